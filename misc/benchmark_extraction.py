@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+Compare how long it takes to extract the values of all fields of an entity
+with :func:`sir.querying.iterate_path_values` and with the function compiled
+by :func:`sir.querying.compile_paths`.
+
+The objects are built in memory from the paths of the entity: every
+relationship on a path leads to ``--children`` related objects (or one for
+many-to-one relationships) and every column gets a made-up value, so no
+database is needed.
+
+Usage: PYTHONPATH=. python misc/benchmark_extraction.py [--children N]
+       [--rows N] [entity ...]
+"""
+import argparse
+import timeit
+
+from sir.querying import iterate_path_values
+from sir.schema import SCHEMA
+from sir.schema.searchentities import merge_paths
+from sqlalchemy import Column
+from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+
+
+def make_value(column, counter):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        python_type = unicode
+    counter[0] += 1
+    if python_type in (int, long, float):
+        return python_type(counter[0])
+    if python_type is bool:
+        return counter[0] % 2 == 0
+    if python_type in (str, unicode):
+        return u"value %i" % counter[0]
+    return None
+
+
+def make_object(model, paths, children, counter):
+    """
+    Return an instance of ``model`` with the values and related objects
+    needed by ``paths``, a tree returned by
+    :func:`sir.schema.searchentities.merge_paths`.
+    """
+    obj = model()
+    for name, sub_paths in paths.items():
+        attribute = getattr(model, name, None)
+        # Hybrid properties can return the attributes they're based on, but
+        # can't be set
+        if (not isinstance(attribute, InstrumentedAttribute) or
+                attribute.key != name):
+            continue
+        prop = attribute.property
+        if isinstance(prop, RelationshipProperty) and sub_paths:
+            sub_model = prop.mapper.class_
+            if prop.direction == MANYTOONE:
+                setattr(obj, name, make_object(sub_model, sub_paths, children,
+                                               counter))
+            elif prop.direction == ONETOMANY:
+                setattr(obj, name, [make_object(sub_model, sub_paths,
+                                                children, counter)
+                                    for _ in range(children)])
+        elif isinstance(prop, ColumnProperty) and len(prop.columns) == 1:
+            column = prop.columns[0]
+            # Skip column_propertys, their values are computed by queries
+            if isinstance(column, Column):
+                setattr(obj, name, make_value(column, counter))
+    return obj
+
+
+def interpreted(entity, obj):
+    field_values = []
+    for field in entity.fields:
+        values = set()
+        for path in field.paths:
+            for value in iterate_path_values(path, obj):
+                if value is not None:
+                    if isinstance(value, list):
+                        values.update(value)
+                    else:
+                        values.add(value)
+        field_values.append(values)
+    return field_values
+
+
+def compiled(entity, obj):
+    return entity.extractor(obj)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--children", type=int, default=3,
+                        help="The number of objects on the other side of "
+                        "each one-to-many relationship")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("entity_type", nargs="*",
+                        default=["release", "recording", "artist", "work"])
+    args = parser.parse_args()
+
+    for name in args.entity_type:
+        entity = SCHEMA[name]
+        paths = merge_paths([field.paths for field in entity.fields])
+        objects = [make_object(entity.model, paths, args.children, [0])
+                   for _ in range(args.rows)]
+        for obj in objects:
+            assert interpreted(entity, obj) == compiled(entity, obj)
+        times = {}
+        for function in (interpreted, compiled):
+            times[function.__name__] = min(timeit.repeat(
+                lambda: [function(entity, obj) for obj in objects],
+                number=1, repeat=3))
+        print("%-15s interpreted %7.1fms  compiled %7.1fms  speedup %.1fx" %
+              (name, times["interpreted"] * 1000, times["compiled"] * 1000,
+               times["interpreted"] / times["compiled"]))
+
+
+if __name__ == "__main__":
+    main()
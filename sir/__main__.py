@@ -7,17 +7,56 @@ import multiprocessing
 import ConfigParser
 
 from . import config
+from . import profiling
 from . import init_raven_client
 from .amqp.extension_generation import generate_extension
 from .amqp.handler import watch
 from .amqp.setup import setup_rabbitmq
 from .indexing import reindex
 from .schema import SCHEMA
+from .sinks import SINKS
 from .trigger_generation import generate_func
+from datetime import datetime
 
 
 logger = logging.getLogger("sir")
 
+#: The formats accepted by :func:`parse_timestamp`
+_TIMESTAMP_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+                      "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+
+def parse_timestamp(value):
+    """
+    Parse a timestamp given on the command line.
+
+    :param str value:
+    :rtype: datetime.datetime
+    :raises argparse.ArgumentTypeError: if ``value`` has an unknown format
+    """
+    for timestamp_format in _TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("Invalid timestamp: %r" % value)
+
+
+def add_profiling_arguments(parser):
+    """
+    Add the options of :mod:`sir.profiling` to ``parser``.
+
+    :param argparse.ArgumentParser parser:
+    """
+    parser.add_argument('--profile', action="store_true",
+                        help="Profile the import with cProfile and write a "
+                        "report sorted by cumulative time when done.")
+    parser.add_argument('--profile-dir', action="store", default="profile",
+                        help="The directory the profiling stats and the "
+                        "report are written into.")
+    parser.add_argument('--profile-every', type=int, default=1,
+                        help="Only profile every Nth batch or message.")
+
 
 def main():
 
@@ -33,6 +72,31 @@ def main():
     reindex_parser.add_argument('--entity-type', action='append',
                                 help="Which entity types to index.",
                                 choices=SCHEMA.keys())
+    reindex_parser.add_argument('--resume', action="store_true",
+                                help="Skip the batches that have been "
+                                "imported by a previous, interrupted run.")
+    reindex_parser.add_argument('--shadow', action="store_true",
+                                help="Build the index in new cores and swap "
+                                "them with the serving ones when done.")
+    reindex_parser.add_argument('--since', type=parse_timestamp,
+                                help="Only reindex the entities that have "
+                                "changed since this time (YYYY-MM-DD "
+                                "[HH:MM[:SS]]) according to the "
+                                "last_updated columns.")
+    reindex_parser.add_argument('--only-own-rows', action="store_true",
+                                help="With --since, ignore changes to the "
+                                "rows of related tables.")
+    reindex_parser.add_argument('--sink', choices=SINKS, default="solr",
+                                help="Where to send the documents to: Solr, "
+                                "JSON lines files or nowhere, to measure "
+                                "the import speed.")
+    reindex_parser.add_argument('--spool-dir', action="store",
+                                default="spool",
+                                help="The directory the jsonl sink writes "
+                                "its files into.")
+    reindex_parser.add_argument('--spool-gzip', action="store_true",
+                                help="Compress the files of the jsonl sink.")
+    add_profiling_arguments(reindex_parser)
 
     generate_trigger_parser = subparsers.add_parser("triggers",
                                                     help="Generate triggers")
@@ -81,10 +145,17 @@ def main():
     amqp_watch_parser.add_argument('--entity-type', action='append',
                                    help="Which entity types to watch.",
                                    choices=SCHEMA.keys())
+    add_profiling_arguments(amqp_watch_parser)
 
     amqp_watch_parser.set_defaults(func=watch)
 
     args = parser.parse_args()
+    if args.func is reindex and args.since is not None:
+        # Imports of changed entities are neither checkpointed nor swapped in
+        for option in ("shadow", "resume"):
+            if getattr(args, option):
+                reindex_parser.error("argument --%s: not allowed with "
+                                     "argument --since" % option)
     if args.debug:
         logger.setLevel(logging.DEBUG)
     else:
@@ -133,7 +204,14 @@ def main():
         logger.info("Skipping Raven client initialization. Configuration issue: %s", e)
     func = args.func
     args = vars(args)
-    func(args)
+    if args.get("profile"):
+        profiling.enable(args["profile_dir"], args["profile_every"])
+        try:
+            func(args)
+        finally:
+            profiling.report(args["profile_dir"])
+    else:
+        func(args)
 
 
 if __name__ == '__main__':
@@ -9,7 +9,7 @@ import sir.indexing as indexing
 import time
 
 from sir.amqp import message
-from sir import get_sentry, config
+from sir import get_sentry, config, metrics, profiling
 from sir.schema import SCHEMA, generate_update_map
 from sir.indexing import live_index
 from sir.trigger_generation.paths import second_last_model_in_path, generate_query, generate_filtered_query
@@ -229,6 +229,7 @@ class Handler(object):
         self.channel.basic_reject(msg.delivery_tag, requeue=requeue)
 
     @callback_wrapper
+    @profiling.profiled
     def index_callback(self, parsed_message):
         """
         Callback for processing `index` messages.
@@ -262,6 +263,7 @@ class Handler(object):
             self._index_by_pk(parsed_message)
 
     @callback_wrapper
+    @profiling.profiled
     def delete_callback(self, parsed_message):
         """
         Callback for processing `delete` messages.
@@ -512,6 +514,8 @@ def watch(args):
         logger.error("Couldn't connect to RabbitMQ, check your settings. %s", e)
         exit(1)
 
+    metrics.start_exporters()
+
     try:
         entities = args["entity_type"] or SCHEMA.keys()
         _watch_impl(entities)
@@ -0,0 +1,131 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module adapts the number of rows in the batches of each entity to how
+long importing them takes and how much memory the import workers use, and
+remembers the sizes between runs.
+"""
+import json
+import os
+
+from logging import getLogger
+
+
+logger = getLogger("sir")
+
+#: The file the learned sizes are stored in if ``[sir] batch_sizes_file`` is
+#: not set.
+_DEFAULT_BATCH_SIZES_FILE = "batch_sizes.json"
+
+#: How much the newest measurement contributes to the estimated throughput.
+_SMOOTHING = 0.3
+
+#: How many times larger than ``query_batch_size`` a batch may become.
+_MAX_SIZE_FACTOR = 10
+
+#: How many times smaller than ``query_batch_size`` a batch may become.
+_MIN_SIZE_FACTOR = 10
+
+
+class BatchSizer(object):
+    """
+    Computes the size of the next batch of an entity from the throughput of
+    the previous ones. Calling the object returns the current size, so it can
+    be passed to :func:`sir.querying.iter_bounds` as its ``batch_size``.
+
+    The size is chosen so that a batch takes about ``target_seconds`` to
+    import. If the resident set size of its worker peaked more than
+    ``max_memory`` above the one before the batch, the size is reduced
+    proportionally.
+    The memory the worker already used before the batch, for example for the
+    batches of other entities, doesn't make the size shrink.
+    """
+
+    def __init__(self, size, target_seconds, max_memory=0, max_size=None,
+                 min_size=1):
+        """
+        :param int size: The size of the first batch.
+        :param float target_seconds: How long importing a batch should take.
+        :param int max_memory: How many bytes importing a batch may add to
+                               the memory of a worker, or 0 if there is no
+                               limit.
+        :param int max_size: The largest allowed size.
+        :param int min_size: The smallest allowed size.
+        """
+        self.min_size = max(int(min_size), 1)
+        self.size = max(int(size), self.min_size)
+        self.target_seconds = target_seconds
+        self.max_memory = max_memory
+        self.max_size = max_size
+        #: The smoothed number of rows imported per second
+        self.rows_per_second = None
+
+    def __call__(self):
+        return self.size
+
+    def record(self, rows, seconds, memory):
+        """
+        Update the size after a batch with ``rows`` rows has been imported in
+        ``seconds`` seconds and the peak resident set size of its worker was
+        ``memory`` bytes above the one before the batch.
+
+        :param int rows:
+        :param float seconds:
+        :param int memory:
+        """
+        if rows <= 0:
+            # Empty batches (like the noop batch at the importlimit) don't
+            # say anything about the throughput
+            return
+        rate = rows / max(seconds, 0.001)
+        if self.rows_per_second is None:
+            self.rows_per_second = rate
+        else:
+            self.rows_per_second = (_SMOOTHING * rate +
+                                    (1 - _SMOOTHING) * self.rows_per_second)
+        size = self.rows_per_second * self.target_seconds
+        # Grow slowly because a single fast batch might have been a fluke
+        size = min(size, 2 * self.size)
+        if self.max_memory and memory > self.max_memory:
+            size = min(size, rows * float(self.max_memory) / memory)
+        if self.max_size:
+            size = min(size, self.max_size)
+        self.size = max(int(size), self.min_size)
+
+
+def load_batch_sizes(path):
+    """
+    Return the batch sizes stored in ``path`` by :func:`save_batch_sizes` or
+    an empty dict if there are none.
+
+    :param str path:
+    :rtype: dict(str, int)
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            sizes = json.load(f)
+    except ValueError:
+        logger.warning("Ignoring invalid batch sizes in %s", path)
+        return {}
+    return dict((name, int(size)) for name, size in sizes.items())
+
+
+def save_batch_sizes(path, sizes):
+    """
+    Store ``sizes``, which maps entity names to batch sizes, in ``path``
+    together with the sizes of other entities already stored there.
+
+    :param str path:
+    :param sizes:
+    :type sizes: dict(str, int)
+    """
+    stored = load_batch_sizes(path)
+    stored.update(sizes)
+    # Replace the file atomically so an interrupted write doesn't lose the
+    # sizes of all entities
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stored, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
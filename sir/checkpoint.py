@@ -0,0 +1,106 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module keeps track of the batches of a reindex whose documents have
+been accepted by Solr, so an interrupted reindex can be resumed without
+importing them again.
+"""
+import os
+
+from collections import defaultdict
+from logging import getLogger
+
+
+logger = getLogger("sir")
+
+#: The file the journal is stored in if ``[sir] checkpoint_file`` is not set.
+_DEFAULT_CHECKPOINT_FILE = "reindex.checkpoints"
+
+
+def _format_bound(bound):
+    return "-" if bound is None else str(bound)
+
+
+def _parse_bound(bound):
+    return None if bound == "-" else int(bound)
+
+
+class CheckpointJournal(object):
+    """
+    An append-only file with one line per completed batch. Each line contains
+    the entity name and the lower and upper bound of the batch, separated by
+    whitespace. An upper bound of ``None`` is written as ``-``.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: The path of the journal file.
+        """
+        self.path = path
+        self.completed = defaultdict(list)
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entity, lower, upper = line.split()
+                        bounds = (_parse_bound(lower), _parse_bound(upper))
+                    except ValueError:
+                        # A line that has only been written partially
+                        logger.warning("Ignoring invalid checkpoint %r",
+                                       line)
+                        continue
+                    self.completed[entity].append(bounds)
+
+    def clear(self, entities):
+        """
+        Forget all completed batches of ``entities``.
+
+        :param [str] entities:
+        """
+        for entity in entities:
+            self.completed.pop(entity, None)
+        with open(self.path, "w") as f:
+            for entity, bounds_list in self.completed.items():
+                for bounds in bounds_list:
+                    f.write(self._format(entity, bounds))
+
+    def record(self, entity, bounds):
+        """
+        Mark the batch ``bounds`` of ``entity`` as completed.
+
+        :param str entity:
+        :param bounds:
+        :type bounds: (int, int)
+        """
+        self.completed[entity].append(bounds)
+        with open(self.path, "a") as f:
+            f.write(self._format(entity, bounds))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def is_completed(self, entity, bounds):
+        """
+        Check whether all rows in ``bounds`` are covered by a completed batch
+        of ``entity``. The bounds don't have to match the recorded ones
+        exactly because they might be computed differently after rows have
+        been added to or removed from the table.
+
+        :param str entity:
+        :param bounds:
+        :type bounds: (int, int)
+        :rtype: bool
+        """
+        lower, upper = bounds
+        for done_lower, done_upper in self.completed.get(entity, []):
+            if done_lower > lower:
+                continue
+            if done_upper is None or (upper is not None and
+                                      upper <= done_upper):
+                return True
+        return False
+
+    @staticmethod
+    def _format(entity, bounds):
+        return "%s %s %s\n" % (entity,
+                               _format_bound(bounds[0]),
+                               _format_bound(bounds[1]))
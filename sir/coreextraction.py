@@ -0,0 +1,437 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module extracts the values of the fields of an entity with plain
+SQLAlchemy Core queries instead of loading ORM objects through
+:attr:`sir.schema.searchentities.SearchEntity.query`.
+
+The paths of the fields are merged into a tree of the models they lead
+through, like in :func:`sir.querying.compile_paths`. For each node of the
+tree, one query selects the columns needed by the paths ending there and the
+ones needed to find the related rows of the next nodes. The rows of a node
+are grouped by the column that links them to the rows of their parent node,
+so the values of an entity can be collected by following those groups
+instead of ORM relationships.
+
+:class:`JSONExtractor` walks the same tree, but lets Postgres collect the
+rows of all nodes into one JSON document per entity, so only a single query
+runs per batch and its result only has to be decoded.
+"""
+import operator
+import ujson
+
+from collections import defaultdict, namedtuple
+from logging import getLogger
+from sqlalchemy import (Date, DateTime, Float, Interval, LargeBinary, Numeric,
+                        Text, Time, and_, cast, func, select)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, psycopg2
+from sqlalchemy.orm.descriptor_props import CompositeProperty
+from sqlalchemy.orm.interfaces import MANYTOMANY
+from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm.query import Query
+from sqlalchemy.sql.elements import BinaryExpression
+from sqlalchemy.sql.util import ClauseAdapter
+from sqlalchemy.types import UserDefinedType
+
+
+logger = getLogger("sir")
+
+#: The maximum number of values in the ``IN`` clause of a query for the rows
+#: related to the rows of the previous node
+_IN_CHUNK_SIZE = 5000
+
+#: The id of an entity and a list with a set of values for each of its fields,
+#: like :attr:`sir.schema.searchentities.SearchEntity.extractor` returns
+ExtractedRow = namedtuple("ExtractedRow", ["id", "values"])
+
+#: Postgres functions like ``json_build_array`` take at most this many
+#: arguments
+_MAX_FUNCTION_ARGUMENTS = 100
+
+#: Types whose values psycopg2 returns as Python objects that aren't
+#: represented the same way in JSON
+_NON_JSON_TYPES = (Date, DateTime, Interval, LargeBinary, Numeric, Time)
+
+#: Types whose values are converted by their result processor, so they're
+#: put into JSON documents as text for :class:`JSONExtractor`
+_TEXT_TYPES = (UserDefinedType, UUID)
+
+
+class UnsupportedPathException(Exception):
+    def __init__(self, model, path, reason):
+        self.model = model
+        self.path = path
+        self.reason = reason
+
+    def __str__(self):
+        return "%s on %s: %s" % (self.path, self.model.__name__, self.reason)
+
+
+class _Node(object):
+    """
+    The rows of ``model`` reached through the same relationships, whose
+    ``link_column`` matches a column of the rows of the previous node.
+    """
+
+    def __init__(self, model, paths, link_column):
+        """
+        :param model:
+        :param paths: A list of ``(path, index)`` tuples, where ``index`` is
+                      the index of the field ``path`` belongs to.
+        :param sqlalchemy.Column link_column:
+        """
+        self.model = model
+        self.link_column = link_column
+        #: The columns selected besides ``link_column``
+        self.columns = []
+        #: ``(positions, composite_class, constant, indexes)`` tuples, one
+        #: for each attribute the paths in ``indexes`` end at
+        self.leaves = []
+        #: ``(position, node)`` tuples, where ``position`` is the position of
+        #: the column ``node.link_column`` has to match
+        self.branches = []
+
+        leaves = defaultdict(set)
+        branches = defaultdict(list)
+        for path, index in paths:
+            pathelem, _, rest = path.partition(".")
+            attribute = getattr(model, pathelem)
+            prop = getattr(attribute, "property", None)
+            if rest and isinstance(prop, RelationshipProperty):
+                branches[pathelem].append((rest, index))
+            else:
+                leaves[pathelem].add(index)
+
+        for name, indexes in leaves.items():
+            self._add_leaf(model, name, tuple(indexes))
+        for name, sub_paths in branches.items():
+            self._add_branch(model, name, sub_paths)
+
+    def _position(self, column):
+        # Columns are compared by identity because == builds an expression
+        for i, selected in enumerate(self.columns, 1):
+            if selected is column:
+                return i
+        self.columns.append(column)
+        # The link column comes first in each row
+        return len(self.columns)
+
+    def _add_leaf(self, model, name, indexes):
+        attribute = getattr(model, name)
+        prop = getattr(attribute, "property", None)
+        if isinstance(prop, ColumnProperty):
+            self.leaves.append(((self._position(prop.columns[0]),), None,
+                                None, indexes))
+        elif isinstance(prop, CompositeProperty):
+            positions = tuple(self._position(column)
+                              for column in prop.columns)
+            self.leaves.append((positions, prop.composite_class, None,
+                                indexes))
+        elif prop is None and isinstance(attribute, basestring):
+            # Like __tablename__
+            self.leaves.append(((), None, attribute, indexes))
+        else:
+            raise UnsupportedPathException(model, name, "Only columns, "
+                                           "composites and string constants "
+                                           "are supported at the end of a "
+                                           "path")
+
+    def _add_branch(self, model, name, sub_paths):
+        prop = getattr(model, name).property
+        if prop.direction == MANYTOMANY:
+            # iterate_path_values doesn't follow them
+            return
+        join = prop.primaryjoin
+        if (prop.secondary is not None or
+                len(prop.local_remote_pairs) != 1 or
+                not isinstance(join, BinaryExpression) or
+                join.operator is not operator.eq):
+            raise UnsupportedPathException(model, name, "Only relationships "
+                                           "joining on a single pair of "
+                                           "columns are supported")
+        local, remote = prop.local_remote_pairs[0]
+        node = _Node(prop.mapper.class_, sub_paths, remote)
+        self.branches.append((self._position(local), node))
+
+    def statement(self, condition):
+        # The labels keep columns that are selected twice, like a primary key
+        # that's also needed by a relationship, apart
+        columns = [self.link_column.label("link")]
+        columns.extend(column.label("c%i" % i)
+                       for i, column in enumerate(self.columns, 1))
+        return select(columns).where(condition)
+
+    def fetch(self, session, link_values):
+        """
+        Return a :class:`_Rows` with the rows of this node whose link column
+        has one of the values in ``link_values``.
+        """
+        groups = defaultdict(list)
+        link_values = sorted(link_values)
+        for i in xrange(0, len(link_values), _IN_CHUNK_SIZE):
+            chunk = link_values[i:i + _IN_CHUNK_SIZE]
+            query = self.statement(self.link_column.in_(chunk))
+            for row in session.execute(query):
+                groups[row[0]].append(row)
+        return _Rows(self, session, groups)
+
+    def add_values(self, row, rows, values):
+        """
+        Add the values of the paths through ``row`` to ``values``.
+
+        :param row: A row of this node
+        :param _Rows rows: The rows of this and the following nodes
+        :param [set] values:
+        """
+        self._add_leaf_values(row, values)
+        for (position, node), node_rows in zip(self.branches, rows.children):
+            key = row[position]
+            if key is None:
+                continue
+            for sub_row in node_rows.groups.get(key, ()):
+                node.add_values(sub_row, node_rows, values)
+
+    def _add_leaf_values(self, row, values):
+        for positions, composite_class, constant, indexes in self.leaves:
+            if composite_class is not None:
+                value = composite_class(*[row[p] for p in positions])
+            elif positions:
+                value = row[positions[0]]
+            else:
+                value = constant
+            if value is None:
+                continue
+            if isinstance(value, list):
+                for index in indexes:
+                    values[index].update(value)
+            else:
+                for index in indexes:
+                    values[index].add(value)
+
+    def json_array(self, adapter, dialect):
+        """
+        Return a ``json_build_array`` expression with the link column and the
+        other columns of a row of this node, in the same positions as in the
+        rows of :meth:`statement`, followed by a JSON array of the arrays of
+        the related rows of each branch, which is ``null`` if there are none.
+
+        Each node selects from its own alias of its table, so the subqueries
+        of the branches are only correlated to the rows of their parent node,
+        even if a table is reached more than once.
+
+        :param sqlalchemy.sql.util.ClauseAdapter adapter: Adapts the columns
+                                                          of this node to its
+                                                          alias.
+        :param dialect: The dialect whose result processors are used to
+                        convert the values of :data:`_TEXT_TYPES`.
+        :raises UnsupportedPathException: if a value can't be represented in
+                                          JSON
+        """
+        #: ``(position, processor)`` tuples for the values that are converted
+        #: after decoding the JSON document
+        self.json_processors = []
+        leaf_positions = set(position for positions, _, _, _ in self.leaves
+                             for position in positions)
+        columns = [adapter.traverse(column)
+                   for column in [self.link_column] + self.columns]
+        elements = []
+        for position, column in enumerate(columns):
+            if position in leaf_positions:
+                column = self._json_value(column, position, dialect)
+            elements.append(column)
+        for position, node in self.branches:
+            elements.append(node.json_aggregate(columns[position], dialect))
+        if len(elements) > _MAX_FUNCTION_ARGUMENTS:
+            raise UnsupportedPathException(self.model, "",
+                                           "Too many columns for "
+                                           "json_build_array")
+        return func.json_build_array(*elements)
+
+    def json_aggregate(self, parent_column, dialect):
+        """
+        Return a scalar subquery aggregating the :meth:`json_array` of each
+        row of this node whose link column matches ``parent_column``.
+        """
+        adapter = ClauseAdapter(self.link_column.table.alias())
+        link = adapter.traverse(self.link_column)
+        return (select([func.json_agg(self.json_array(adapter, dialect))]).
+                where(link == parent_column).
+                as_scalar())
+
+    def _json_value(self, column, position, dialect):
+        type_ = column.type
+        item_type = type_.item_type if isinstance(type_, ARRAY) else type_
+        if (isinstance(item_type, _NON_JSON_TYPES) and
+                not isinstance(item_type, Float)):
+            raise UnsupportedPathException(self.model,
+                                           getattr(column, "key", column),
+                                           "%s values can't be compared "
+                                           "after a round trip through JSON"
+                                           % type(item_type).__name__)
+        if isinstance(type_, _TEXT_TYPES):
+            processor = (type_.dialect_impl(dialect).
+                         result_processor(dialect, None))
+            if processor is not None:
+                self.json_processors.append((position, processor))
+                return cast(column, Text)
+        return column
+
+    def add_json_values(self, item, values):
+        """
+        Add the values of the paths through ``item``, a decoded
+        :meth:`json_array`, to ``values``.
+
+        :param list item:
+        :param [set] values:
+        """
+        for position, processor in self.json_processors:
+            if item[position] is not None:
+                item[position] = processor(item[position])
+        self._add_leaf_values(item, values)
+        for (_, node), sub_items in zip(self.branches,
+                                        item[len(self.columns) + 1:]):
+            for sub_item in sub_items or ():
+                node.add_json_values(sub_item, values)
+
+
+class _Rows(object):
+    """
+    The rows of a :class:`_Node`, grouped by the value of its link column,
+    and the rows of the nodes following it.
+    """
+
+    def __init__(self, node, session, groups):
+        self.groups = groups
+        self.children = []
+        for position, sub_node in node.branches:
+            keys = set(row[position] for group in groups.itervalues()
+                       for row in group)
+            keys.discard(None)
+            self.children.append(sub_node.fetch(session, keys))
+
+
+class CoreExtractor(object):
+    """
+    Extracts the values of the fields of the entities of ``model`` with
+    SQLAlchemy Core queries.
+    """
+
+    def __init__(self, model, field_paths, extraquery=None):
+        """
+        :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+        :param field_paths: The paths of each field.
+        :type field_paths: [[str]]
+        :param extraquery: The ``extraquery`` of the
+                           :class:`~sir.schema.searchentities.SearchEntity`,
+                           which may only add filters to the query.
+        :raises UnsupportedPathException: if any of the paths can't be
+                                          followed without the ORM
+        """
+        self.model = model
+        self.field_count = len(field_paths)
+        self.extraquery = extraquery
+        self.root = _Node(model, [(path, index)
+                                  for index, paths in enumerate(field_paths)
+                                  for path in paths],
+                          model.id.property.columns[0])
+
+    def iter_rows(self, session, condition, chunk_size=None):
+        """
+        Yield an :data:`ExtractedRow` for each entity matching ``condition``.
+
+        The rows related to the entities are queried for ``chunk_size``
+        entities at a time, or all of them at once if it's not set.
+
+        :param sqlalchemy.orm.session.Session session:
+        :param sqlalchemy.sql.expression.BinaryExpression condition:
+        :param int chunk_size:
+        """
+        if self.extraquery is not None:
+            ids = self.extraquery(Query(self.model.id)).statement
+            condition = and_(condition, self.model.id.in_(ids))
+        query = (self.root.statement(condition).
+                 order_by(self.root.link_column))
+        root_rows = session.execute(query).fetchall()
+        chunk_size = chunk_size or len(root_rows)
+        for i in xrange(0, len(root_rows), chunk_size):
+            chunk = root_rows[i:i + chunk_size]
+            groups = dict((row[0], [row]) for row in chunk)
+            rows = _Rows(self.root, session, groups)
+            for row in chunk:
+                values = [set() for _ in xrange(self.field_count)]
+                self.root.add_values(row, rows, values)
+                yield ExtractedRow(row[0], values)
+
+
+class JSONExtractor(object):
+    """
+    Extracts the values of the fields of the entities of ``model`` with a
+    single query that returns one JSON document per entity.
+
+    The document of an entity is built by Postgres with ``json_build_array``
+    from the columns needed by the paths of the fields, and includes the
+    documents of its related rows, collected with ``json_agg`` in a
+    correlated subquery for each relationship along the paths. Python only
+    has to decode the documents.
+
+    Values of :data:`_NON_JSON_TYPES`, like timestamps, can't be extracted
+    this way, because they would come back as strings instead of the
+    objects the ORM returns.
+    """
+
+    def __init__(self, model, field_paths, extraquery=None):
+        """
+        The parameters are the same as for :class:`CoreExtractor`.
+
+        :raises UnsupportedPathException: if any of the paths can't be
+                                          followed without the ORM or leads
+                                          to values that can't be represented
+                                          in JSON
+        """
+        self.model = model
+        self.field_count = len(field_paths)
+        self.extraquery = extraquery
+        self.root = _Node(model, [(path, index)
+                                  for index, paths in enumerate(field_paths)
+                                  for path in paths],
+                          model.id.property.columns[0])
+        self._adapter = ClauseAdapter(self.root.link_column.table.alias())
+        self._document = cast(self.root.json_array(self._adapter,
+                                                   psycopg2.dialect()),
+                              Text)
+
+    def statement(self, condition):
+        """
+        Return the query selecting the id and the JSON document of each
+        entity matching ``condition``.
+
+        :param sqlalchemy.sql.expression.BinaryExpression condition:
+        """
+        link = self._adapter.traverse(self.root.link_column)
+        condition = self._adapter.traverse(condition)
+        if self.extraquery is not None:
+            ids = self.extraquery(Query(self.model.id)).statement
+            condition = and_(condition, link.in_(ids))
+        return (select([link.label("id"), self._document.label("document")]).
+                where(condition).
+                order_by(link))
+
+    def iter_rows(self, session, condition, chunk_size=None):
+        """
+        Yield an :data:`ExtractedRow` for each entity matching ``condition``.
+
+        If ``chunk_size`` is set, the documents are read through a
+        server-side cursor ``chunk_size`` at a time instead of all at once.
+
+        :param sqlalchemy.orm.session.Session session:
+        :param sqlalchemy.sql.expression.BinaryExpression condition:
+        :param int chunk_size:
+        """
+        query = self.statement(condition)
+        if chunk_size:
+            query = query.execution_options(stream_results=True,
+                                            max_row_buffer=chunk_size)
+        for row_id, document in session.execute(query):
+            values = [set() for _ in xrange(self.field_count)]
+            self.root.add_json_values(ujson.loads(document), values)
+            yield ExtractedRow(row_id, values)
@@ -1,21 +1,42 @@
 # Copyright (c) 2014, 2015, 2017 Lukas Lalinsky, Wieland Hoffmann, MetaBrainz Foundation
 # License: MIT, see LICENSE for details
+import atexit
+import itertools
+import json
 import multiprocessing
+import os
+import re
+import resource
 import signal
+import sys
+import threading
+import time
 
-from . import config, querying, util, get_sentry
-from .schema import SCHEMA
+from . import config, metrics, profiling, querying, util, get_sentry
+from .batchsizing import (BatchSizer, _DEFAULT_BATCH_SIZES_FILE,
+                          _MAX_SIZE_FACTOR, _MIN_SIZE_FACTOR, load_batch_sizes,
+                          save_batch_sizes)
+from .checkpoint import CheckpointJournal, _DEFAULT_CHECKPOINT_FILE
+from .schema import SCHEMA, generate_update_map, queryext
+from .shadow import CoreAdmin, ShadowCore, ShadowCoreMismatchException
+from .sinks import sink_connection_function
+from .trigger_generation.paths import generate_query, unique_split_paths
 from ConfigParser import NoOptionError
+from collections import Counter, defaultdict
 from functools import partial
 from logging import getLogger, DEBUG, INFO
 from pysolr import SolrError
+from retrying import Retrying
 from sqlalchemy import and_
 from .util import SIR_EXIT
-from ctypes import c_bool
+from ctypes import c_bool, c_double, c_long
+from multiprocessing.pool import ThreadPool
+from multiprocessing.queues import SimpleQueue
+from Queue import Empty
 
 __all__ = ["reindex", "index_entity", "queue_to_solr", "send_data_to_solr",
-           "_multiprocessed_import", "_index_entity_process_wrapper", "live_index",
-           "live_index_entity"]
+           "_multiprocessed_import", "_index_entity_process_wrapper",
+           "live_index", "live_index_entity", "_init_index_worker"]
 
 
 logger = getLogger("sir")
@@ -24,6 +45,24 @@ PROCESS_FLAG = multiprocessing.Value(c_bool, True)
 FAILED = multiprocessing.Value(c_bool, False)
 STOP = None
 
+#: The ways changes can be committed to Solr, see :func:`_commit_policy`
+COMMIT_POLICIES = ("none", "within", "soft", "hard")
+
+#: The ways the values of the fields can be retrieved from the database, see
+#: :func:`_query_database`
+EXTRACTION_ENGINES = ("orm", "core", "json")
+
+#: Maps entity names to the queues their documents are put into. It's set in
+#: each import worker by :func:`_init_index_worker` because queues can only be
+#: shared with other processes through inheritance.
+_DATA_QUEUES = {}
+
+#: The :class:`_ImportWorkers` of live indexing and the queues of
+#: :func:`_document_queues` of every entity they put documents into. They're
+#: kept between calls of :func:`live_index`, so the workers keep their
+#: database connections.
+_LIVE_WORKERS = None
+
 
 def reindex(args):
     """
@@ -31,7 +70,26 @@ def reindex(args):
 
     If no types are specified, all known entities will be reindexed.
 
-    :param args: A dictionary with a key named ``entities``.
+    If ``args["resume"]`` is true, batches that have already been imported
+    by a previous, interrupted run according to the checkpoint journal
+    (see :mod:`sir.checkpoint`) are skipped. Only imports into the ``solr``
+    sink use the journal.
+
+    If ``args["since"]`` is set, only the entities returned by
+    :func:`_changed_entity_ids` are reindexed, following the paths of the
+    update map unless ``args["only_own_rows"]`` is true.
+
+    ``args["sink"]`` selects where the documents are sent to, see
+    :mod:`sir.sinks`. Documents for the ``jsonl`` sink are written into
+    ``args["spool_dir"]``, compressed if ``args["spool_gzip"]`` is true.
+
+    If ``args["shadow"]`` is true, the documents are imported into shadow
+    cores that replace the serving cores once they're complete, see
+    :mod:`sir.shadow`.
+
+    :param args: A dictionary with keys named ``entities``, ``resume``,
+                 ``since``, ``only_own_rows``, ``sink``, ``spool_dir``,
+                 ``spool_gzip`` and ``shadow``.
     :type args: dict
     """
 
@@ -41,20 +99,235 @@ def reindex(args):
         logger.info('Process Flag is off, terminating.')
         return
 
+    metrics.start_exporters()
+
     entities = args["entity_type"]
     known_entities = SCHEMA.keys()
     if entities is None:
         entities = known_entities
 
+    sink = args.get("sink") or "solr"
+    if args.get("shadow") and sink != "solr":
+        logger.error("Shadow cores can only be built with the solr sink")
+        return
+    if sink == "solr":
+        try:
+            logger.info("Checking whether the versions of the Solr cores are "
+                        "supported")
+            util.check_solr_cores_version(entities)
+        except util.VersionMismatchException as exc:
+            logger.error(exc)
+            return
+    connect = sink_connection_function(sink, args.get("spool_dir"),
+                                       args.get("spool_gzip", False))
+
+    engine = _extraction_engine()
+    if engine != "orm" and config.CFG.getboolean("sir", "wscompat"):
+        logger.warning("The %s extraction engine can't build the _store "
+                       "field needed by wscompat, all entities are loaded "
+                       "as ORM objects instead", engine)
+
+    since = args.get("since")
+    if since is not None:
+        ids = _changed_entity_ids(entities, since,
+                                  not args.get("only_own_rows", False))
+        for entity_name in entities:
+            logger.info("%i %s entities have changed since %s",
+                        len(ids.get(entity_name, ())), entity_name, since)
+        # These are just like the ids received when live indexing
+        FAILED.value = False
+        _multiprocessed_import(ids.keys(), live=True, entities=ids,
+                               connect=connect)
+        if FAILED.value:
+            logger.error("Failed to send some documents to Solr")
+        return
+
+    # The journal records the batches Solr has accepted, so other sinks must
+    # neither clear nor add to it
+    journal = None
+    if sink == "solr":
+        try:
+            checkpoint_file = config.CFG.get("sir", "checkpoint_file")
+        except NoOptionError:
+            checkpoint_file = _DEFAULT_CHECKPOINT_FILE
+        journal = CheckpointJournal(checkpoint_file)
+        if not args["resume"]:
+            journal.clear(entities)
+    elif args["resume"]:
+        logger.warning("Only imports into Solr are checkpointed, importing "
+                       "all batches into the %s sink", sink)
+
+    if args.get("shadow"):
+        _reindex_into_shadow_cores(entities, journal, args["resume"])
+        return
+
+    _multiprocessed_import(entities, journal=journal, connect=connect)
+
+
+def _reindex_into_shadow_cores(entity_names, journal, resume=False):
+    """
+    Import ``entity_names`` into a :class:`~sir.shadow.ShadowCore` each and
+    swap them with the serving cores if they contain as many documents as
+    there are rows in the database.
+
+    The shadow cores are created from the configset named by
+    ``shadow_config_set`` in the ``[solr]`` section, in which ``%s`` is
+    replaced by the name of the core. Their document counts may differ from
+    the number of rows by the fraction ``shadow_tolerance``, since rows with
+    invalid data are skipped. The replaced cores are deleted unless
+    ``shadow_keep_old`` is set.
+
+    :param [str] entity_names:
+    :param sir.checkpoint.CheckpointJournal journal:
+    :param bool resume: Whether to continue importing into existing shadow
+                        cores
+    """
+    try:
+        config_set = config.CFG.get("solr", "shadow_config_set")
+    except NoOptionError:
+        config_set = "%s"
+    try:
+        tolerance = config.CFG.getfloat("solr", "shadow_tolerance")
+    except NoOptionError:
+        tolerance = 0.001
     try:
-        logger.info("Checking whether the versions of the Solr cores are "
-                    "supported")
-        util.check_solr_cores_version(entities)
-    except util.VersionMismatchException as exc:
-        logger.error(exc)
+        keep_old = config.CFG.getboolean("solr", "shadow_keep_old")
+    except NoOptionError:
+        keep_old = False
+    try:
+        importlimit = config.CFG.getint("sir", "importlimit")
+    except NoOptionError:
+        importlimit = 0
+
+    admin = CoreAdmin(config.CFG.get("solr", "uri"))
+    shadow_cores = {}
+    for entity_name in entity_names:
+        shadow_core = ShadowCore(admin, entity_name, config_set % entity_name)
+        shadow_core.prepare(resume)
+        shadow_cores[entity_name] = shadow_core
+
+    FAILED.value = False
+    # Every document is sent to an empty core, so Solr doesn't have to check
+    # whether it replaces an existing one. A resumed import sends the batches
+    # that were being imported when it was interrupted again, and their
+    # documents may already be in the core.
+    failed = _multiprocessed_import(entity_names, journal=journal,
+                                    connect=partial(_shadow_connection,
+                                                    shadow_cores),
+                                    overwrite=resume)
+    if FAILED.value or not PROCESS_FLAG.value:
+        logger.error("Not swapping the shadow cores because the import "
+                     "failed")
         return
 
-    _multiprocessed_import(entities)
+    with util.db_session_ctx(util.db_session()) as session:
+        for entity_name in entity_names:
+            if entity_name in failed:
+                logger.error("Not swapping %s because some of its batches "
+                             "failed", entity_name)
+                continue
+            expected_count = _expected_document_count(session, entity_name,
+                                                      journal, importlimit)
+            try:
+                shadow_cores[entity_name].finish(expected_count, tolerance,
+                                                 keep_old)
+            except ShadowCoreMismatchException as exc:
+                logger.error("Not swapping %s: %s", entity_name, exc)
+
+
+def _expected_document_count(session, entity_name, journal, importlimit=0):
+    """
+    Return the number of rows of ``entity_name`` a reindex imports, which
+    are the ones matching the ``extraquery`` of its search entity.
+
+    With an ``importlimit``, the import stops at the end of the last batch
+    before the limit, so only the rows below the highest upper bound of the
+    batches completed according to ``journal`` are counted.
+
+    :param sqlalchemy.orm.session.Session session:
+    :param str entity_name:
+    :param sir.checkpoint.CheckpointJournal journal:
+    :param int importlimit:
+    :rtype: int
+    """
+    search_entity = SCHEMA[entity_name]
+    model = search_entity.model
+    query = session.query(model.id)
+    if search_entity.extraquery is not None:
+        query = search_entity.extraquery(query)
+    if importlimit:
+        # The noop bound at the limit has the same lower and upper bound
+        upper_bounds = [upper for lower, upper
+                        in journal.completed.get(entity_name, [])
+                        if lower != upper]
+        if not upper_bounds:
+            return 0
+        if None not in upper_bounds:
+            query = query.filter(model.id < max(upper_bounds))
+    return query.count()
+
+
+def _shadow_connection(shadow_cores, core, max_inflight=1):
+    """
+    Like :func:`sir.util.solr_connection`, but connect to the shadow core of
+    ``core`` in ``shadow_cores``.
+    """
+    return util.solr_connection(shadow_cores[core].name, max_inflight)
+
+
+def _changed_id_queries(entity_names, since, follow_paths=True):
+    """
+    Yield ``(entity name, query)`` tuples. Each query selects the ids of the
+    entities of that type whose own row or, if ``follow_paths`` is true, a
+    row of a table on one of the paths of :func:`sir.schema.generate_update_map`
+    has a ``last_updated`` value not older than ``since``.
+
+    Tables without a ``last_updated`` column are skipped, so changes to them
+    and deleted rows are not found.
+
+    :param [str] entity_names:
+    :param datetime.datetime since:
+    :param bool follow_paths:
+    :rtype: iterator over (str, sqlalchemy.orm.query.Query)
+    """
+    entity_names = set(entity_names)
+    update_map, _, model_map, _ = generate_update_map()
+    for table_name, core_paths in sorted(update_map.items()):
+        model = model_map[table_name]
+        if not hasattr(model, "last_updated"):
+            continue
+        for core_name, path in sorted(core_paths):
+            if core_name not in entity_names or (path and not follow_paths):
+                continue
+            yield core_name, generate_query(SCHEMA[core_name].model, path,
+                                            model.last_updated >= since)
+
+
+def _changed_entity_ids(entity_names, since, follow_paths=True):
+    """
+    Return the ids of the entities of the types in ``entity_names`` that
+    have changed since ``since``, as found by the queries of
+    :func:`_changed_id_queries`. Only indexed range scans on the
+    ``last_updated`` columns are needed, instead of a scan of every table.
+
+    :param [str] entity_names:
+    :param datetime.datetime since:
+    :param bool follow_paths:
+    :rtype: dict(str, set(int))
+    """
+    for entity_name in entity_names:
+        if not hasattr(SCHEMA[entity_name].model, "last_updated"):
+            logger.warning("The table of %s has no last_updated column, only "
+                           "changes to related rows will be found",
+                           entity_name)
+    ids = defaultdict(set)
+    with util.db_session_ctx(util.db_session()) as session:
+        for core_name, query in _changed_id_queries(entity_names, since,
+                                                     follow_paths):
+            logger.debug("SQL: %s", query)
+            ids[core_name].update(row[0] for row in
+                                  query.with_session(session))
+    return dict(ids)
 
 
 def live_index(entities):
@@ -62,6 +335,9 @@ def live_index(entities):
      Reindex all documents in``entities`` in multiple processes via the
     :mod:`multiprocessing` module.
 
+    The import workers and their database connections are kept for the next
+    call, see :func:`_live_import_workers`.
+
     :param entities:
     :type entities: dict(set(int))
     """
@@ -74,26 +350,61 @@ def live_index(entities):
         return
     # Reset failed before each import
     FAILED.value = False
+    for entity_name, ids in entities.items():
+        metrics.LIVE_BATCH_SIZE.observe(entity_name, len(ids))
     _multiprocessed_import(entities.keys(), live=True, entities=entities)
     if FAILED.value:
-        raise Exception('Post to Solr failed. Requeueing all pending messages for retry.')
+        raise Exception('Post to Solr failed. Requeueing all pending '
+                        'messages for retry.')
 
 
-def _multiprocessed_import(entity_names, live=False, entities=None):
+def _multiprocessed_import(entity_names, live=False, entities=None,
+                           journal=None, connect=None, overwrite=True):
     """
     Does the real work to import all entities with ``entity_name`` in multiple
     processes via the :mod:`multiprocessing` module.
 
-    When ``live`` is True, it means, we are live indexing documents with ids in the
-    ``entities`` dict, otherwise it reindexes the entire table for entities in
-    ``entity_names``.
+    When ``live`` is True, it means, we are live indexing documents with ids
+    in the ``entities`` dict, otherwise it reindexes the entire table for
+    entities in ``entity_names``.
+
+    The batches of all entities are imported by a single pool of processes.
+    :func:`_next_entity_import` decides which entity the next batch is taken
+    from, so small entities don't leave most of the pool idle and the tail
+    of one entity overlaps with the others. The Solr processes of an entity
+    are only running while that entity has batches left, and only the
+    batches of ``max_active_entities`` entities in the ``[sir]`` section are
+    imported at the same time.
+
+    If a ``journal`` is given, batches it has already recorded as completed
+    are skipped and every batch whose documents have all been accepted by
+    Solr is recorded in it.
+
+    ``connect`` is called with the name of an entity's core and the number of
+    batches sent at the same time to get the connection its documents are
+    sent to. It defaults to :func:`sir.util.solr_connection`. ``overwrite``
+    is passed on to :func:`send_data_to_solr`.
+
+    If ``target_batch_seconds`` is set in the ``[sir]`` section, the size of
+    the batches of each entity is adapted by a
+    :class:`~sir.batchsizing.BatchSizer` while it's being imported. The
+    learned sizes are stored in ``batch_sizes_file`` and used as the initial
+    sizes of the next import.
 
     :param entity_names:
     :type entity_names: [str]
     :param bool live:
     :param entities:
     :type entities: dict(set(int))
+    :param sir.checkpoint.CheckpointJournal journal:
+    :param connect:
+    :param bool overwrite:
+    :rtype: set(str)
+    :returns: The names of the entities that couldn't be imported completely
+              because one of their batches or Solr processes failed
     """
+    if connect is None:
+        connect = util.solr_connection
     query_batch_size = config.CFG.getint("sir", "query_batch_size")
     try:
         importlimit = config.CFG.getint("sir", "importlimit")
@@ -101,94 +412,918 @@ def _multiprocessed_import(entity_names, live=False, entities=None):
         importlimit = 0
 
     max_processes = config.CFG.getint("sir", "import_threads")
+    try:
+        max_active_entities = config.CFG.getint("sir", "max_active_entities")
+    except NoOptionError:
+        max_active_entities = 2
     try:
         max_solr_processes = config.CFG.getint("sir", "solr_threads")
     except NoOptionError:
         max_solr_processes = max_processes
     solr_batch_size = config.CFG.getint("solr", "batch_size")
+    try:
+        max_inflight = config.CFG.getint("solr", "max_inflight")
+    except NoOptionError:
+        max_inflight = 1
+    try:
+        max_batch_bytes = config.CFG.getint("solr", "max_batch_bytes")
+    except NoOptionError:
+        max_batch_bytes = 0
+    try:
+        retries = config.CFG.getint("solr", "retries")
+    except NoOptionError:
+        retries = 2
+    try:
+        retry_wait = config.CFG.getint("solr", "retry_wait")
+    except NoOptionError:
+        retry_wait = 500
+    try:
+        dead_letters = _DeadLetterFile(config.CFG.get("solr",
+                                                      "dead_letter_file"))
+    except NoOptionError:
+        dead_letters = _DeadLetterFile(_DEFAULT_DEAD_LETTER_FILE)
+    commit_policy, commit_within = _commit_policy(live)
+    try:
+        queue_chunk_size = config.CFG.getint("sir", "queue_chunk_size")
+    except NoOptionError:
+        queue_chunk_size = solr_batch_size
+    # The number of documents of an entity that may be waiting to be sent to
+    # Solr. The Solr processes keep up to a batch each while collecting the
+    # next one, so anything smaller than that could block the import workers
+    # forever.
+    try:
+        document_budget = config.CFG.getint("sir", "document_budget")
+    except NoOptionError:
+        document_budget = 0
+    min_document_budget = (max_solr_processes * solr_batch_size +
+                           queue_chunk_size)
+    if document_budget and document_budget < min_document_budget:
+        logger.warning("Raising document_budget to %i so the Solr processes "
+                       "can fill their batches", min_document_budget)
+        document_budget = min_document_budget
+    # Entities whose bounds are estimated from the table statistics instead of
+    # being computed exactly
+    try:
+        approximate_bounds = set(name.strip() for name in
+                                 config.CFG.get("sir", "approximate_bounds").
+                                 split(",") if name.strip())
+    except NoOptionError:
+        approximate_bounds = set()
+    # Import workers are kept around for many batches so they can reuse their
+    # database connections, compiled queries and caches. They're replaced
+    # once they've used too much memory or imported too many rows.
+    try:
+        max_worker_rss = (config.CFG.getint("sir", "worker_max_rss") *
+                          1024 * 1024)
+    except NoOptionError:
+        max_worker_rss = 0
+    try:
+        max_worker_rows = config.CFG.getint("sir", "worker_max_rows")
+    except NoOptionError:
+        max_worker_rows = 0
+    try:
+        target_batch_seconds = config.CFG.getfloat("sir",
+                                                   "target_batch_seconds")
+    except NoOptionError:
+        target_batch_seconds = 0
+    try:
+        batch_memory_budget = (config.CFG.getint("sir", "batch_memory_budget") *
+                               1024 * 1024)
+    except NoOptionError:
+        batch_memory_budget = 0
+    try:
+        batch_sizes_file = config.CFG.get("sir", "batch_sizes_file")
+    except NoOptionError:
+        batch_sizes_file = _DEFAULT_BATCH_SIZES_FILE
+    # Live indexing only imports a few rows at a time, so there's nothing to
+    # adapt
+    adaptive = bool(target_batch_seconds) and not live
+    learned_sizes = load_batch_sizes(batch_sizes_file) if adaptive else {}
+
+    # The ids of the valid annotations are aggregated once for all workers,
+    # which are forked afterwards, instead of in every batch
+    valid_annotation_table = not live and "annotation" in entity_names
+    if valid_annotation_table:
+        queryext.create_valid_annotation_table(util.engine())
+
+    worker_function = partial(_import_worker,
+                              live=live,
+                              queue_chunk_size=queue_chunk_size,
+                              max_rss=max_worker_rss,
+                              max_rows=max_worker_rows)
+    if live:
+        live_queues, workers = _live_import_workers(max_processes,
+                                                    document_budget,
+                                                    worker_function)
+    else:
+        live_queues = workers = None
 
     db_session = util.db_session()
 
-    # Only allow one task per child to prevent the process consuming too much
-    # memory
-    pool = multiprocessing.Pool(max_processes, maxtasksperchild=1)
-    for e in entity_names:
-        logger.log(DEBUG if live else INFO, "Importing %s...", e)
-        index_function_args = []
-        # `entities` will be None when reindexing the entire DB
-        entity_id_list = list(entities.get(e, set())) if entities else None
-        manager = multiprocessing.Manager()
-        entity_data_queue = manager.Queue()
-
-        solr_connection = util.solr_connection(e)
-        process_function = partial(queue_to_solr,
-                                   entity_data_queue,
-                                   solr_batch_size,
-                                   solr_connection)
-        solr_processes = []
-        for i in range(max_solr_processes):
-            p = multiprocessing.Process(target=process_function, name="Solr-" + str(i))
-            p.start()
-            solr_processes.append(p)
-        indexer = partial(_index_entity_process_wrapper, live=live)
-        if live:
-            if entity_id_list:
-                for i in range(0, len(entity_id_list), query_batch_size):
-                    index_function_args.append((e,
-                                                entity_id_list[i:i + query_batch_size],
-                                                entity_data_queue))
-        else:
-            with util.db_session_ctx(db_session) as session:
-                for bounds in querying.iter_bounds(session, SCHEMA[e].model.id,
-                                                   query_batch_size, importlimit):
-                    args = (e, bounds, entity_data_queue)
-                    index_function_args.append(args)
+    # The bounds are generated lazily while the first batches are already
+    # being imported, so the session they're read from has to stay open
+    # until all batches have been dispatched.
+    with util.db_session_ctx(db_session) as session:
+        imports = []
+        for e in entity_names:
+            sizer = None
+            if live:
+                # `entities` will be None when reindexing the entire DB
+                entity_id_list = (list(entities.get(e, set())) if entities
+                                  else [])
+                tasks = _iter_id_batches(e, entity_id_list, query_batch_size)
+            else:
+                if e in approximate_bounds:
+                    bounds_function = querying.iter_approximate_bounds
+                else:
+                    bounds_function = querying.iter_bounds
+                if adaptive:
+                    sizer = BatchSizer(learned_sizes.get(e, query_batch_size),
+                                       target_batch_seconds,
+                                       batch_memory_budget,
+                                       query_batch_size * _MAX_SIZE_FACTOR,
+                                       query_batch_size // _MIN_SIZE_FACTOR)
+                bounds_iter = bounds_function(session, SCHEMA[e].model.id,
+                                              sizer or query_batch_size,
+                                              importlimit)
+                tasks = _iter_bounds_batches(e, bounds_iter, journal)
+            entity_import = _EntityImport(e, tasks, _estimate_batch_cost(e),
+                                          with_acks=journal is not None,
+                                          commit_policy=commit_policy,
+                                          commit_within=commit_within,
+                                          document_budget=document_budget,
+                                          queues=live_queues and
+                                          live_queues[e])
+            entity_import.sizer = sizer
+            imports.append(entity_import)
+
+        # Documents travel from the import workers to the Solr processes in
+        # chunks over a plain pipe, so there's no Manager process that has to
+        # proxy (and pickle) every single document. The pipes have to exist
+        # before the workers are started so they can inherit them.
+        if workers is None:
+            data_queues = dict((i.name, i.worker_queue) for i in imports)
+            workers = _ImportWorkers(max_processes,
+                                     partial(worker_function,
+                                             data_queues=data_queues))
+        # Keep a few more batches than there are workers in the task queue
+        # so no worker has to wait for the next one
+        max_pending = 2 * max_processes
+        # Maps the ids of the dispatched batches to their _EntityImport
+        pending = {}
+        task_ids = itertools.count()
 
         try:
-            results = pool.imap(indexer,
-                                index_function_args)
-            for r in results:
+            while True:
                 if not PROCESS_FLAG.value:
                     raise SIR_EXIT
+
+                while len(pending) < max_pending:
+                    entity_import = _next_entity_import(imports,
+                                                        max_active_entities)
+                    if entity_import is None:
+                        break
+                    try:
+                        args = next(entity_import.tasks)
+                    except StopIteration:
+                        entity_import.exhausted = True
+                        continue
+                    except Exception as exc:
+                        logger.error("Failed to import %s.", entity_import.name)
+                        logger.exception(exc)
+                        entity_import.failed = True
+                        continue
+                    if not entity_import.solr_processes:
+                        logger.log(DEBUG if live else INFO, "Importing %s...",
+                                   entity_import.name)
+                        entity_import.start_solr_processes(
+                            max_solr_processes,
+                            solr_batch_size,
+                            connect,
+                            max_inflight=max_inflight,
+                            max_batch_bytes=max_batch_bytes,
+                            retries=retries,
+                            retry_wait=retry_wait,
+                            dead_letters=dead_letters,
+                            overwrite=overwrite)
+                    entity_import.dispatched()
+                    task_id = next(task_ids)
+                    pending[task_id] = entity_import
+                    workers.submit(task_id, args)
+
+                if not pending and all(i.done for i in imports):
+                    break
+
+                for task_id, success, r in workers.results(timeout=0.1):
+                    entity_import = pending.pop(task_id)
+                    entity_import.in_flight -= 1
+                    if not success:
+                        logger.error("Failed to import %s: %s",
+                                     entity_import.name, r)
+                        entity_import.failed = True
+                        continue
+                    r, seconds, batch_memory = r
+                    if live:
+                        continue
+                    bounds, batch_count = r
+                    if entity_import.sizer is not None:
+                        entity_import.sizer.record(batch_count, seconds,
+                                                   batch_memory)
+                        logger.debug("Imported %i rows of %s in %.1fs, next "
+                                     "batch size is %i", batch_count,
+                                     entity_import.name, seconds,
+                                     entity_import.sizer.size)
+                    if journal is not None:
+                        entity_import.batch_sizes[bounds] = batch_count
+                        entity_import.record_checkpoints(journal)
+
+                for entity_import in imports:
+                    entity_import.finish_if_done(journal, live)
         except SIR_EXIT:
             logger.info('Killing all worker processes.')
-            entity_data_queue.put(STOP)
-            for p in solr_processes:
-                p.terminate()
-                p.join()
-            pool.terminate()
-            pool.join()
+            for entity_import in imports:
+                entity_import.terminate_solr_processes()
+            workers.terminate()
+            if live:
+                _discard_live_workers()
             raise
-        except Exception as exc:
-            logger.error("Failed to import %s.", e)
-            logger.exception(exc)
-            pool.terminate()
-        else:
-            logger.log(DEBUG if live else INFO, "Successfully imported %s!", e)
-        entity_data_queue.put(STOP)
-        for p in solr_processes:
+        except Exception:
+            for entity_import in imports:
+                entity_import.terminate_solr_processes()
+            workers.terminate()
+            if live:
+                _discard_live_workers()
+            raise
+        finally:
+            if adaptive:
+                save_batch_sizes(batch_sizes_file,
+                                 dict((i.name, i.sizer.size) for i in imports
+                                      if i.sizer is not None))
+            if valid_annotation_table:
+                queryext.drop_valid_annotation_table(util.engine())
+    failed = set(i.name for i in imports if i.failed)
+    if not live:
+        workers.close()
+    elif failed:
+        # Documents of the failed entities might still be in their queues
+        _discard_live_workers(close=True)
+    return failed
+
+
+def _live_import_workers(count, document_budget, worker_function):
+    """
+    Return the queues of :func:`_document_queues` for each entity and the
+    :class:`_ImportWorkers` of live indexing, which run ``worker_function``,
+    starting them on the first call.
+
+    :param int count:
+    :param int document_budget:
+    :param worker_function: :func:`_import_worker` with all arguments bound
+                            but the first two and ``data_queues``.
+    :rtype: (dict(str, tuple), _ImportWorkers)
+    """
+    global _LIVE_WORKERS
+    if _LIVE_WORKERS is None:
+        queues = dict((e, _document_queues(e, document_budget))
+                      for e in SCHEMA)
+        data_queues = dict((e, q[2]) for e, q in queues.items())
+        workers = _ImportWorkers(count, partial(worker_function,
+                                                data_queues=data_queues))
+        _LIVE_WORKERS = queues, workers
+    return _LIVE_WORKERS
+
+
+def _discard_live_workers(close=False):
+    """
+    Forget the workers of :func:`_live_import_workers`, so the next call
+    starts new ones. If ``close`` is true, they're stopped as well.
+
+    :param bool close:
+    """
+    global _LIVE_WORKERS
+    if _LIVE_WORKERS is not None:
+        if close:
+            _LIVE_WORKERS[1].close()
+        _LIVE_WORKERS = None
+
+
+atexit.register(_discard_live_workers, close=True)
+
+
+def _commit_policy(live):
+    """
+    Return the policy configured for committing the documents of an import to
+    Solr and the ``commitWithin`` time that goes with it.
+
+    The policy is read from ``live_commit`` or ``reindex_commit`` in the
+    ``[solr]`` section, depending on ``live``, and is one of
+
+    ``none``
+        Don't commit at all and rely on Solr's autocommit settings.
+    ``within``
+        Ask Solr to commit the documents of each batch within
+        ``commit_within`` milliseconds.
+    ``soft`` and ``hard``
+        Send a single soft or hard commit once all documents of an entity
+        have been sent.
+
+    It defaults to ``hard``.
+
+    :param bool live:
+    :rtype: (str, int)
+    :raises ValueError: if the configured policy is unknown
+    """
+    option = "live_commit" if live else "reindex_commit"
+    try:
+        policy = config.CFG.get("solr", option)
+    except NoOptionError:
+        policy = "hard"
+    if policy not in COMMIT_POLICIES:
+        raise ValueError("Unknown commit policy %r for %s, expected one of %s" %
+                         (policy, option, ", ".join(COMMIT_POLICIES)))
+    commit_within = None
+    if policy == "within":
+        try:
+            commit_within = config.CFG.getint("solr", "commit_within")
+        except NoOptionError:
+            commit_within = 1000
+    return policy, commit_within
+
+
+def _iter_id_batches(entity_name, ids, batch_size):
+    """
+    Yield the arguments for :func:`_index_entity_process_wrapper` to live
+    index ``ids`` of ``entity_name`` in batches of ``batch_size``.
+    """
+    for i in range(0, len(ids), batch_size):
+        yield (entity_name, ids[i:i + batch_size])
+
+
+def _iter_bounds_batches(entity_name, bounds_iter, journal=None):
+    """
+    Yield the arguments for :func:`_index_entity_process_wrapper` to import
+    the batches of ``entity_name`` in ``bounds_iter`` that ``journal`` does
+    not already contain.
+    """
+    for bounds in bounds_iter:
+        if journal is None or not journal.is_completed(entity_name, bounds):
+            yield (entity_name, bounds)
+
+
+def _estimate_batch_cost(entity_name):
+    """
+    Estimate how expensive importing a batch of ``entity_name`` is compared
+    to other entities by counting the relationships that have to be loaded
+    for each row.
+
+    :param str entity_name:
+    :rtype: int
+    """
+    entity = SCHEMA[entity_name]
+    paths = [path for field in entity.fields for path in field.paths]
+    if config.CFG.getboolean("sir", "wscompat") and entity.extrapaths:
+        paths.extend(entity.extrapaths)
+    # The last element of each path is a column
+    relationships = set(path.rsplit(".", 1)[0] for path in paths if "." in path)
+    return 1 + len(set(unique_split_paths(relationships)))
+
+
+def _next_entity_import(imports, max_active=0):
+    """
+    Return the :class:`_EntityImport` in ``imports`` the next batch should be
+    taken from or ``None`` if there are no batches left that can be taken
+    right now.
+
+    This uses stride scheduling: each time an entity gets a batch, its pass
+    value increases by the inverse of its estimated cost, and the entity with
+    the lowest pass value is picked. Entities therefore get a share of the
+    pool that's proportional to the cost of their batches, which makes the
+    expensive ones (that take longest overall) progress fastest while still
+    interleaving the cheap ones.
+
+    Each entity that has been started keeps its Solr processes until all of
+    its batches are done. If ``max_active`` is set, no other entity is
+    started while that many are, so the number of Solr processes is bounded
+    by ``max_active`` times the number per entity.
+
+    :param [_EntityImport] imports:
+    :param int max_active:
+    :rtype: _EntityImport
+    """
+    candidates = [i for i in imports if not (i.exhausted or i.failed)]
+    if max_active:
+        active = [i for i in imports if i.solr_processes and not i.done]
+        if len(active) >= max_active:
+            candidates = [i for i in candidates if i in active]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda i: i.pass_value)
+
+
+def _document_queues(entity_name, document_budget=0):
+    """
+    Return the queue the Solr processes of an entity read its documents from,
+    the :class:`_DocumentBudget` of the entity or ``None`` if there's no
+    ``document_budget``, and the queue the import workers put the documents
+    into.
+
+    :param str entity_name:
+    :param int document_budget:
+    :rtype: (multiprocessing.queues.SimpleQueue, _DocumentBudget, object)
+    """
+    data_queue = SimpleQueue()
+    if not document_budget:
+        return data_queue, None, data_queue
+    budget = _DocumentBudget(document_budget, entity_name)
+    return data_queue, budget, _BudgetedQueue(data_queue, budget)
+
+
+class _EntityImport(object):
+    """
+    Keeps track of the import of a single entity in
+    :func:`_multiprocessed_import`.
+    """
+
+    def __init__(self, name, tasks, cost, with_acks=False,
+                 commit_policy="hard", commit_within=None, document_budget=0,
+                 queues=None):
+        """
+        :param str name: The name of the entity.
+        :param tasks: An iterator over the arguments for
+                      :func:`_index_entity_process_wrapper`.
+        :param int cost: The estimated cost of a batch of this entity.
+        :param bool with_acks: Whether the Solr processes should report the
+                               documents they sent.
+        :param str commit_policy: See :func:`_commit_policy`.
+        :param int commit_within: See :func:`_commit_policy`.
+        :param int document_budget: The number of documents that may be
+                                    waiting to be sent to Solr or 0 if there
+                                    is no limit.
+        :param queues: The queues returned by :func:`_document_queues` to
+                       use instead of new ones.
+        """
+        self.name = name
+        self.tasks = tasks
+        self.cost = cost
+        #: The :class:`~sir.batchsizing.BatchSizer` of the batches, if their
+        #: size is adapted
+        self.sizer = None
+        self.pass_value = 0.0
+        #: :attr:`worker_queue` is the queue the import workers put their
+        #: documents into
+        self.data_queue, self.budget, self.worker_queue = (
+            queues or _document_queues(name, document_budget))
+        # The Solr processes report the number of documents of each batch they
+        # sent successfully through this queue
+        self.ack_queue = multiprocessing.Queue() if with_acks else None
+        # Maps the bounds of all finished batches to the number of documents
+        # in them
+        self.batch_sizes = {}
+        self.acked = Counter()
+        self.commit_policy = commit_policy
+        self.commit_within = commit_within
+        self.solr_connection = None
+        self.solr_processes = []
+        self.in_flight = 0
+        self.exhausted = False
+        self.failed = False
+        self.stopping = False
+        self.done = False
+
+    def dispatched(self):
+        self.in_flight += 1
+        self.pass_value += 1.0 / self.cost
+
+    def start_solr_processes(self, count, batch_size, connect, max_inflight=1,
+                             **send_options):
+        """
+        Start ``count`` processes running :func:`queue_to_solr` with the
+        connection returned by ``connect``. ``send_options`` are passed on to
+        it.
+        """
+        self.solr_connection = connect(self.name, max_inflight)
+        process_function = partial(queue_to_solr,
+                                   self.data_queue,
+                                   batch_size,
+                                   self.solr_connection,
+                                   entity_name=self.name,
+                                   ack_queue=self.ack_queue,
+                                   max_inflight=max_inflight,
+                                   commit_within=self.commit_within,
+                                   budget=self.budget,
+                                   **send_options)
+        for i in range(count):
+            p = multiprocessing.Process(target=process_function,
+                                        name="Solr-%s-%i" % (self.name, i))
+            p.start()
+            self.solr_processes.append(p)
+
+    def finish_if_done(self, journal, live):
+        """
+        Stop the Solr processes once all batches have been imported. Once
+        they've exited, commit the documents according to the commit policy
+        and record the last checkpoints.
+        """
+        if self.done or self.in_flight or not (self.exhausted or self.failed):
+            return
+        if not self.stopping:
+            self.stopping = True
+            if self.solr_processes:
+                self.data_queue.put(STOP)
+        if any(p.is_alive() for p in self.solr_processes):
+            return
+        for p in self.solr_processes:
+            p.join()
+        # Each Solr process puts the STOP it read back for the others, so one
+        # is left over, which would stop the next ones reading from a queue
+        # kept by live indexing right away
+        while not self.data_queue.empty():
+            self.data_queue.get()
+        for p in self.solr_processes:
+            if p.exitcode:
+                logger.error("A Solr process of %s exited with code %i",
+                             self.name, p.exitcode)
+                self.failed = True
+        if self.solr_processes and PROCESS_FLAG.value:
+            self.commit()
+        # Sinks that count the documents report them regardless of the commit
+        # policy
+        log_totals = getattr(self.solr_connection, "log_totals", None)
+        if self.solr_processes and log_totals is not None:
+            log_totals()
+        if journal is not None:
+            self.record_checkpoints(journal)
+        if self.solr_processes and not self.failed:
+            logger.log(DEBUG if live else INFO, "Successfully imported %s!",
+                       self.name)
+        if self.budget is not None and self.solr_processes:
+            logger.log(DEBUG if live else INFO,
+                       "Up to %i documents of %s were waiting for Solr, the "
+                       "import workers were blocked for %.1fs",
+                       self.budget.peak.value, self.name,
+                       self.budget.blocked_seconds.value)
+        self.done = True
+
+    def commit(self):
+        """
+        Send a soft or hard commit to the core of the entity if the commit
+        policy asks for one.
+        """
+        if self.commit_policy not in ("soft", "hard"):
+            return
+        logger.debug("Sending a %s commit to Solr for %s", self.commit_policy,
+                     self.name)
+        try:
+            self.solr_connection.commit(softCommit=self.commit_policy == "soft")
+        except SolrError:
+            logger.error("Failed to commit %s", self.name)
+            get_sentry().captureException()
+            FAILED.value = True
+
+    def terminate_solr_processes(self):
+        for p in self.solr_processes:
+            p.terminate()
             p.join()
-    pool.close()
-    pool.join()
 
+    def record_checkpoints(self, journal):
+        """
+        Add the numbers of sent documents per batch that are waiting in
+        :attr:`ack_queue` to :attr:`acked` and record all batches whose
+        documents have all been sent in ``journal``.
 
-def _index_entity_process_wrapper(args, live=False):
+        :param sir.checkpoint.CheckpointJournal journal:
+        """
+        while True:
+            try:
+                self.acked.update(self.ack_queue.get_nowait())
+            except Empty:
+                break
+        for bounds, count in self.batch_sizes.items():
+            if self.acked[bounds] >= count:
+                journal.record(self.name, bounds)
+                del self.batch_sizes[bounds]
+                del self.acked[bounds]
+
+
+class _DocumentBudget(object):
+    """
+    Limits the number of documents that have been put into the queue of an
+    entity but haven't been sent to Solr yet.
+
+    The import workers :meth:`acquire` room for their documents before
+    putting them into the queue and block while there is none. The Solr
+    processes :meth:`release` it once they've sent a batch. The state is kept
+    in shared memory, so it can be used by all of them.
+
+    The peak number of documents and the time spent waiting are recorded in
+    :mod:`sir.metrics` under ``entity_name``.
     """
-    Calls :func:`sir.indexing.index_entity` with ``args`` unpacked.
 
+    def __init__(self, max_documents, entity_name=None):
+        """
+        :param int max_documents:
+        :param str entity_name:
+        """
+        self.max_documents = max_documents
+        self.entity_name = entity_name
+        self.condition = multiprocessing.Condition()
+        #: The number of documents currently waiting to be sent
+        self.documents = multiprocessing.Value(c_long, 0, lock=False)
+        #: The largest value :attr:`documents` has had
+        self.peak = multiprocessing.Value(c_long, 0, lock=False)
+        #: The time the import workers have spent waiting in :meth:`acquire`
+        self.blocked_seconds = multiprocessing.Value(c_double, 0, lock=False)
+
+    def _exhausted(self, count):
+        # An empty budget always admits documents, so chunks larger than the
+        # budget can't block forever
+        return (self.documents.value > 0 and
+                self.documents.value + count > self.max_documents)
+
+    def acquire(self, count):
+        """
+        Wait until ``count`` documents fit into the budget and add them to it.
+
+        :param int count:
+        :raises sir.util.SIR_EXIT: if :data:`PROCESS_FLAG` is turned off while
+                                   waiting
+        """
+        with self.condition:
+            if self._exhausted(count):
+                start = time.time()
+                while self._exhausted(count):
+                    if not PROCESS_FLAG.value:
+                        raise SIR_EXIT
+                    self.condition.wait(0.5)
+                blocked_seconds = time.time() - start
+                self.blocked_seconds.value += blocked_seconds
+                metrics.BUDGET_BLOCKED_SECONDS.inc(self.entity_name,
+                                                   blocked_seconds)
+            self.documents.value += count
+            if self.documents.value > self.peak.value:
+                metrics.QUEUE_PEAK_DEPTH.add(self.entity_name,
+                                             self.documents.value -
+                                             self.peak.value)
+                self.peak.value = self.documents.value
+
+    def release(self, count):
+        """
+        Remove ``count`` documents from the budget.
+
+        :param int count:
+        """
+        with self.condition:
+            self.documents.value -= count
+            self.condition.notify_all()
+
+
+class _BudgetedQueue(object):
+    """
+    Wraps the queue of an entity so that putting ``(key, list of dict)``
+    tuples into it first acquires room for the documents from a
+    :class:`_DocumentBudget`.
+    """
+
+    def __init__(self, queue, budget):
+        self.queue = queue
+        self.budget = budget
+
+    def put(self, item):
+        self.budget.acquire(len(item[1]))
+        self.queue.put(item)
+
+
+class _ImportWorkers(object):
+    """
+    A set of long-lived processes running :func:`_import_worker`. Processes
+    that have exited, either because they recycled themselves or because they
+    died, are replaced by new ones.
+    """
+
+    def __init__(self, count, worker_function):
+        """
+        :param int count: The number of processes.
+        :param worker_function: :func:`_import_worker` with all but its first
+                                two arguments bound.
+        """
+        self.count = count
+        self.task_queue = SimpleQueue()
+        # Results are sent synchronously so they can't get lost if a worker
+        # dies right after sending them
+        self.result_reader, result_writer = multiprocessing.Pipe(duplex=False)
+        self.target = partial(worker_function, self.task_queue,
+                              result_writer, multiprocessing.Lock())
+        self.processes = []
+        # Maps the pids of the processes to the id of the task they're working
+        # on
+        self.running = {}
+        self._spawned = 0
+        self._lost = []
+        self._maintain()
+
+    def _maintain(self):
+        for p in self.processes[:]:
+            if p.is_alive():
+                continue
+            p.join()
+            self.processes.remove(p)
+            # The results it sent before exiting are already in the queue
+            self._read_results()
+            task_id = self.running.pop(p.pid, None)
+            if task_id is not None:
+                self._lost.append((task_id, False,
+                                   "%s exited with %s" % (p.name, p.exitcode)))
+        while len(self.processes) < self.count:
+            p = multiprocessing.Process(target=self.target,
+                                        name="Import-%i" % self._spawned)
+            self._spawned += 1
+            p.start()
+            self.processes.append(p)
+
+    def _read_results(self, timeout=0):
+        results = []
+        while self.result_reader.poll(timeout):
+            timeout = 0
+            pid, task_id, success, value = self.result_reader.recv()
+            if success is None:
+                self.running[pid] = task_id
+            else:
+                self.running.pop(pid, None)
+                results.append((task_id, success, value))
+        self._lost.extend(results)
+
+    def submit(self, task_id, args):
+        self.task_queue.put((task_id, args))
+
+    def results(self, timeout):
+        """
+        Return ``(task id, success, result or error)`` tuples for all tasks
+        that have finished since the last call, waiting up to ``timeout``
+        seconds for the first one.
+        """
+        self._read_results(timeout)
+        self._maintain()
+        results, self._lost = self._lost, []
+        return results
+
+    def close(self):
+        for p in self.processes:
+            self.task_queue.put(STOP)
+        for p in self.processes:
+            p.join()
+
+    def terminate(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+
+
+def _import_worker(task_queue, result_connection, result_lock, data_queues,
+                   live=False, queue_chunk_size=1, max_rss=0, max_rows=0):
+    """
+    Read ``(task id, args)`` tuples from ``task_queue`` and call
+    :func:`_index_entity_process_wrapper` with ``args`` until :data:`STOP` is
+    read.
+
+    Before and after each task, a ``(pid, task id, success, result)`` tuple is
+    sent through ``result_connection`` while holding ``result_lock``.
+    ``success`` is ``None`` for the message sent before the task, and
+    ``result`` is the error message if the task failed. Otherwise, it's a
+    ``(return value, seconds, memory)`` tuple containing the time the task
+    took and how many bytes the peak resident set size of the process was
+    above the one before the task (see :func:`_reset_peak_rss`).
+
+    The process exits after a task once its resident set size exceeds
+    ``max_rss`` bytes or it has imported more than ``max_rows`` rows, so it
+    can be replaced by a fresh one.
+
+    :param multiprocessing.queues.SimpleQueue task_queue:
+    :param multiprocessing.Connection result_connection:
+    :param multiprocessing.Lock result_lock:
+    :param data_queues: See :func:`_init_index_worker`
     :param bool live:
+    :param int queue_chunk_size:
+    :param int max_rss:
+    :param int max_rows:
+    """
+    def report(*message):
+        with result_lock:
+            result_connection.send(message)
+
+    _init_index_worker(data_queues)
+    pid = os.getpid()
+    rows = 0
+    while PROCESS_FLAG.value:
+        task = task_queue.get()
+        if task is STOP:
+            break
+        task_id, args = task
+        report(pid, task_id, None, None)
+        start = time.time()
+        start_rss = _current_rss()
+        peak_reset = _reset_peak_rss()
+        try:
+            result = _index_entity_process_wrapper(args, live, queue_chunk_size)
+        except Exception as exc:
+            report(pid, task_id, False, repr(exc))
+            continue
+        rss = _current_rss()
+        # Once the allocator holds on to freed memory, the RSS hardly grows
+        # even for large batches, so the peak of the batch is used if it can
+        # be measured
+        peak_rss = _peak_rss() if peak_reset else rss
+        report(pid, task_id, True, (result, time.time() - start,
+                                    max(peak_rss - start_rss, 0)))
+        rows += result if live else result[1]
+        if (max_rows and rows >= max_rows) or (max_rss and rss >= max_rss):
+            logger.debug("Recycling worker after %i rows with %i bytes RSS",
+                         rows, rss)
+            break
 
-    :rtype: None or an Exception
+
+def _current_rss():
+    """
+    Return the resident set size of the current process in bytes.
+
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # The peak RSS is the best we can do without /proc. It's in kilobytes
+        # on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process reported by
+    :func:`_peak_rss` to the current one, which is only possible on Linux.
+
+    :rtype: bool
+    :returns: Whether the peak could be reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except IOError:
+        return False
+    return True
+
+
+def _peak_rss():
+    """
+    Return the peak resident set size of the current process in bytes since
+    the last call of :func:`_reset_peak_rss`.
+
+    :rtype: int
+    """
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                # In kilobytes
+                return int(line.split()[1]) * 1024
+    return _current_rss()
+
+
+def _init_index_worker(data_queues):
+    """
+    Initializes an import worker by storing ``data_queues``, which maps entity
+    names to the queues the documents of those entities will be put into.
+
+    :param data_queues:
+    :type data_queues: dict(str, multiprocessing.queues.SimpleQueue)
+    """
+    global _DATA_QUEUES
+    _DATA_QUEUES = data_queues
+
+
+def _index_entity_process_wrapper(args, live=False, queue_chunk_size=1):
+    """
+    Calls :func:`sir.indexing.index_entity` with ``args`` unpacked and the
+    queue of the entity set up by :func:`_init_index_worker`.
+
+    :param bool live:
+    :param int queue_chunk_size:
+
+    :rtype: The number of imported rows, paired with the bounds when not
+            live indexing
     """
 
-    # Restoring the default SIGTERM handler so the pool can actually terminate
-    # its workers
+    # Restoring the default SIGTERM handler so the workers can actually be
+    # terminated
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
     try:
+        entity_name, bounds_or_ids = args
+        data_queue = _DATA_QUEUES[entity_name]
         if live:
-            return live_index_entity(*args)
-        return index_entity(*args)
+            return live_index_entity(entity_name, bounds_or_ids, data_queue,
+                                     queue_chunk_size)
+        return (bounds_or_ids,
+                index_entity(entity_name, bounds_or_ids, data_queue,
+                             queue_chunk_size))
     except Exception as exc:
         logger.error("Failed to import %s with id in bounds %s",
                      args[0],
@@ -197,16 +1332,20 @@ def _index_entity_process_wrapper(args, live=False):
         raise
 
 
-def index_entity(entity_name, bounds, data_queue):
+@profiling.profiled
+def index_entity(entity_name, bounds, data_queue, queue_chunk_size=1):
     """
     Retrieve rows for a single entity type identified by ``entity_name``,
     convert them to a dict with :func:`sir.indexing.query_result_to_dict` and
-    put the dicts into ``queue``.
+    put lists of up to ``queue_chunk_size`` dicts into ``queue``, tagged
+    with ``bounds``.
 
     :param str entity_name:
     :param bounds:
     :type bounds: (int, int)
     :param Queue.Queue data_queue:
+    :param int queue_chunk_size:
+    :rtype: int
     """
     model = SCHEMA[entity_name].model
     logger.debug("Importing %s %s", model, bounds)
@@ -215,51 +1354,114 @@ def index_entity(entity_name, bounds, data_queue):
         condition = and_(model.id >= lower_bound, model.id < upper_bound)
     else:
         condition = model.id >= lower_bound
-    _query_database(entity_name, condition, data_queue)
+    return _query_database(entity_name, condition, data_queue,
+                           queue_chunk_size, key=bounds)
 
 
-def live_index_entity(entity_name, ids, data_queue):
+@profiling.profiled
+def live_index_entity(entity_name, ids, data_queue, queue_chunk_size=1):
     """
     Retrieve rows for a single entity type identified by ``entity_name``,
     convert them to a dict with :func:`sir.indexing.query_result_to_dict` and
-    put the dicts into ``queue``.
+    put lists of up to ``queue_chunk_size`` dicts into ``queue``.
 
     :param str entity_name:
     :param [int] ids:
     :param Queue.Queue data_queue:
+    :param int queue_chunk_size:
+    :rtype: int
     """
     if not PROCESS_FLAG.value:
-        return
+        return 0
     condition = and_(SCHEMA[entity_name].model.id.in_(ids))
     logger.debug("Importing %s new rows for entity %s", len(ids), entity_name)
-    _query_database(entity_name, condition, data_queue)
+    return _query_database(entity_name, condition, data_queue, queue_chunk_size)
 
 
-def _query_database(entity_name, condition, data_queue):
+def _query_database(entity_name, condition, data_queue, queue_chunk_size=1,
+                    key=None):
     """
     Retrieve rows for a single entity type identified by ``entity_name``,
     convert them to a dict with :func:`sir.indexing.query_result_to_dict` and
-    put the dicts into ``data_queue``.
+    put them into ``data_queue`` in lists of up to ``queue_chunk_size`` dicts.
+    Sending lists instead of single dicts means the queue only has to pickle
+    and transfer one object per chunk. Each list is put into the queue as a
+    ``(key, list)`` tuple, so the Solr processes can tell which batch the
+    documents belong to.
 
     Rows that contain unsupported control character are just skipped
     with log info. It is not considered as an indexing error, since
     it should not be in the MusicBrainz database to start with.
 
+    If ``stream_chunk_size`` is set in the ``[sir]`` section, the rows are
+    retrieved with :func:`_iter_rows_streamed` instead of all at once. The
+    values of the aggregates of the ORM objects are loaded for all of them at
+    once by :meth:`~sir.schema.searchentities.SearchEntity.load_aggregates`.
+
+    If ``extraction`` in the ``[sir]`` section is ``core`` or ``json``, the
+    values of the fields are retrieved by the
+    :attr:`~sir.schema.searchentities.SearchEntity.core_extractor` or the
+    :attr:`~sir.schema.searchentities.SearchEntity.json_extractor` of the
+    entity without loading ORM objects, unless the entity has no such
+    extractor or ``wscompat`` is enabled. The ``_store`` field of
+    ``wscompat`` is built from ORM objects, so in that case the whole entity
+    is retrieved through the ORM, including the values of the other fields.
+
+    The rows and documents are counted in :mod:`sir.metrics`.
+
     :param str entity_name:
     :param sqlalchemy.sql.expression.BinaryExpression condition:
     :param Queue.Queue data_queue:
+    :param int queue_chunk_size:
+    :param key:
+    :rtype: int
+    :returns: The number of documents put into ``data_queue``
     """
     search_entity = SCHEMA[entity_name]
     model = search_entity.model
     row_converter = search_entity.query_result_to_dict
+    try:
+        stream_chunk_size = config.CFG.getint("sir", "stream_chunk_size")
+    except NoOptionError:
+        stream_chunk_size = 0
+    extractor = None
+    engine = _extraction_engine()
+    if engine != "orm" and not config.CFG.getboolean("sir", "wscompat"):
+        extractor = getattr(search_entity, "%s_extractor" % engine)
+    start = time.time()
+
+    def put(chunk, rows):
+        data_queue.put((key, chunk))
+        metrics.DB_ROWS.inc(entity_name, rows)
+        metrics.DOCUMENTS_CONVERTED.inc(entity_name, len(chunk))
+        metrics.QUEUE_DEPTH.add(entity_name, len(chunk))
+
     with util.db_session_ctx(util.db_session()) as session:
-        query = search_entity.query.filter(condition).with_session(session)
+        if extractor is not None:
+            rows = extractor.iter_rows(session, condition, stream_chunk_size)
+
+            def extracted_row_to_dict(row):
+                return search_entity.field_values_to_dict(row.values)
+            row_converter = extracted_row_to_dict
+        elif stream_chunk_size:
+            rows = _iter_rows_streamed(search_entity, condition, session,
+                                       stream_chunk_size)
+        else:
+            rows = (search_entity.query.filter(condition).
+                    with_session(session).
+                    all())
+            search_entity.load_aggregates(session, rows)
         total_records = 0
-        for row in query:
+        # The number of rows retrieved since the last chunk was put into the
+        # queue, including the skipped ones
+        chunk_rows = 0
+        chunk = []
+        for row in rows:
             if not PROCESS_FLAG.value:
-                return
+                return total_records
+            chunk_rows += 1
             try:
-                data_queue.put(row_converter(row))
+                chunk.append(row_converter(row))
             except ValueError:
                 logger.info("Skipping %s with id %s. "
                             "The most likely cause of this is an "
@@ -275,58 +1477,506 @@ def _query_database(entity_name, condition, data_queue):
                 raise
             else:
                 total_records += 1
+                if len(chunk) >= queue_chunk_size:
+                    put(chunk, chunk_rows)
+                    chunk = []
+                    chunk_rows = 0
+        if chunk:
+            put(chunk, chunk_rows)
+        elif chunk_rows:
+            metrics.DB_ROWS.inc(entity_name, chunk_rows)
+        metrics.CONVERSION_SECONDS.observe(entity_name, time.time() - start)
         logger.debug("Retrieved %s records in %s", total_records, model)
+        return total_records
+
+
+def _extraction_engine():
+    """
+    Return the ``extraction`` setting in the ``[sir]`` section, one of
+    :data:`EXTRACTION_ENGINES`, which defaults to ``orm``.
+
+    :rtype: str
+    :raises ValueError: if the setting is unknown
+    """
+    try:
+        engine = config.CFG.get("sir", "extraction")
+    except NoOptionError:
+        return "orm"
+    if engine not in EXTRACTION_ENGINES:
+        raise ValueError("Unknown extraction engine %r, expected one of %s" %
+                         (engine, ", ".join(EXTRACTION_ENGINES)))
+    return engine
 
 
-def queue_to_solr(queue, batch_size, solr_connection):
+def _iter_rows_streamed(search_entity, condition, session, chunk_size):
     """
-    Read :class:`dict` objects from ``queue`` and send them to the Solr server
-    behind ``solr_connection`` in batches of ``batch_size``.
+    Yield the rows of ``search_entity`` matching ``condition`` while only
+    keeping ``chunk_size`` of them in memory.
+
+    The ids of the matching rows are read through a server-side cursor. For
+    each chunk of ``chunk_size`` ids, the query of ``search_entity`` is run
+    to load the rows together with all their related objects and
+    aggregates. Once a chunk has been consumed, its objects are removed from
+    ``session``.
+
+    :param sir.schema.searchentities.SearchEntity search_entity:
+    :param sqlalchemy.sql.expression.BinaryExpression condition:
+    :param sqlalchemy.orm.session.Session session:
+    :param int chunk_size:
+    """
+    model = search_entity.model
+    ids = (session.query(model.id).
+           filter(condition).
+           order_by(model.id).
+           yield_per(chunk_size))
+    ids = (row[0] for row in ids)
+    while True:
+        chunk_ids = list(itertools.islice(ids, chunk_size))
+        if not chunk_ids:
+            break
+        rows = (search_entity.query.
+                filter(model.id.in_(chunk_ids)).
+                with_session(session).
+                all())
+        search_entity.load_aggregates(session, rows)
+        for row in rows:
+            yield row
+        session.expunge_all()
+
+
+@profiling.profiled
+def queue_to_solr(queue, batch_size, solr_connection, ack_queue=None,
+                  max_inflight=1, commit_within=None, max_batch_bytes=0,
+                  budget=None, retries=0, retry_wait=0, dead_letters=None,
+                  overwrite=True, entity_name=None):
+    """
+    Read ``(key, list of dict)`` tuples from ``queue`` and send the dicts to
+    the Solr server behind ``solr_connection`` in batches of ``batch_size``.
+    If ``max_batch_bytes`` is set, a batch is also sent once adding the next
+    document would make its estimated size (see
+    :func:`_estimate_document_size`) exceed that many bytes. Up to
+    ``max_inflight`` batches are sent at the same time by a
+    :class:`_SolrSender`.
+
+    The documents are not committed, unless ``commit_within`` is set, in
+    which case Solr commits them within that many milliseconds. Other
+    commits are sent by :func:`_multiprocessed_import` once all processes of
+    an entity are done.
+
+    If ``ack_queue`` is not ``None``, a :class:`collections.Counter` of the
+    keys of the documents in each batch that has been sent successfully is put
+    into it.
+
+    If ``budget`` is not ``None``, the documents of each batch are released
+    from it once the batch has been sent.
+
+    ``retries``, ``retry_wait``, ``dead_letters`` and ``overwrite`` are passed
+    on to :func:`send_data_to_solr`.
+
+    The documents and batches are counted in :mod:`sir.metrics` under
+    ``entity_name``.
 
     :param multiprocessing.Queue queue:
     :param int batch_size:
     :param solr.Solr solr_connection:
+    :param multiprocessing.Queue ack_queue:
+    :param int max_inflight:
+    :param int commit_within:
+    :param int max_batch_bytes:
+    :param _DocumentBudget budget:
+    :param int retries:
+    :param int retry_wait:
+    :param _DeadLetterFile dead_letters:
+    :param bool overwrite:
+    :param str entity_name:
     """
 
     # Restoring the default SIGTERM handler so the Solr process can actually
     # be terminated on calling terminate.
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-    data = []
-    count = 0
+    sender = _SolrSender(solr_connection, max_inflight, ack_queue,
+                         commit_within, budget, retries, retry_wait,
+                         dead_letters, overwrite, entity_name)
+    stats = {"documents": 0, "batches": 0, "bytes": 0, "largest": 0}
+
+    def send(batch):
+        sender.send(batch.docs, batch.keys)
+        metrics.SOLR_ESTIMATED_BYTES.inc(entity_name, batch.size)
+        stats["documents"] += len(batch.docs)
+        stats["batches"] += 1
+        stats["bytes"] += batch.size
+        stats["largest"] = max(stats["largest"], batch.size)
+        logger.debug("Sent %d new documents (%d bytes). Total: %d",
+                     len(batch.docs), batch.size, stats["documents"])
+        return _SolrBatch()
+
+    batch = _SolrBatch()
     while True:
         item = queue.get()
         if not PROCESS_FLAG.value or item is STOP:
             break
-        data.append(item)
-        if len(data) >= batch_size:
-            send_data_to_solr(solr_connection, data)
-            count += len(data)
-            logger.debug("Sent %d new documents. Total: %d", len(data), count)
-            data = []
+        key, docs = item
+        metrics.QUEUE_DEPTH.add(entity_name, -len(docs))
+        for doc in docs:
+            size = _estimate_document_size(doc)
+            if (max_batch_bytes and batch.docs and
+                    batch.size + size > max_batch_bytes):
+                batch = send(batch)
+            batch.add(key, doc, size)
+            if len(batch.docs) >= batch_size:
+                batch = send(batch)
 
     queue.put(STOP)
     if not PROCESS_FLAG.value:
+        sender.close()
         return
     logger.debug("%s: Sending remaining data & stopping", solr_connection)
-    send_data_to_solr(solr_connection, data)
-    logger.debug("Committing changes to Solr")
-    solr_connection.commit()
+    send(batch)
+    sender.close()
+    if stats["batches"]:
+        logger.debug("Sent %d documents in %d batches of %d bytes on average, "
+                     "the largest had %d bytes", stats["documents"],
+                     stats["batches"], stats["bytes"] / stats["batches"],
+                     stats["largest"])
+
+
+class _SolrBatch(object):
+    """
+    The documents that will be sent to Solr in one request by
+    :func:`queue_to_solr`.
+    """
+
+    def __init__(self):
+        self.docs = []
+        #: The key of each document in :attr:`docs`
+        self.keys = []
+        #: The estimated size of the documents in bytes
+        self.size = 0
+
+    def add(self, key, doc, size):
+        self.docs.append(doc)
+        self.keys.append(key)
+        self.size += size
+
+
+#: The number of bytes each field value adds to an update request besides
+#: the name of the field and the value itself
+_FIELD_OVERHEAD = len('<field name=""></field>')
+
+
+def _estimate_document_size(doc):
+    """
+    Estimate how many bytes ``doc`` adds to an update request to Solr by
+    adding up the UTF-8 encoded lengths of its field names and values. The
+    escaping of XML characters isn't taken into account.
+
+    >>> _estimate_document_size({"id": "1", "name": ["a", "bc"]})
+    94
+    >>> _estimate_document_size({"id": "1", "name": [u"\\xe4"]})
+    66
+
+    :param dict doc:
+    :rtype: int
+    """
+    size = len("<doc></doc>")
+    for name, value in doc.items():
+        if not isinstance(value, (list, tuple, set)):
+            value = (value,)
+        for v in value:
+            if isinstance(v, unicode):
+                v = v.encode("utf-8")
+            elif not isinstance(v, str):
+                v = str(v)
+            size += _FIELD_OVERHEAD + len(name) + len(v)
+    return size
+
+
+class _SolrSender(object):
+    """
+    Sends batches of documents to Solr with :func:`send_data_to_solr` while
+    the caller goes on to collect the next ones.
+
+    Up to ``max_inflight`` batches are sent at the same time by a pool of
+    threads sharing ``solr_connection``, whose connection pool keeps one
+    HTTP connection per thread alive (see :func:`sir.util.solr_connection`).
+    :meth:`send` blocks while that many batches are being sent. With a
+    ``max_inflight`` of 1, batches are sent synchronously.
+
+    Unexpected exceptions raised while sending a batch in a thread are raised
+    again by the next call of :meth:`send` or :meth:`close`.
+
+    The time it takes to send each batch and the numbers of sent and rejected
+    documents are recorded in :mod:`sir.metrics` under ``entity_name``.
+    """
+
+    def __init__(self, solr_connection, max_inflight=1, ack_queue=None,
+                 commit_within=None, budget=None, retries=0, retry_wait=0,
+                 dead_letters=None, overwrite=True, entity_name=None):
+        """
+        :param solr.Solr solr_connection:
+        :param int max_inflight:
+        :param multiprocessing.Queue ack_queue: See :func:`queue_to_solr`
+        :param int commit_within: See :func:`queue_to_solr`
+        :param _DocumentBudget budget: See :func:`queue_to_solr`
+        :param int retries: See :func:`send_data_to_solr`
+        :param int retry_wait: See :func:`send_data_to_solr`
+        :param _DeadLetterFile dead_letters: See :func:`send_data_to_solr`
+        :param bool overwrite: See :func:`send_data_to_solr`
+        :param str entity_name:
+        """
+        self.solr_connection = solr_connection
+        self.entity_name = entity_name
+        self.ack_queue = ack_queue
+        self.commit_within = commit_within
+        self.budget = budget
+        self.retries = retries
+        self.retry_wait = retry_wait
+        self.dead_letters = dead_letters
+        self.overwrite = overwrite
+        self.error = None
+        if max_inflight > 1:
+            self.pool = ThreadPool(max_inflight)
+            self.slots = threading.BoundedSemaphore(max_inflight)
+        else:
+            self.pool = None
+
+    def _send(self, data, keys):
+        try:
+            start = time.time()
+            rejected = send_data_to_solr(self.solr_connection, data,
+                                         self.commit_within, self.retries,
+                                         self.retry_wait, self.dead_letters,
+                                         self.overwrite)
+            metrics.SOLR_BATCH_SECONDS.observe(self.entity_name,
+                                               time.time() - start)
+            metrics.SOLR_DOCUMENTS.inc(self.entity_name,
+                                       len(data) - len(rejected))
+            metrics.SOLR_FAILURES.inc(self.entity_name, len(rejected))
+            if self.ack_queue is not None and len(rejected) < len(data):
+                self.ack_queue.put(Counter(key for i, key in enumerate(keys)
+                                           if i not in rejected))
+        finally:
+            if self.budget is not None:
+                self.budget.release(len(data))
+
+    def _send_and_release(self, data, keys):
+        try:
+            self._send(data, keys)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.slots.release()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def send(self, data, keys):
+        """
+        Send ``data``, whose documents have the keys ``keys``.
+
+        :param [dict] data:
+        :param list keys:
+        """
+        if self.pool is None:
+            self._send(data, keys)
+            return
+        self._raise_error()
+        self.slots.acquire()
+        self.pool.apply_async(self._send_and_release, (data, keys))
+
+    def close(self):
+        """
+        Wait until all batches have been sent.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self._raise_error()
 
 
-def send_data_to_solr(solr_connection, data):
+def send_data_to_solr(solr_connection, data, commit_within=None, retries=0,
+                      retry_wait=0, dead_letters=None, overwrite=True):
     """
     Sends ``data`` through ``solr_connection``.
 
+    If Solr rejects some of the documents (see :func:`_is_document_error`),
+    ``data`` is split in halves which are sent separately until the rejected
+    documents are found, so all other documents are still indexed. The
+    rejected ones are reported to Sentry and written to ``dead_letters``, if
+    it is given.
+
+    If Solr responds with any other error, sending is retried up to
+    ``retries`` times, waiting exponentially longer starting with twice
+    ``retry_wait`` milliseconds.
+
+    Any other error, like a connection that can't be established or a server
+    error, fails the whole batch: it's reported to Sentry once and
+    :data:`FAILED` is set. Otherwise, :data:`FAILED` is only set if none of
+    the documents could be sent.
+
+    If ``overwrite`` is false, Solr is told not to check whether the
+    documents replace existing ones on the first attempt. Solr might have
+    added some of the documents of a failed request, so all later attempts
+    overwrite them to avoid duplicates.
+
     :param solr.Solr solr_connection:
     :param [dict] data:
-    :raises: :class:`solr:solr.SolrException`
+    :param int commit_within: If set, the number of milliseconds within which
+                              Solr should commit ``data``
+    :param int retries:
+    :param int retry_wait:
+    :param _DeadLetterFile dead_letters:
+    :param bool overwrite:
+    :rtype: set(int)
+    :returns: The positions of the documents in ``data`` that could not be
+              sent
     """
+    attempts = [0]
+
+    def add(docs):
+        kwargs = {}
+        if commit_within:
+            # pysolr puts it into an XML attribute, which has to be a string
+            kwargs["commitWithin"] = str(commit_within)
+        if not overwrite and not attempts[0]:
+            kwargs["overwrite"] = False
+        attempts[0] += 1
+        solr_connection.add(docs, **kwargs)
+
+    def should_retry(exc):
+        # Sending documents Solr rejected again fails again, so they're
+        # looked for right away
+        if isinstance(exc, SolrError) and not _is_document_error(exc):
+            logger.warning("Solr responded with an error to %d documents: %s",
+                           len(data), exc)
+            return True
+        return False
+
+    core = getattr(solr_connection, "url", None)
+
+    retrying = Retrying(stop_max_attempt_number=retries + 1,
+                        wait_exponential_multiplier=retry_wait,
+                        wait_exponential_max=60000,
+                        retry_on_exception=should_retry)
+    rejected = set()
+    # The positions of the documents that have been sent successfully while
+    # bisecting
+    sent = set()
     try:
-        solr_connection.add(data)
-        logger.debug("Done sending data to Solr")
+        try:
+            retrying.call(add, data)
+            logger.debug("Done sending data to Solr")
+        except SolrError as exc:
+            if not _is_document_error(exc):
+                raise
+            if len(data) > 1:
+                logger.warning("Failed to send %d documents to Solr, looking "
+                               "for the ones it rejects", len(data))
+                _send_bisected(add, data, 0, rejected, sent, dead_letters,
+                               core)
+            elif data:
+                _reject(data, 0, rejected, dead_letters, core)
     except SolrError:
-        get_sentry().captureException(extra={"data": data})
+        get_sentry().captureException(extra={"core": core,
+                                             "documents": len(data)})
+        logger.error("Failed to send %d documents to Solr", len(data))
+        rejected.update(set(xrange(len(data))) - sent)
+        FAILED.value = True
+        return rejected
+    if data and len(rejected) == len(data):
         FAILED.value = True
     else:
         logger.debug("Sent data to Solr")
+    return rejected
+
+
+def _is_document_error(exc):
+    """
+    Return whether ``exc`` means that Solr rejected some of the documents
+    that were sent (a ``400 Bad Request`` response), as opposed to Solr being
+    unreachable or failing to process any request.
+
+    :param pysolr.SolrError exc:
+    :rtype: bool
+    """
+    match = re.search(r"\(HTTP (\d+)\)", str(exc))
+    return match is not None and match.group(1) == "400"
+
+
+def _send_bisected(add, data, offset, rejected, sent, dead_letters, core):
+    """
+    Send both halves of ``data`` with ``add``, splitting them further if Solr
+    rejects some of their documents, and add the positions of the documents
+    that can't be sent on their own to ``rejected`` and of the ones that have
+    been sent to ``sent``. ``offset`` is the position of the first element of
+    ``data`` in the original batch.
+
+    :raises pysolr.SolrError: if sending fails for another reason
+    """
+    middle = len(data) // 2
+    for part, part_offset in ((data[:middle], offset),
+                              (data[middle:], offset + middle)):
+        try:
+            add(part)
+        except SolrError as exc:
+            if not _is_document_error(exc):
+                raise
+            if len(part) > 1:
+                _send_bisected(add, part, part_offset, rejected, sent,
+                               dead_letters, core)
+            else:
+                _reject(part, part_offset, rejected, dead_letters, core)
+        else:
+            sent.update(xrange(part_offset, part_offset + len(part)))
+
+
+def _reject(data, offset, rejected, dead_letters, core):
+    """
+    Report the single document in ``data`` that couldn't be sent to ``core``.
+    This has to be called while handling the :class:`pysolr.SolrError`.
+    """
+    get_sentry().captureException(extra={"data": data})
+    logger.error("Solr rejected the document %s", data[0].get("id"))
+    rejected.add(offset)
+    if dead_letters is not None:
+        dead_letters.write(core, data[0], sys.exc_info()[1])
+
+
+#: The file rejected documents are written to if ``[solr] dead_letter_file``
+#: is not set.
+_DEFAULT_DEAD_LETTER_FILE = "dead_letters.jsonl"
+
+
+class _DeadLetterFile(object):
+    """
+    A file with one JSON object for each document Solr rejected, containing
+    the document and the error.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path:
+        """
+        self.path = path
+
+    def write(self, core, doc, error):
+        """
+        :param str core: The URL of the core ``doc`` was sent to.
+        :param dict doc:
+        :param Exception error:
+        """
+        line = json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                           "core": core,
+                           "error": str(error),
+                           "document": doc},
+                          default=str)
+        # Each line is written with a single write() to a file opened with
+        # O_APPEND, so the lines of different threads and Solr processes
+        # aren't interleaved
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line + "\n")
+        finally:
+            os.close(fd)
@@ -0,0 +1,308 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module collects counters, gauges and histograms about the stages of an
+import, per entity type, and exposes them in the Prometheus text format.
+
+All values are kept in a single block of shared memory that's allocated
+when this module is imported. Processes started afterwards, like the import
+workers and Solr processes, update the same values, so the totals can be
+read from the main process.
+"""
+import multiprocessing
+import os
+import threading
+import time
+
+from . import config
+from .schema import SCHEMA
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from ConfigParser import NoOptionError
+from ctypes import c_double
+from logging import getLogger
+
+
+logger = getLogger("sir")
+
+#: The default upper bounds of the buckets of histograms of durations
+_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+#: The upper bounds of the buckets of histograms of sizes
+_SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+
+class _Metric(object):
+    """
+    A metric with one series per entity type, whose values are stored in
+    ``slots`` consecutive elements of :attr:`Registry.values` per entity.
+    """
+
+    kind = None
+    slots = 1
+
+    def __init__(self, registry, name, description):
+        self.registry = registry
+        self.name = name
+        self.description = description
+        self.offset = registry.reserve(self)
+
+    def _index(self, entity):
+        # Entities that aren't in the schema (like in tests) aren't counted
+        position = self.registry.entities.get(entity)
+        if position is None:
+            return None
+        return self.offset + position * self.slots
+
+    def render(self, values):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for entity in sorted(self.registry.entities):
+            index = self._index(entity)
+            lines.extend(self._render_series(entity,
+                                             values[index:index + self.slots]))
+        return lines
+
+    def _render_series(self, entity, values):
+        return ['%s{entity="%s"} %s' % (self.name, entity,
+                                        _format_value(values[0]))]
+
+
+class _Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, entity, amount=1):
+        index = self._index(entity)
+        if index is not None:
+            with self.registry.lock:
+                self.registry.values[index] += amount
+
+
+class _Gauge(_Counter):
+    kind = "gauge"
+
+    def add(self, entity, amount):
+        self.inc(entity, amount)
+
+
+class _Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, description, buckets=_SECONDS_BUCKETS):
+        self.buckets = buckets
+        # One slot per bucket, one for +Inf, the sum and the count
+        self.slots = len(buckets) + 3
+        super(_Histogram, self).__init__(registry, name, description)
+
+    def observe(self, entity, value):
+        index = self._index(entity)
+        if index is None:
+            return
+        bucket = len(self.buckets)
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                bucket = i
+                break
+        values = self.registry.values
+        with self.registry.lock:
+            values[index + bucket] += 1
+            values[index + len(self.buckets) + 1] += value
+            values[index + len(self.buckets) + 2] += 1
+
+    def _render_series(self, entity, values):
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + ("+Inf",), values):
+            cumulative += count
+            lines.append('%s_bucket{entity="%s",le="%s"} %s' %
+                         (self.name, entity, upper_bound,
+                          _format_value(cumulative)))
+        lines.append('%s_sum{entity="%s"} %s' %
+                     (self.name, entity, _format_value(values[-2])))
+        lines.append('%s_count{entity="%s"} %s' %
+                     (self.name, entity, _format_value(values[-1])))
+        return lines
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Registry(object):
+    """
+    A set of metrics for the entity types in ``entities``. Metrics have to be
+    created before :meth:`allocate` is called.
+    """
+
+    def __init__(self, entities):
+        """
+        :param [str] entities:
+        """
+        self.entities = dict((entity, i) for i, entity in
+                             enumerate(sorted(entities)))
+        self.metrics = []
+        self.size = 0
+        self.values = None
+        self.lock = None
+
+    def reserve(self, metric):
+        self.metrics.append(metric)
+        offset = self.size
+        self.size += metric.slots * len(self.entities)
+        return offset
+
+    def counter(self, name, description):
+        return _Counter(self, name, description)
+
+    def gauge(self, name, description):
+        return _Gauge(self, name, description)
+
+    def histogram(self, name, description, buckets=_SECONDS_BUCKETS):
+        return _Histogram(self, name, description, buckets)
+
+    def allocate(self):
+        """
+        Allocate the shared memory for the values of all metrics.
+        """
+        self.values = multiprocessing.RawArray(c_double, self.size)
+        self.lock = multiprocessing.Lock()
+
+    def render(self):
+        """
+        Return the values of all metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        with self.lock:
+            values = self.values[:]
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(values))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry(SCHEMA.keys())
+
+DB_ROWS = REGISTRY.counter("sir_db_rows_total",
+                           "Rows retrieved from the database")
+DOCUMENTS_CONVERTED = REGISTRY.counter("sir_documents_converted_total",
+                                       "Rows converted into documents")
+CONVERSION_SECONDS = REGISTRY.histogram("sir_conversion_seconds",
+                                        "Time to retrieve and convert a batch "
+                                        "of rows")
+QUEUE_DEPTH = REGISTRY.gauge("sir_queue_depth",
+                             "Documents waiting to be sent to Solr")
+QUEUE_PEAK_DEPTH = REGISTRY.gauge("sir_queue_peak_depth",
+                                  "Most documents counted against the "
+                                  "document_budget at the same time")
+BUDGET_BLOCKED_SECONDS = REGISTRY.counter("sir_budget_blocked_seconds_total",
+                                          "Time the import workers waited "
+                                          "for room in the document_budget")
+SOLR_BATCH_SECONDS = REGISTRY.histogram("sir_solr_batch_seconds",
+                                        "Time to send a batch to Solr")
+SOLR_DOCUMENTS = REGISTRY.counter("sir_solr_documents_total",
+                                  "Documents sent to Solr")
+#: The UTF-8 encoded size of the field names and values, see
+#: :func:`sir.indexing._estimate_document_size`, not of the requests
+SOLR_ESTIMATED_BYTES = REGISTRY.counter("sir_solr_estimated_bytes_total",
+                                        "Estimated bytes of the documents "
+                                        "sent to Solr")
+SOLR_FAILURES = REGISTRY.counter("sir_solr_failures_total",
+                                 "Documents Solr rejected")
+LIVE_BATCH_SIZE = REGISTRY.histogram("sir_live_batch_size",
+                                     "Ids per entity type in a batch of "
+                                     "live indexing messages", _SIZE_BUCKETS)
+
+REGISTRY.allocate()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_thread(target, name):
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def start_http_server(port, address=""):
+    """
+    Serve the metrics in the Prometheus text format on ``port`` from a
+    thread.
+
+    :param int port:
+    :param str address:
+    :rtype: BaseHTTPServer.HTTPServer
+    """
+    server = HTTPServer((address, port), _MetricsHandler)
+    _start_thread(server.serve_forever, "metrics-http")
+    logger.info("Serving metrics on port %i", server.server_port)
+    return server
+
+
+def write_stats_file(path):
+    """
+    Write the metrics in the Prometheus text format into ``path``, replacing
+    it atomically.
+
+    :param str path:
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(REGISTRY.render())
+    os.rename(tmp_path, path)
+
+
+def start_stats_file_writer(path, interval):
+    """
+    Rewrite ``path`` with :func:`write_stats_file` every ``interval`` seconds
+    from a thread.
+
+    :param str path:
+    :param float interval:
+    """
+    def write_periodically():
+        while True:
+            try:
+                write_stats_file(path)
+            except (IOError, OSError) as exc:
+                logger.warning("Failed to write the metrics to %s: %s", path,
+                               exc)
+            time.sleep(interval)
+
+    _start_thread(write_periodically, "metrics-file")
+
+
+def start_exporters():
+    """
+    Start exposing the metrics as configured by ``metrics_port``,
+    ``metrics_file`` and ``metrics_interval`` in the ``[sir]`` section.
+    """
+    try:
+        port = config.CFG.getint("sir", "metrics_port")
+    except NoOptionError:
+        port = 0
+    if port:
+        start_http_server(port)
+    try:
+        path = config.CFG.get("sir", "metrics_file")
+    except NoOptionError:
+        path = None
+    if path:
+        try:
+            interval = config.CFG.getfloat("sir", "metrics_interval")
+        except NoOptionError:
+            interval = 10
+        start_stats_file_writer(path, interval)
@@ -0,0 +1,136 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module profiles the functions that do the work of an import with
+:mod:`cProfile` if ``reindex`` or ``amqp_watch`` is run with ``--profile``.
+
+Every process writes the stats of the calls it profiled into its own file,
+which :func:`report` merges into a single report once the command is done.
+Only one out of every ``every`` calls of each function is profiled to keep
+the overhead low.
+"""
+import cProfile
+import glob
+import multiprocessing
+import os
+import pstats
+
+from ctypes import c_long
+from functools import wraps
+from logging import getLogger
+
+
+logger = getLogger("sir")
+
+#: The directory the stats are written into, or None if profiling is off
+_DIRECTORY = None
+#: Only every ``_EVERY``-th call of a function is profiled
+_EVERY = 1
+
+# The profiler of the current process and its pid, to notice when a process
+# has been forked and inherited the profiler of its parent
+_PROFILER = None
+_PROFILER_PID = None
+# Whether the current process is running a profiled call, in which case
+# calls of other profiled functions are already covered by it
+_ACTIVE = False
+
+
+def enable(directory, every=1):
+    """
+    Profile every ``every``-th call of all functions decorated with
+    :func:`profiled` from now on and write the stats into ``directory``.
+    Stats of a previous run in ``directory`` are deleted.
+
+    This has to be called before the worker processes are started.
+
+    :param str directory:
+    :param int every:
+    """
+    global _DIRECTORY, _EVERY
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for path in _stats_files(directory):
+        os.remove(path)
+    _DIRECTORY = directory
+    _EVERY = max(every, 1)
+    logger.info("Profiling every %i. call, writing the stats into %s", _EVERY,
+                directory)
+
+
+def _stats_files(directory):
+    return glob.glob(os.path.join(directory, "process-*.prof"))
+
+
+def _profiler():
+    global _PROFILER, _PROFILER_PID
+    if _PROFILER_PID != os.getpid():
+        _PROFILER = cProfile.Profile()
+        _PROFILER_PID = os.getpid()
+    return _PROFILER
+
+
+def _run_profiled(function, args, kwargs):
+    global _ACTIVE
+    profiler = _profiler()
+    _ACTIVE = True
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        _ACTIVE = False
+        # Write the stats after each call because worker processes might be
+        # terminated at any time
+        profiler.dump_stats(os.path.join(_DIRECTORY,
+                                         "process-%i.prof" % os.getpid()))
+
+
+def profiled(function):
+    """
+    A decorator that runs ``function`` under :mod:`cProfile` after
+    :func:`enable` has been called. Otherwise ``function`` is called
+    directly.
+
+    Only the thread calling ``function`` is profiled.
+    """
+    # Shared by all processes forked after the decoration, so every
+    # _EVERY-th call across all of them is profiled
+    calls = multiprocessing.Value(c_long, 0)
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if _DIRECTORY is None or _ACTIVE:
+            return function(*args, **kwargs)
+        with calls.get_lock():
+            call = calls.value
+            calls.value += 1
+        if call % _EVERY:
+            return function(*args, **kwargs)
+        return _run_profiled(function, args, kwargs)
+
+    return wrapper
+
+
+def report(directory):
+    """
+    Merge the stats of all processes in ``directory`` and write them into
+    ``merged.prof``, which can be loaded with :class:`pstats.Stats`, and,
+    sorted by cumulative time, into ``report.txt``.
+
+    :param str directory:
+    :rtype: str
+    :returns: The path of the report or None if there were no stats
+    """
+    paths = _stats_files(directory)
+    if not paths:
+        logger.info("No calls have been profiled")
+        return None
+    report_path = os.path.join(directory, "report.txt")
+    with open(report_path, "w") as f:
+        stats = pstats.Stats(*paths, stream=f)
+        stats.dump_stats(os.path.join(directory, "merged.prof"))
+        stats.sort_stats("cumulative").print_stats()
+    logger.info("Merged the profiles of %i processes into %s", len(paths),
+                report_path)
+    return report_path
@@ -3,6 +3,8 @@
 import logging
 
 
+from collections import defaultdict
+from operator import attrgetter
 from sqlalchemy import func
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE
@@ -83,49 +85,257 @@ def iterate_path_values(path, obj):
         yield getattr(obj, pathelem)
 
 
+def compile_paths(model, field_paths):
+    """
+    Return a function that, given an instance of ``model``, returns a list
+    with a set for each list of paths in ``field_paths``, containing the
+    values :func:`iterate_path_values` returns for those paths that aren't
+    ``None``. Values that are lists are added element by element.
+
+    The paths are merged into a tree of their elements, like the one
+    :func:`sir.schema.searchentities.merge_paths` returns, whose nodes are
+    looked up on the models, including the directions of the relationships,
+    only once here instead of for every object. The returned function walks
+    each relationship only once per object, no matter how many paths go
+    through it::
+
+        >>> from mbdata.models import Recording, ISRC
+        >>> recording = Recording(name="Fortuna Imperatrix Mundi: O Fortuna")
+        >>> recording.isrcs.append(ISRC(isrc="DEF056730100"))
+        >>> recording.isrcs.append(ISRC(isrc="DEF056730101"))
+        >>> extract = compile_paths(Recording, [["name"],
+        ...                                     ["isrcs.isrc", "isrcs.id"]])
+        >>> names, isrcs = extract(recording)
+        >>> sorted(isrcs)
+        ['DEF056730100', 'DEF056730101']
+
+    :param model: A :ref:`declarative <sqla:declarative_toplevel>` class.
+    :param field_paths:
+    :type field_paths: [[str]]
+    :rtype: function
+    """
+    walk = _compile_path_tree(model, [(path, index)
+                                      for index, paths in enumerate(field_paths)
+                                      for path in paths])
+    count = len(field_paths)
+
+    def extract(obj):
+        values = [set() for _ in xrange(count)]
+        walk(obj, values)
+        return values
+    return extract
+
+
+def _compile_path_tree(model, paths):
+    """
+    Return a function that adds the values of ``paths``, a list of
+    ``(path, index)`` tuples, on an instance of ``model`` to the set at
+    ``index`` of a list.
+    """
+    # Maps the names of attributes to the indexes of the paths ending there
+    leaves = defaultdict(set)
+    # Maps the names of relationships to the rest of the paths through them
+    branches = defaultdict(list)
+    for path, index in paths:
+        pathelem, _, rest = path.partition(".")
+        column = getattr(model, pathelem)
+        # Like iterate_path_values, the rest of a path after an attribute
+        # that isn't a relationship is ignored
+        if (rest and isinstance(column, InstrumentedAttribute) and
+                isinstance(column.property, RelationshipProperty)):
+            branches[pathelem].append((rest, index))
+        else:
+            leaves[pathelem].add(index)
+
+    leaves = [(attrgetter(name), tuple(indexes))
+              for name, indexes in leaves.items()]
+    many_to_one = []
+    one_to_many = []
+    for name, sub_paths in branches.items():
+        prop = getattr(model, name).property
+        sub_walk = _compile_path_tree(prop.mapper.class_, sub_paths)
+        if prop.direction == MANYTOONE:
+            many_to_one.append((attrgetter(name), sub_walk))
+        elif prop.direction == ONETOMANY:
+            one_to_many.append((attrgetter(name), sub_walk))
+        # iterate_path_values doesn't follow many-to-many relationships either
+
+    def walk(obj, values):
+        for getter, indexes in leaves:
+            value = getter(obj)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                for index in indexes:
+                    values[index].update(value)
+            else:
+                for index in indexes:
+                    values[index].add(value)
+        for getter, sub_walk in many_to_one:
+            sub_obj = getter(obj)
+            if sub_obj is not None:
+                sub_walk(sub_obj, values)
+        for getter, sub_walk in one_to_many:
+            for sub_obj in getter(obj):
+                sub_walk(sub_obj, values)
+    return walk
+
+
 def iter_bounds(db_session, column, batch_size, importlimit):
     """
-    Return a list of (lower bound, upper bound) tuples which contain row ids to
-    iterate through a table in batches of ``batch_size``. If ``importlimit`` is
-    greater than zero, return only enough tuples to contain ``importlimit``
-    rows. The second element of the last tuple in the returned list may be
-    ``None``. This happens if the last batch will contain less than
-    ``batch_size`` rows.
+    Yield (lower bound, upper bound) tuples which contain row ids to iterate
+    through a table in batches of ``batch_size``. If ``importlimit`` is
+    greater than zero, yield only enough tuples to contain ``importlimit``
+    rows. The second element of the last tuple may be ``None``. This happens
+    if the last batch will contain less than ``batch_size`` rows.
+
+    ``batch_size`` can also be a function without arguments that returns the
+    size of the next batch, for example a
+    :class:`sir.batchsizing.BatchSizer`. It's called right before each
+    upper bound is looked up, so the size can change while the bounds are
+    being consumed.
+
+    The bounds are found by keyset pagination: each upper bound is looked up
+    with an index scan that starts at the previous one, so the first bounds
+    are available right away instead of after a scan of the whole table.
 
     :param sqlalchemy.orm.session.Session db_session:
     :param sqlalchemy.Column column:
-    :param int batch_size:
+    :param batch_size:
+    :type batch_size: int or callable
     :param int importlimit:
-    :rtype: [(int, int)]
+    :rtype: iterator over (int, int)
     """
-    q = db_session.query(
-        column,
-        func.row_number().
-        over(order_by=column).
-        label('rownum')
-    ).\
-        from_self(column)
-
-    if batch_size > 1:
-        q = q.filter("rownum %% %d=1" % batch_size)
-
-    if importlimit:
-        q = q.filter("rownum <= %d" % (importlimit))
-
-    intervals = [id for id in q]
-    bounds = []
-
-    while intervals:
-        start = intervals.pop(0)[0]
-        if intervals:
-            end = intervals[0][0]
-        elif importlimit:
+    next_size = _size_function(batch_size)
+    start = db_session.query(func.min(column)).scalar()
+    # The row number of ``start`` in the table ordered by ``column``
+    rownum = 1
+    while start is not None:
+        batch_size = next_size()
+        end = (db_session.query(column).
+               filter(column > start).
+               order_by(column).
+               offset(batch_size - 1).
+               limit(1).
+               scalar())
+        rownum += batch_size
+        if importlimit and (end is None or rownum > importlimit):
             # If there's an importlimit, just add a noop bound. This way,
             # :func:`sir.indexing.index_entity` doesn't require any
             # information about the limit
-            end = start
-        else:
-            end = None
-        bounds.append((start, end))
+            yield (start, start)
+            return
+        yield (start, end)
+        start = end
+
 
-    return bounds
+def _size_function(batch_size):
+    """
+    Return a function returning the size of the next batch for a
+    ``batch_size`` as accepted by :func:`iter_bounds`.
+    """
+    if callable(batch_size):
+        return lambda: max(batch_size(), 1)
+    batch_size = max(batch_size, 1)
+    return lambda: batch_size
+
+
+def iter_histogram_splits(histogram, total_rows, batch_size, importlimit=0):
+    """
+    Yield the ids that split a column into batches of approximately
+    ``batch_size`` rows, given the equal-population ``histogram`` of the
+    column (as found in the ``histogram_bounds`` of ``pg_stats``) and the
+    estimated number of rows in the table.
+
+    Positions between two histogram bounds are interpolated linearly. If
+    ``importlimit`` is greater than zero, the last returned id is the one
+    approximately ``importlimit`` rows into the table. ``batch_size`` may be a
+    function, like in :func:`iter_bounds`.
+
+    >>> list(iter_histogram_splits([0, 100, 200], 200, 50))
+    [50, 100, 150]
+    >>> list(iter_histogram_splits([0, 100, 200], 200, 50, importlimit=120))
+    [50, 100, 120]
+
+    :param [int] histogram:
+    :param int total_rows:
+    :param batch_size:
+    :type batch_size: int or callable
+    :param int importlimit:
+    :rtype: iterator over int
+    """
+    next_size = _size_function(batch_size)
+    buckets = len(histogram) - 1
+    rows_per_bucket = float(total_rows) / buckets
+    last_split = None
+    target = next_size()
+    while True:
+        if importlimit and target >= importlimit:
+            target = importlimit
+        position = target / rows_per_bucket
+        if position >= buckets:
+            break
+        bucket = int(position)
+        lower, upper = histogram[bucket], histogram[bucket + 1]
+        split = int(lower + (position - bucket) * (upper - lower))
+        if last_split is None or split > last_split:
+            last_split = split
+            yield split
+        if target == importlimit:
+            break
+        target += next_size()
+
+
+def iter_approximate_bounds(db_session, column, batch_size, importlimit):
+    """
+    Like :func:`iter_bounds`, but compute the bounds from the statistics
+    Postgres keeps about ``column`` instead of looking at the rows themselves.
+    This takes a few milliseconds no matter how large the table is, but the
+    batches will only roughly contain ``batch_size`` rows, depending on how
+    recently the table has been analyzed.
+
+    If there are no statistics for ``column``, this falls back to
+    :func:`iter_bounds`.
+
+    :param sqlalchemy.orm.session.Session db_session:
+    :param sqlalchemy.Column column:
+    :param batch_size:
+    :type batch_size: int or callable
+    :param int importlimit:
+    :rtype: iterator over (int, int)
+    """
+    table = column.table
+    stats = db_session.execute(
+        "SELECT s.histogram_bounds::text, c.reltuples "
+        "FROM pg_stats s "
+        "JOIN pg_namespace n ON n.nspname = s.schemaname "
+        "JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = s.tablename "
+        "WHERE s.schemaname = :schema AND s.tablename = :table "
+        "AND s.attname = :column",
+        {"schema": table.schema or "public",
+         "table": table.name,
+         "column": column.name}).first()
+    histogram = None
+    if stats is not None and stats[0] is not None:
+        histogram = [int(bound) for bound in stats[0].strip("{}").split(",")]
+    if histogram is None or len(histogram) < 2 or not stats[1] > 0:
+        logger.info("No statistics for %s.%s, falling back to exact bounds",
+                    table.name, column.name)
+        for bounds in iter_bounds(db_session, column, batch_size, importlimit):
+            yield bounds
+        return
+
+    start = db_session.query(func.min(column)).scalar()
+    if start is None:
+        return
+    splits = iter_histogram_splits(histogram, stats[1], batch_size,
+                                   importlimit)
+    for end in splits:
+        if end <= start:
+            continue
+        yield (start, end)
+        start = end
+    if importlimit and importlimit < stats[1]:
+        # The last split is the one at ``importlimit``
+        return
+    yield (start, None)
@@ -4,6 +4,7 @@
 This module wraps models from mbdata package and adds missing relationships
 that are used in SIR.
 """
+from collections import namedtuple
 from mbdata.models import (Annotation, Area, Artist, ArtistAlias, Event,
                            Instrument, Label, LinkAttribute, LinkAttributeType,
                            LinkRecordingWork, Medium, MediumCDTOC, Place, Recording, Release,
@@ -18,6 +19,62 @@ from warnings import simplefilter
 simplefilter(action="ignore", category=sa_exc.SAWarning)
 
 
+class Aggregate(namedtuple("Aggregate", ["function", "foreign_key",
+                                         "criteria", "default"])):
+    """
+    The value of ``function`` over the rows whose ``foreign_key`` points to
+    an object and that match all ``criteria``, or ``default`` if there are
+    none.
+    """
+
+    def load(self, session, ids):
+        """
+        Return a dict mapping each of ``ids`` that has matching rows to its
+        value, computed with a single query grouped by the foreign key.
+
+        If the ids are dense enough, as for the batches of a reindex, the
+        rows are selected by the range between the lowest and the highest id
+        instead of a list of all of them.
+
+        :param sqlalchemy.orm.session.Session session:
+        :param [int] ids:
+        :rtype: dict
+        """
+        low, high = min(ids), max(ids)
+        if high - low < 2 * len(ids):
+            condition = self.foreign_key.between(low, high)
+        else:
+            condition = self.foreign_key.in_(ids)
+        query = (select([self.foreign_key, self.function]).
+                 where(and_(condition, *self.criteria)).
+                 group_by(self.foreign_key))
+        return dict((id_, value) for id_, value in session.execute(query))
+
+
+def aggregate_property(function, foreign_key, parent_id, *criteria, **kwargs):
+    """
+    Return a deferred :func:`~sqlalchemy.orm.column_property` with the value
+    of ``function`` over the rows whose ``foreign_key`` is ``parent_id``. It
+    is a correlated subquery that would run once for every object, so the
+    values should be loaded for many objects at once with
+    :meth:`sir.schema.searchentities.SearchEntity.load_aggregates`, which
+    finds the :class:`Aggregate` in the ``info`` of the property.
+
+    :param function: The aggregate function, like ``func.count(Place.id)``.
+    :param foreign_key: The column of the aggregated rows that points to the
+                        object.
+    :param parent_id: The column of the object ``foreign_key`` points to.
+    :param criteria: Further conditions on the aggregated rows.
+    :param default: The value if there are no matching rows, like ``0`` for
+                    counts. Defaults to ``None``.
+    """
+    aggregate = Aggregate(function, foreign_key, criteria,
+                          kwargs.get("default"))
+    return column_property(select([function]).
+                           where(and_(foreign_key == parent_id, *criteria)),
+                           deferred=True, info={"aggregate": aggregate})
+
+
 class CustomAnnotation(Annotation):
     areas = relationship("AreaAnnotation")
     artists = relationship("ArtistAnnotation")
@@ -37,9 +94,9 @@ class CustomArea(Area):
     area_links = relationship("LinkAreaArea",
                               primaryjoin="Area.id == LinkAreaArea.entity1_id")
     tags = relationship("AreaTag")
-    place_count = column_property(select([func.count(Place.id)]).where(Place.area_id == Area.id))
-    label_count = column_property(select([func.count(Label.id)]).where(Label.area_id == Area.id))
-    artist_count = column_property(select([func.count(Artist.id)]).where(Artist.area_id == Area.id))
+    place_count = aggregate_property(func.count(Place.id), Place.area_id, Area.id, default=0)
+    label_count = aggregate_property(func.count(Label.id), Label.area_id, Area.id, default=0)
+    artist_count = aggregate_property(func.count(Artist.id), Artist.area_id, Area.id, default=0)
 
 
 class CustomArtist(Artist):
@@ -49,10 +106,9 @@ class CustomArtist(Artist):
     end_area = relationship('CustomArea', foreign_keys=[Artist.end_area_id])
     tags = relationship('ArtistTag')
     artist_credit_names = relationship("ArtistCreditName", innerjoin=True)
-    primary_aliases = column_property(select(
-        [func.array_agg(ArtistAlias.name)]).where(
-            and_(ArtistAlias.artist_id == Artist.id,
-                 ArtistAlias.primary_for_locale == True)))
+    primary_aliases = aggregate_property(
+        func.array_agg(ArtistAlias.name), ArtistAlias.artist_id, Artist.id,
+        ArtistAlias.primary_for_locale == True)
 
 
 class CustomArtistAlias(ArtistAlias):
@@ -78,7 +134,7 @@ class CustomLabel(Label):
     aliases = relationship("LabelAlias")
     area = relationship("CustomArea", foreign_keys=[Label.area_id])
     tags = relationship("LabelTag")
-    release_count = column_property(select([func.count(ReleaseLabel.id)]).where(ReleaseLabel.label_id == Label.id))
+    release_count = aggregate_property(func.count(ReleaseLabel.id), ReleaseLabel.label_id, Label.id, default=0)
 
 
 class CustomMediumCDToc(MediumCDTOC):
@@ -101,13 +157,13 @@ class CustomReleaseGroup(ReleaseGroup):
     aliases = relationship("ReleaseGroupAlias")
     releases = relationship("Release")
     tags = relationship("ReleaseGroupTag")
-    release_count = column_property(select([func.count(Release.id)]).where(Release.release_group_id == ReleaseGroup.id))
+    release_count = aggregate_property(func.count(Release.id), Release.release_group_id, ReleaseGroup.id, default=0)
 
 
 class CustomRelease(Release):
     aliases = relationship("ReleaseAlias")
     asin = relationship("ReleaseMeta")
-    medium_count = column_property(select([func.count(Medium.id)]).where(Medium.release_id == Release.id))
+    medium_count = aggregate_property(func.count(Medium.id), Medium.release_id, Release.id, default=0)
 
 
 class CustomReleaseRaw(ReleaseRaw):
@@ -136,7 +192,7 @@ class CustomWork(Work):
     tags = relationship("WorkTag")
     languages = relationship("WorkLanguage")
     recording_links = relationship("LinkRecordingWork")
-    recording_count = column_property(select([func.count(LinkRecordingWork.id)]).where(LinkRecordingWork.work_id == Work.id))
+    recording_count = aggregate_property(func.count(LinkRecordingWork.id), LinkRecordingWork.work_id, Work.id, default=0)
 
 
 class CustomURL(URL):
@@ -2,12 +2,20 @@
 # coding: utf-8
 # Copyright (c) 2015 Wieland Hoffmann
 # License: MIT, see LICENSE for details
+import uuid
+
 from mbdata.models import (Annotation, AreaAnnotation, ArtistAnnotation,
                            EventAnnotation, InstrumentAnnotation, LabelAnnotation,
                            PlaceAnnotation, RecordingAnnotation, ReleaseAnnotation,
                            ReleaseGroupAnnotation, SeriesAnnotation, WorkAnnotation)
-from sqlalchemy import func
+from logging import getLogger
+from sqlalchemy import Column, Integer, MetaData, Table, func, select
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.query import Query
+from sqlalchemy.schema import CreateTable
+
+
+logger = getLogger("sir")
 
 models = [
     AreaAnnotation,
@@ -23,9 +31,19 @@ models = [
     WorkAnnotation,
 ]
 
+#: The table with the ids returned by :func:`valid_annotation_ids` that has
+#: been created by :func:`create_valid_annotation_table`, if any
+_valid_annotation_table = None
 
-def filter_valid_annotations(query):
-    # TODO: Document this. What's going on in this filter?
+
+def valid_annotation_ids():
+    """
+    Returns a query for the ids of the annotations that are currently valid.
+    Every edit of an annotation of an entity adds a new row to the annotation
+    table, so only the one with the highest id for each entity is valid.
+
+    :rtype: :class:`sqla:sqlalchemy.orm.query.Query`
+    """
     queries = [Query(func.max(getattr(m, "annotation_id"))).
                group_by(
                    getattr(m,
@@ -33,5 +51,73 @@ def filter_valid_annotations(query):
                            # into release_id
                            m.__tablename__.replace("_annotation", "_id")))
                for m in models]
-    filter_query = queries[0].union_all(*queries[1:])
-    return query.filter(Annotation.id.in_(filter_query))
+    return queries[0].union_all(*queries[1:])
+
+
+def filter_valid_annotations(query):
+    """
+    Filters ``query`` so it only returns the annotations that are currently
+    valid.
+
+    If :func:`create_valid_annotation_table` has created a table, their ids
+    are read from it. Otherwise, the query of :func:`valid_annotation_ids`
+    runs as a subquery, which aggregates all annotation tables every time.
+
+    :param sqlalchemy.orm.query.Query query:
+    """
+    if _valid_annotation_table is not None:
+        ids = select([_valid_annotation_table.c.id])
+    else:
+        ids = valid_annotation_ids()
+    return query.filter(Annotation.id.in_(ids))
+
+
+def create_valid_annotation_table(engine):
+    """
+    Creates an unlogged table in the database of ``engine``, fills it with
+    :func:`valid_annotation_ids` and makes :func:`filter_valid_annotations`
+    read the ids from it. The ids are then only aggregated once instead of
+    once per query, and each query can join the table on its primary key.
+
+    The table isn't updated afterwards, so this is only meant for reindexing,
+    not for live indexing. Processes forked afterwards use the table as
+    well, but the queries of the annotation entity have to be built after
+    this has been called. Each call creates a table with a name of its own,
+    so concurrent imports don't interfere with each other.
+
+    If the table can't be created, for example because the database is a
+    read-only replica, the subquery is used instead.
+
+    :param sqlalchemy.engine.Engine engine:
+    """
+    global _valid_annotation_table
+    table = Table("sir_valid_annotation_%s" % uuid.uuid4().hex, MetaData(),
+                  Column("id", Integer, primary_key=True, autoincrement=False),
+                  prefixes=["UNLOGGED"])
+    statements = [CreateTable(table),
+                  table.insert().from_select(["id"],
+                                             valid_annotation_ids().statement),
+                  "ANALYZE %s" % table.name]
+    try:
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(statement)
+    except SQLAlchemyError as exc:
+        logger.warning("Failed to create %s, the valid annotations are "
+                       "aggregated by every query instead: %s", table.name,
+                       exc)
+        return
+    _valid_annotation_table = table
+
+
+def drop_valid_annotation_table(engine):
+    """
+    Drops the table created by :func:`create_valid_annotation_table`, if
+    any.
+
+    :param sqlalchemy.engine.Engine engine:
+    """
+    global _valid_annotation_table
+    table, _valid_annotation_table = _valid_annotation_table, None
+    if table is not None:
+        engine.execute("DROP TABLE IF EXISTS %s" % table.name)
@@ -1,7 +1,9 @@
 # Copyright (c) 2014, 2015 Lukas Lalinsky, Wieland Hoffmann
 # License: MIT, see LICENSE for details
 from sir import config
-from sir.querying import iterate_path_values
+from sir.coreextraction import (CoreExtractor, JSONExtractor,
+                                UnsupportedPathException)
+from sir.querying import compile_paths
 from collections import defaultdict
 from functools import partial
 from logging import getLogger
@@ -10,7 +12,8 @@ try:
 except ImportError:
     from xml.etree.ElementTree import tostring
 from sqlalchemy.orm import class_mapper, Load
-from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm.attributes import (InstrumentedAttribute,
+                                       set_committed_value)
 from sqlalchemy.orm.descriptor_props import CompositeProperty
 from sqlalchemy.orm.interfaces import ONETOMANY, MANYTOONE
 from sqlalchemy.orm.properties import RelationshipProperty
@@ -143,6 +146,10 @@ class SearchEntity(object):
         self.extrapaths = extrapaths
         self.extraquery = extraquery
         self._query = None
+        self._extractor = None
+        self._core_extractor = None
+        self._json_extractor = None
+        self._aggregates = None
         self.version = version
         self.compatconverter = compatconverter
 
@@ -156,6 +163,85 @@ class SearchEntity(object):
 
         return self._query
 
+    @property
+    def extractor(self):
+        """
+        The paths of all fields compiled with
+        :func:`sir.querying.compile_paths`.
+        """
+        if self._extractor is None:
+            self._extractor = compile_paths(self.model, [field.paths for field
+                                                         in self.fields])
+        return self._extractor
+
+    @property
+    def core_extractor(self):
+        """
+        A :class:`~sir.coreextraction.CoreExtractor` for the fields of this
+        entity, or ``None`` if some of their paths can't be followed without
+        the ORM.
+        """
+        if self._core_extractor is None:
+            self._core_extractor = self._build_extractor(CoreExtractor)
+        return self._core_extractor or None
+
+    @property
+    def json_extractor(self):
+        """
+        A :class:`~sir.coreextraction.JSONExtractor` for the fields of this
+        entity, or ``None`` if some of their paths can't be followed without
+        the ORM or lead to values that can't be represented in JSON.
+        """
+        if self._json_extractor is None:
+            self._json_extractor = self._build_extractor(JSONExtractor)
+        return self._json_extractor or None
+
+    def _build_extractor(self, extractor_class):
+        try:
+            return extractor_class(self.model,
+                                   [field.paths for field in self.fields],
+                                   self.extraquery)
+        except UnsupportedPathException as exc:
+            logger.warning("Can't extract %s with %s: %s",
+                           self.model.__name__, extractor_class.__name__,
+                           exc)
+            return False
+
+    @property
+    def aggregates(self):
+        """
+        A list of ``(key, aggregate)`` tuples for the properties of the model
+        created by :func:`sir.schema.modelext.aggregate_property` that the
+        fields of this entity or its :attr:`extrapaths` start with.
+        """
+        if self._aggregates is None:
+            paths = [path for field in self.fields for path in field.paths]
+            paths.extend(self.extrapaths or [])
+            keys = set(path.split(".")[0] for path in paths)
+            self._aggregates = [
+                (prop.key, prop.info["aggregate"])
+                for prop in class_mapper(self.model).iterate_properties
+                if prop.key in keys and "aggregate" in prop.info]
+        return self._aggregates
+
+    def load_aggregates(self, session, objs):
+        """
+        Loads the values of the :attr:`aggregates` of all ``objs`` with one
+        grouped query per aggregate, instead of a correlated subquery per
+        object, and sets them on the objects.
+
+        :param sqlalchemy.orm.session.Session session:
+        :param objs: Objects returned by :attr:`query`.
+        """
+        if not objs:
+            return
+        ids = [obj.id for obj in objs]
+        for key, aggregate in self.aggregates:
+            values = aggregate.load(session, ids)
+            for obj in objs:
+                set_committed_value(obj, key,
+                                    values.get(obj.id, aggregate.default))
+
     def build_entity_query(self):
         """
         Builds a :class:`sqla:sqlalchemy.orm.query.Query` object for this
@@ -242,26 +328,30 @@ class SearchEntity(object):
         :param obj: A :ref:`declarative <sqla:declarative_toplevel>` object.
         :rtype: dict
         """
+        data = self.field_values_to_dict(self.extractor(obj))
+
+        if (config.CFG.getboolean("sir", "wscompat") and self.compatconverter is
+            not None):
+            data["_store"] = tostring(self.compatconverter(obj).to_etree())
+
+        return data
+
+    def field_values_to_dict(self, field_values):
+        """
+        Converts the sets of values of the fields of an entity, as returned
+        by :attr:`extractor` or the ``iter_rows`` method of
+        :attr:`core_extractor` and :attr:`json_extractor`, into a dictionary.
+
+        :param [set] field_values:
+        :rtype: dict
+        """
         data = {}
-        for field in self.fields:
+        for field, tempvals in zip(self.fields, field_values):
             fieldname = field.name
-            tempvals = set()
-            for path in field.paths:
-                for value in iterate_path_values(path, obj):
-                    if value is not None:
-                        if isinstance(value, list):
-                            tempvals.update(set(value))
-                        else:
-                            tempvals.add(value)
             if field.transformfunc is not None:
                 tempvals = field.transformfunc(tempvals)
             if isinstance(tempvals, set) and len(tempvals) == 1:
                 tempvals = tempvals.pop()
             if tempvals is not None and tempvals:
                 data[fieldname] = tempvals
-
-        if (config.CFG.getboolean("sir", "wscompat") and self.compatconverter is
-            not None):
-            data["_store"] = tostring(self.compatconverter(obj).to_etree())
-
         return data
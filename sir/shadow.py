@@ -0,0 +1,212 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module rebuilds the index of an entity type in a separate "shadow" Solr
+core, which replaces the serving core via the CoreAdmin API once it's
+complete. Users keep getting results from the old index until then.
+"""
+import json
+import time
+import urllib
+import urllib2
+
+from logging import getLogger
+
+
+logger = getLogger("sir")
+
+#: The properties set with the Config API while a shadow core is being built.
+#: Soft commits are turned off and hard commits don't open a new searcher,
+#: since nobody searches the shadow core.
+_BULK_PROPERTIES = {
+    "updateHandler.autoSoftCommit.maxTime": -1,
+    "updateHandler.autoCommit.maxTime": 300000,
+    "updateHandler.autoCommit.openSearcher": False,
+}
+
+
+class ShadowCoreMismatchException(Exception):
+    def __init__(self, core, expected, actual):
+        self.core = core
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return "%s: Expected %i documents, got %i" % (self.core,
+                                                      self.expected,
+                                                      self.actual)
+
+
+class CoreAdmin(object):
+    """
+    A client for the parts of the CoreAdmin, Config and update APIs of the
+    Solr server at ``solr_uri`` that are needed to build a shadow core.
+    """
+
+    def __init__(self, solr_uri):
+        """
+        :param str solr_uri: The URI of the server, like the ``uri`` in the
+                             ``[solr]`` section.
+        """
+        self.solr_uri = solr_uri.rstrip("/")
+
+    def _request(self, path, params=None, data=None):
+        params = dict(params or {}, wt="json")
+        url = "%s/%s?%s" % (self.solr_uri, path, urllib.urlencode(params))
+        if data is not None:
+            request = urllib2.Request(url, json.dumps(data),
+                                      {"Content-Type": "application/json"})
+        else:
+            request = urllib2.Request(url)
+        response = urllib2.urlopen(request)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+
+    def _admin(self, action, **params):
+        params["action"] = action
+        return self._request("admin/cores", params)
+
+    def exists(self, core):
+        """
+        :param str core:
+        :rtype: bool
+        """
+        status = self._admin("STATUS", core=core)["status"]
+        return bool(status.get(core))
+
+    def create(self, core, config_set, instance_dir=None):
+        """
+        Create the core ``core`` from the configset ``config_set`` in the
+        directory ``instance_dir``, which defaults to the name of the core.
+
+        :param str core:
+        :param str config_set:
+        :param str instance_dir:
+        """
+        self._admin("CREATE", name=core, instanceDir=instance_dir or core,
+                    configSet=config_set)
+
+    def swap(self, core, other):
+        """
+        Swap the names of ``core`` and ``other``.
+
+        :param str core:
+        :param str other:
+        """
+        self._admin("SWAP", core=core, other=other)
+
+    def unload(self, core, delete=True):
+        """
+        Unload ``core``, deleting its index and directory if ``delete`` is
+        true.
+
+        :param str core:
+        :param bool delete:
+        """
+        delete = "true" if delete else "false"
+        self._admin("UNLOAD", core=core, deleteIndex=delete,
+                    deleteInstanceDir=delete)
+
+    def set_properties(self, core, properties):
+        """
+        :param str core:
+        :param properties:
+        :type properties: dict(str, object)
+        """
+        self._request("%s/config" % core, data={"set-property": properties})
+
+    def unset_properties(self, core, names):
+        """
+        :param str core:
+        :param [str] names:
+        """
+        self._request("%s/config" % core, data={"unset-property": list(names)})
+
+    def commit(self, core):
+        """
+        Send a hard commit to ``core``.
+
+        :param str core:
+        """
+        self._request("%s/update" % core, {"commit": "true"})
+
+    def count(self, core):
+        """
+        Return the number of documents in ``core``.
+
+        :param str core:
+        :rtype: int
+        """
+        return self._request("%s/select" % core,
+                             {"q": "*:*", "rows": 0})["response"]["numFound"]
+
+
+class ShadowCore(object):
+    """
+    The shadow core that the documents of the core ``core`` are imported into
+    before it replaces ``core``.
+    """
+
+    def __init__(self, admin, core, config_set):
+        """
+        :param CoreAdmin admin:
+        :param str core: The name of the serving core.
+        :param str config_set: The name of the configset of ``core``.
+        """
+        self.admin = admin
+        self.core = core
+        self.config_set = config_set
+        self.name = "%s_shadow" % core
+
+    def prepare(self, resume=False):
+        """
+        Create the shadow core and tune it for bulk imports. If it already
+        exists, it's reused if ``resume`` is true and recreated otherwise.
+
+        :param bool resume:
+        """
+        if self.admin.exists(self.name):
+            if resume:
+                logger.info("Resuming the import into %s", self.name)
+            else:
+                logger.info("Deleting the old shadow core %s", self.name)
+                self.admin.unload(self.name)
+                self._create()
+        else:
+            logger.info("Creating the shadow core %s", self.name)
+            self._create()
+        self.admin.set_properties(self.name, _BULK_PROPERTIES)
+
+    def _create(self):
+        # The serving core keeps the directory of the shadow core it was
+        # swapped with, so each build needs a directory of its own
+        instance_dir = "%s_%s" % (self.name, time.strftime("%Y%m%d%H%M%S"))
+        self.admin.create(self.name, self.config_set, instance_dir)
+
+    def finish(self, expected_count, tolerance=0.0, keep_old=False):
+        """
+        Restore the settings of the shadow core, check that it contains
+        ``expected_count`` documents, give or take a fraction of
+        ``tolerance``, and swap it with the serving core. Unless ``keep_old``
+        is true, the old serving core is deleted afterwards.
+
+        :param int expected_count:
+        :param float tolerance:
+        :param bool keep_old:
+        :raises ShadowCoreMismatchException: if the number of documents is
+                                             off, in which case the cores
+                                             aren't swapped
+        """
+        self.admin.unset_properties(self.name, _BULK_PROPERTIES.keys())
+        self.admin.commit(self.name)
+        count = self.admin.count(self.name)
+        if abs(count - expected_count) > expected_count * tolerance:
+            raise ShadowCoreMismatchException(self.name, expected_count, count)
+        logger.info("Swapping %s with %s", self.name, self.core)
+        self.admin.swap(self.core, self.name)
+        if not keep_old:
+            # After the swap, the old index is the one called self.name
+            logger.info("Deleting the old index of %s", self.core)
+            self.admin.unload(self.name)
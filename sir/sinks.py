@@ -0,0 +1,133 @@
+# Copyright (c) 2026 MetaBrainz Foundation
+# License: MIT, see LICENSE for details
+"""
+This module contains the destinations documents can be sent to instead of a
+Solr core. They have the same ``add`` and ``commit`` methods as
+:class:`pysolr.Solr` that are used by :mod:`sir.indexing`, so they can be
+used wherever a Solr connection is expected.
+"""
+import gzip
+import json
+import multiprocessing
+import os
+import threading
+
+from . import util
+from ctypes import c_long
+from functools import partial
+from logging import getLogger
+
+
+logger = getLogger("sir")
+
+#: The names of the sinks that can be selected with ``reindex --sink``
+SINKS = ("solr", "jsonl", "null")
+
+
+class JSONLinesSink(object):
+    """
+    Writes documents as newline-delimited JSON into a file per core and
+    process in ``directory``, for example to load them into a different
+    cluster later on.
+
+    If ``compress`` is true, each batch is appended to the file as a gzip
+    member, so the file stays readable with ``zcat`` even if a process is
+    killed.
+    """
+
+    def __init__(self, directory, core, compress=False):
+        """
+        :param str directory:
+        :param str core:
+        :param bool compress:
+        """
+        self.directory = directory
+        self.core = core
+        self.compress = compress
+        self.url = os.path.join(directory, core)
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        """
+        The path of the file of the current process.
+        """
+        extension = ".jsonl.gz" if self.compress else ".jsonl"
+        return os.path.join(self.directory, "%s.%i%s" % (self.core,
+                                                         os.getpid(),
+                                                         extension))
+
+    def add(self, docs, **kwargs):
+        data = "".join(json.dumps(doc, default=str) + "\n" for doc in docs)
+        with self.lock:
+            if self.compress:
+                with gzip.open(self.path, "ab") as f:
+                    f.write(data)
+            else:
+                with open(self.path, "a") as f:
+                    f.write(data)
+
+    def commit(self, **kwargs):
+        pass
+
+
+class NullSink(object):
+    """
+    Discards all documents, only counting them and the size of their JSON
+    serialization, to measure how fast documents can be retrieved and
+    converted without a Solr server. The counts are shared by all processes
+    and logged by :meth:`log_totals` once the entity has been imported.
+    """
+
+    def __init__(self, core):
+        """
+        :param str core:
+        """
+        self.core = core
+        self.url = "null:" + core
+        self.documents = multiprocessing.Value(c_long, 0)
+        self.bytes = multiprocessing.Value(c_long, 0)
+
+    def add(self, docs, **kwargs):
+        size = sum(len(json.dumps(doc, default=str)) for doc in docs)
+        with self.documents.get_lock():
+            self.documents.value += len(docs)
+        with self.bytes.get_lock():
+            self.bytes.value += size
+
+    def commit(self, **kwargs):
+        pass
+
+    def log_totals(self):
+        logger.info("Discarded %i documents with %i bytes of %s",
+                    self.documents.value, self.bytes.value, self.core)
+
+
+def _jsonl_connection(directory, compress, core, max_inflight=1):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return JSONLinesSink(directory, core, compress)
+
+
+def _null_connection(core, max_inflight=1):
+    return NullSink(core)
+
+
+def sink_connection_function(name, directory=None, compress=False):
+    """
+    Return a function that, like :func:`sir.util.solr_connection`, returns a
+    connection to the sink ``name`` for a core and a number of threads.
+
+    :param str name: One of :data:`SINKS`
+    :param str directory: The directory of the ``jsonl`` sink
+    :param bool compress: Whether the ``jsonl`` sink compresses its files
+    :raises ValueError: if ``name`` is unknown
+    """
+    if name == "solr":
+        return util.solr_connection
+    if name == "jsonl":
+        return partial(_jsonl_connection, directory, compress)
+    if name == "null":
+        return _null_connection
+    raise ValueError("Unknown sink %r, expected one of %s" %
+                     (name, ", ".join(SINKS)))
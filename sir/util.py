@@ -4,21 +4,27 @@ from __future__ import absolute_import
 
 import amqp
 import logging
+import os
 import pysolr
+import requests
 import urllib2
 
 from . import config
 from .schema import SCHEMA
+from ConfigParser import NoOptionError
 from contextlib import contextmanager
 from functools import partial
 from json import loads
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, select
 from sqlalchemy.engine.url import URL
 from sqlalchemy.orm import sessionmaker
 
 
 logger = logging.getLogger("sir")
 
+#: Maps process ids to the engine of that process. See :func:`engine`.
+_ENGINES = {}
+
 
 class SIR_EXIT(Exception):
     pass
@@ -36,20 +42,72 @@ class VersionMismatchException(Exception):
                                                   self.actual)
 
 
-def db_session():
+def _ping_connection(connection, branch):
+    """
+    Make sure ``connection`` still works before it's used by running a
+    ``SELECT 1`` on it. If the database closed it in the meantime, the whole
+    pool is invalidated and a new connection is created.
+    """
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def engine():
     """
-    Creates a new :class:`sqla:sqlalchemy.orm.session.sessionmaker`.
+    Returns the :class:`sqla:sqlalchemy.engine.Engine` of the current process,
+    creating it on the first call. Its connection pool is reused by all
+    sessions of the process, so batches don't have to open a new connection
+    to the database every time.
 
-    :rtype: :class:`sqla:sqlalchemy.orm.session.sessionmaker`
+    Forked processes get an engine of their own. The connections the parent
+    process had open at the time of the fork are never used or closed in the
+    child, because closing them would also close them for the parent.
+
+    :rtype: :class:`sqla:sqlalchemy.engine.Engine`
     """
+    pid = os.getpid()
+    if pid in _ENGINES:
+        return _ENGINES[pid]
     cget = partial(config.CFG.get, "database")
     cdict = {"username": cget("user")}
     for key in ["password", "host", "port"]:
         cdict[key] = cget(key)
     cdict["database"] = cget("dbname")
-    e = create_engine(URL("postgresql", **cdict), server_side_cursors=False)
-    S = sessionmaker(bind=e)
-    return S
+    try:
+        pool_size = config.CFG.getint("database", "pool_size")
+    except NoOptionError:
+        pool_size = 5
+    try:
+        pre_ping = config.CFG.getboolean("database", "pool_pre_ping")
+    except NoOptionError:
+        pre_ping = True
+    e = create_engine(URL("postgresql", **cdict), server_side_cursors=False,
+                      pool_size=pool_size)
+    if pre_ping:
+        event.listen(e, "engine_connect", _ping_connection)
+    _ENGINES[pid] = e
+    return e
+
+
+def db_session():
+    """
+    Creates a new :class:`sqla:sqlalchemy.orm.session.sessionmaker` bound to
+    the :func:`engine` of the current process.
+
+    :rtype: :class:`sqla:sqlalchemy.orm.session.sessionmaker`
+    """
+    return sessionmaker(bind=engine())
 
 
 @contextmanager
@@ -70,11 +128,16 @@ def db_session_ctx(Session):
         session.close()
 
 
-def solr_connection(core):
+def solr_connection(core, max_inflight=1):
     """
     Creates a :class:`solr:solr.Solr` connection for the core ``core``.
 
+    The HTTP connections of the returned object are kept alive and it can be
+    used by up to ``max_inflight`` threads at the same time without opening
+    new ones for each request.
+
     :param str core:
+    :param int max_inflight:
     :raises urllib2.URLError: if a ping to the cores ping handler doesn't
                               succeed
     :rtype: :class:`solr:solr.Solr`
@@ -88,7 +151,14 @@ def solr_connection(core):
     urllib2.urlopen(ping_uri)
 
     logger.debug("Connection to the Solr core at %s", core_uri)
-    return pysolr.Solr(core_uri)
+    connection = pysolr.Solr(core_uri)
+    # Create the session right away so the threads don't race to do it
+    session = connection.get_session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max(max_inflight, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return connection
 
 
 def solr_version_check(core):
@@ -1,5 +1,6 @@
 from collections import namedtuple
-from sqlalchemy import Column, ForeignKey, Integer
+from sir.schema.modelext import aggregate_property
+from sqlalchemy import Column, ForeignKey, Integer, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import composite, relationship
 
@@ -25,9 +26,10 @@ class B(Base):
 class C(Base):
     """
     A class with a one-to-many relationship to :class:`.B` via its ``bs``
-    attribute.
+    attribute and their number in ``b_count``.
     """
     __tablename__ = "table_c"
     id = Column(Integer, primary_key=True)
     bar = Column(Integer)
     bs = relationship("B")
+    b_count = aggregate_property(func.count(B.id), B.c_id, id, default=0)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sir.batchsizing import BatchSizer, load_batch_sizes, save_batch_sizes
+
+
+class BatchSizerTest(unittest.TestCase):
+    def test_initial_size(self):
+        self.assertEqual(BatchSizer(100, 10)(), 100)
+
+    def test_shrinks_to_target(self):
+        sizer = BatchSizer(100, 10)
+        sizer.record(100, 20, 0)
+        self.assertEqual(sizer(), 50)
+
+    def test_growth_limited(self):
+        sizer = BatchSizer(100, 10)
+        sizer.record(100, 1, 0)
+        self.assertEqual(sizer(), 200)
+
+    def test_max_size(self):
+        sizer = BatchSizer(100, 10, max_size=150)
+        sizer.record(100, 1, 0)
+        self.assertEqual(sizer(), 150)
+
+    def test_memory_budget(self):
+        sizer = BatchSizer(100, 10, max_memory=1000)
+        sizer.record(100, 10, 4000)
+        self.assertEqual(sizer(), 25)
+
+    def test_constant_high_rss(self):
+        # A worker whose RSS stays above the budget doesn't grow while
+        # importing the batches, so they don't shrink
+        sizer = BatchSizer(20000, 60, max_memory=1024 * 1024 * 1024)
+        for _ in range(10):
+            sizer.record(sizer(), 60, 0)
+        self.assertGreater(sizer(), 19000)
+
+    def test_min_size(self):
+        sizer = BatchSizer(100, 10, max_memory=1000, min_size=10)
+        for _ in range(5):
+            sizer.record(sizer(), 10, 1000000)
+        self.assertEqual(sizer(), 10)
+
+    def test_learned_size_below_min_size(self):
+        self.assertEqual(BatchSizer(1, 10, min_size=10)(), 10)
+
+    def test_empty_batch_ignored(self):
+        sizer = BatchSizer(100, 10)
+        sizer.record(0, 5, 0)
+        self.assertEqual(sizer(), 100)
+        self.assertIsNone(sizer.rows_per_second)
+
+
+class BatchSizesFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, "batch_sizes.json")
+
+    def test_missing_file(self):
+        self.assertEqual(load_batch_sizes(self.path), {})
+
+    def test_sizes_merged(self):
+        save_batch_sizes(self.path, {"artist": 100, "label": 50})
+        save_batch_sizes(self.path, {"artist": 200})
+        self.assertEqual(load_batch_sizes(self.path),
+                         {"artist": 200, "label": 50})
+
+    def test_invalid_file(self):
+        with open(self.path, "w") as f:
+            f.write("{")
+        self.assertEqual(load_batch_sizes(self.path), {})
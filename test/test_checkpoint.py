@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sir.checkpoint import CheckpointJournal
+
+
+class CheckpointJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, "checkpoints")
+
+    def test_missing_file(self):
+        journal = CheckpointJournal(self.path)
+        self.assertFalse(journal.is_completed("artist", (1, 10)))
+
+    def test_record_persisted(self):
+        CheckpointJournal(self.path).record("artist", (1, 10))
+        CheckpointJournal(self.path).record("artist", (10, None))
+        journal = CheckpointJournal(self.path)
+        self.assertTrue(journal.is_completed("artist", (1, 10)))
+        self.assertTrue(journal.is_completed("artist", (10, None)))
+        self.assertFalse(journal.is_completed("label", (1, 10)))
+
+    def test_covered_bounds(self):
+        journal = CheckpointJournal(self.path)
+        journal.record("artist", (1, 10))
+        journal.record("artist", (20, None))
+        self.assertTrue(journal.is_completed("artist", (2, 9)))
+        self.assertTrue(journal.is_completed("artist", (25, 30)))
+        self.assertFalse(journal.is_completed("artist", (5, 15)))
+        self.assertFalse(journal.is_completed("artist", (1, None)))
+
+    def test_clear(self):
+        journal = CheckpointJournal(self.path)
+        journal.record("artist", (1, 10))
+        journal.record("label", (1, 10))
+        journal.clear(["artist"])
+        journal = CheckpointJournal(self.path)
+        self.assertFalse(journal.is_completed("artist", (1, 10)))
+        self.assertTrue(journal.is_completed("label", (1, 10)))
+
+    def test_partial_line_ignored(self):
+        with open(self.path, "w") as f:
+            f.write("artist 1 10\nartist 10")
+        journal = CheckpointJournal(self.path)
+        self.assertTrue(journal.is_completed("artist", (1, 10)))
+        self.assertFalse(journal.is_completed("artist", (10, 20)))
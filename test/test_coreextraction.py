@@ -0,0 +1,318 @@
+import itertools
+import json
+import mbdata.models
+import mock
+import unittest
+
+from collections import namedtuple
+from sir.schema import SCHEMA
+from sir.schema.searchentities import SearchEntity as E, SearchField as F
+from sqlalchemy import (Column, DateTime, ForeignKey, Integer, String,
+                        create_engine, event, func, select)
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import column_property, composite, relationship
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+Base = declarative_base()
+
+
+class Date(namedtuple("Date", ["year", "month"])):
+    def __composite_values__(self):
+        return tuple(self)
+
+
+class Country(Base):
+    __tablename__ = "country"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+class Alias(Base):
+    __tablename__ = "alias"
+    id = Column(Integer, primary_key=True)
+    person_id = Column(Integer, ForeignKey("person.id"))
+    name = Column(String)
+    locale = Column(String)
+    person = relationship("Person")
+
+
+class Person(Base):
+    __tablename__ = "person"
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    begin_year = Column(Integer)
+    begin_month = Column(Integer)
+    begin = composite(Date, begin_year, begin_month)
+    country_id = Column(Integer, ForeignKey("country.id"))
+    country = relationship("Country")
+    aliases = relationship("Alias")
+    alias_count = column_property(select([func.count(Alias.id)]).
+                                  where(Alias.person_id == id))
+    updated = Column(DateTime)
+
+    @property
+    def upper_name(self):
+        return self.name.upper()
+
+
+def only_with_aliases(query):
+    return query.filter(Person.aliases.any())
+
+
+FIELDS = [
+    F("id", "id"),
+    F("name", ["name", "aliases.name"]),
+    F("locale", "aliases.locale"),
+    F("begin", "begin", transformfunc=lambda dates: set(
+        "%s-%s" % date for date in dates)),
+    F("country", "country.name"),
+    F("alias_country", "aliases.person.country.name"),
+    F("alias_count", "alias_count"),
+    F("table", "aliases.__tablename__"),
+]
+
+
+class CoreExtractorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(cls.engine)
+        session = sessionmaker(bind=cls.engine)()
+        germany = Country(id=1, name="Germany")
+        session.add_all([
+            Person(id=1, name="a", begin=Date(1990, 1), country=germany,
+                   aliases=[Alias(id=1, name="a1", locale="de"),
+                            Alias(id=2, name="a2")]),
+            Person(id=2, name="b", begin=Date(None, None)),
+            Person(id=3, name="c", begin=Date(2000, None), country=germany),
+            Person(id=4, name="d", aliases=[Alias(id=3, name="d")]),
+        ])
+        session.commit()
+        session.close()
+
+    def setUp(self):
+        config_patcher = mock.patch("sir.config.CFG")
+        self.addCleanup(config_patcher.stop)
+        config_patcher.start().getboolean.return_value = False
+        self.session = sessionmaker(bind=self.engine)()
+        self.addCleanup(self.session.close)
+        self.entity = E(Person, FIELDS, 1.0)
+        self.condition = Person.id > 0
+
+    def orm_documents(self):
+        query = (self.entity.query.filter(self.condition).
+                 with_session(self.session))
+        return dict((row.id, self.entity.query_result_to_dict(row))
+                    for row in query)
+
+    def core_documents(self, **kwargs):
+        rows = self.entity.core_extractor.iter_rows(self.session,
+                                                    self.condition, **kwargs)
+        return dict((row.id, self.entity.field_values_to_dict(row.values))
+                    for row in rows)
+
+    def test_same_documents(self):
+        documents = self.orm_documents()
+        self.assertEqual(len(documents), 4)
+        self.assertEqual(documents[1]["alias_country"], "Germany")
+        self.assertEqual(documents[1]["begin"], "1990-1")
+        self.assertEqual(documents[1]["table"], "alias")
+        self.assertEqual(documents[2]["begin"], "None-None")
+        self.assertEqual(self.core_documents(), documents)
+
+    def test_condition(self):
+        self.condition = Person.id.in_([2, 4])
+        documents = self.core_documents()
+        self.assertEqual(sorted(documents), [2, 4])
+        self.assertEqual(documents, self.orm_documents())
+
+    def test_chunks(self):
+        with mock.patch("sir.coreextraction._IN_CHUNK_SIZE", 1):
+            documents = self.core_documents(chunk_size=1)
+        self.assertEqual(documents, self.orm_documents())
+
+    def test_extraquery(self):
+        self.entity = E(Person, FIELDS, 1.0, extraquery=only_with_aliases)
+        documents = self.core_documents()
+        self.assertEqual(sorted(documents), [1, 4])
+        self.assertEqual(documents, self.orm_documents())
+
+    def test_unsupported_path(self):
+        entity = E(Person, [F("name", "upper_name")], 1.0)
+        self.assertIsNone(entity.core_extractor)
+
+
+# SQLite doesn't have Postgres' JSON functions, so they're emulated. The
+# arrays aggregated by json_agg are marked so json_build_array can tell them
+# apart from strings.
+_JSON_AGG_MARKER = "json_agg:"
+
+
+def json_build_array(*elements):
+    return json.dumps([json.loads(element[len(_JSON_AGG_MARKER):])
+                       if (isinstance(element, basestring) and
+                           element.startswith(_JSON_AGG_MARKER))
+                       else element
+                       for element in elements])
+
+
+class JSONAgg(object):
+    def __init__(self):
+        self.arrays = []
+
+    def step(self, array):
+        self.arrays.append(array)
+
+    def finalize(self):
+        return _JSON_AGG_MARKER + "[%s]" % ",".join(self.arrays)
+
+
+class JSONExtractorTest(CoreExtractorTest):
+    @classmethod
+    def setUpClass(cls):
+        super(JSONExtractorTest, cls).setUpClass()
+        connection = cls.engine.raw_connection()
+        connection.connection.create_function("json_build_array", -1,
+                                              json_build_array)
+        connection.connection.create_aggregate("json_agg", 1, JSONAgg)
+        connection.close()
+
+    def core_documents(self, **kwargs):
+        rows = self.entity.json_extractor.iter_rows(self.session,
+                                                    self.condition, **kwargs)
+        return dict((row.id, self.entity.field_values_to_dict(row.values))
+                    for row in rows)
+
+    def test_statement(self):
+        statement = str(self.entity.json_extractor.statement(self.condition))
+        self.assertEqual(statement.count("json_agg("), 4)
+        self.assertIn("person AS person_1", statement)
+        self.assertIn("person AS person_2", statement)
+
+    def test_unsupported_path(self):
+        entity = E(Person, [F("name", "upper_name")], 1.0)
+        self.assertIsNone(entity.json_extractor)
+
+    def test_unsupported_type(self):
+        entity = E(Person, [F("updated", "updated")], 1.0)
+        self.assertIsNone(entity.json_extractor)
+        self.assertIsNotNone(entity.core_extractor)
+
+
+def attach_musicbrainz_schema(dbapi_connection, connection_record):
+    dbapi_connection.execute("ATTACH DATABASE ':memory:' AS musicbrainz")
+
+
+class SchemaExtractionTest(unittest.TestCase):
+    """
+    Compares the documents of the ORM and the extractors for entities of
+    :data:`sir.schema.SCHEMA`.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.engine = create_engine("sqlite://")
+        event.listen(cls.engine, "connect", attach_musicbrainz_schema)
+        connection = cls.engine.raw_connection()
+        connection.connection.create_function("json_build_array", -1,
+                                              json_build_array)
+        connection.connection.create_aggregate("json_agg", 1, JSONAgg)
+        connection.close()
+        # Without the indexes, which SQLite can't create in another schema
+        for table in mbdata.models.Base.metadata.sorted_tables:
+            if table.schema == "musicbrainz":
+                cls.engine.execute(CreateTable(table))
+        gids = ("%032i" % i for i in itertools.count())
+
+        session = sessionmaker(bind=cls.engine)()
+
+        def insert(model, *rows):
+            session.add_all(model(**row) for row in rows)
+            session.flush()
+
+        insert(mbdata.models.AreaType, {"id": 1, "name": "Country",
+                                        "gid": next(gids)})
+        insert(mbdata.models.Area,
+               {"id": 1, "gid": next(gids), "name": "Germany", "type_id": 1,
+                "begin_date_year": 1990, "ended": False},
+               {"id": 2, "gid": next(gids), "name": "Berlin",
+                "ended": True},
+               {"id": 3, "gid": next(gids), "name": "Empty",
+                "ended": False})
+        insert(mbdata.models.AreaAlias,
+               {"id": 1, "area_id": 1, "name": "Deutschland",
+                "sort_name": "Deutschland"})
+        insert(mbdata.models.ISO31661, {"area_id": 1, "code": "DE"})
+        insert(mbdata.models.Tag, {"id": 1, "name": "europe"})
+        insert(mbdata.models.AreaTag, {"area_id": 1, "tag_id": 1,
+                                       "count": 1})
+        insert(mbdata.models.Place,
+               *[{"id": i, "gid": next(gids), "name": "Place %i" % i,
+                  "area_id": 1 + i % 2} for i in range(1, 4)])
+        insert(mbdata.models.Label, {"id": 1, "gid": next(gids),
+                                     "name": "Label", "area_id": 2})
+        insert(mbdata.models.Artist,
+               *[{"id": i, "gid": next(gids), "name": "Artist %i" % i,
+                  "sort_name": "Artist %i" % i, "area_id": 1}
+                 for i in range(1, 3)])
+        insert(mbdata.models.Annotation,
+               *[{"id": i, "editor_id": 1, "text": "Text %i" % i}
+                 for i in range(1, 5)])
+        # Only the latest annotation of each area is valid
+        insert(mbdata.models.AreaAnnotation,
+               {"area_id": 1, "annotation_id": 1},
+               {"area_id": 1, "annotation_id": 3},
+               {"area_id": 2, "annotation_id": 2})
+        insert(mbdata.models.ArtistAnnotation,
+               {"artist_id": 1, "annotation_id": 4})
+        session.commit()
+        session.close()
+
+    def setUp(self):
+        config_patcher = mock.patch("sir.config.CFG")
+        self.addCleanup(config_patcher.stop)
+        config_patcher.start().getboolean.return_value = False
+        self.session = sessionmaker(bind=self.engine)()
+        self.addCleanup(self.session.close)
+
+    def documents(self, entity_name):
+        """
+        Return the documents of ``entity_name`` built by the ORM, the
+        :class:`CoreExtractor` and the :class:`JSONExtractor`.
+        """
+        schema_entity = SCHEMA[entity_name]
+        # A copy, so the cached query doesn't depend on the config of other
+        # tests
+        entity = E(schema_entity.model, schema_entity.fields,
+                   schema_entity.version, extraquery=schema_entity.extraquery)
+        condition = entity.model.id > 0
+        objs = (entity.query.filter(condition).with_session(self.session).
+                all())
+        entity.load_aggregates(self.session, objs)
+        documents = [dict((obj.id, entity.query_result_to_dict(obj))
+                          for obj in objs)]
+        for extractor in (entity.core_extractor, entity.json_extractor):
+            rows = extractor.iter_rows(self.session, condition)
+            documents.append(dict((row.id,
+                                   entity.field_values_to_dict(row.values))
+                                  for row in rows))
+        return documents
+
+    def test_area(self):
+        orm, core, json = self.documents("area")
+        self.assertEqual(sorted(orm), [1, 2, 3])
+        self.assertEqual(orm[1]["ref_count"], 3)
+        self.assertEqual(orm[2]["ref_count"], 3)
+        self.assertNotIn("ref_count", orm[3])
+        self.assertEqual(orm[1]["iso1"], "DE")
+        self.assertEqual(core, orm)
+        self.assertEqual(json, orm)
+
+    def test_annotation(self):
+        orm, core, json = self.documents("annotation")
+        self.assertEqual(sorted(orm), [2, 3, 4])
+        self.assertEqual(orm[3]["type"], "area")
+        self.assertEqual(orm[4]["type"], "artist")
+        self.assertEqual(core, orm)
+        self.assertEqual(json, orm)
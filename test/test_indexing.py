@@ -1,17 +1,37 @@
+import doctest
+import json
 import mock
+import os
+import pysolr
+import shutil
+import tempfile
+import threading
 import unittest
 
 import sir.indexing
+import sir.metrics
 
-from multiprocessing import Queue
+from test import models
+from collections import Counter
+from datetime import datetime
+from ConfigParser import NoOptionError
+from multiprocessing import Lock, Pipe, Queue
+from multiprocessing.queues import SimpleQueue
+from Queue import Queue as ThreadQueue
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Query, sessionmaker
+from sir.checkpoint import CheckpointJournal
 from sir.indexing import queue_to_solr, send_data_to_solr, FAILED
+from sir.schema.searchentities import SearchEntity, SearchField
+from sir.sinks import NullSink
+from sir.util import SIR_EXIT
 from pysolr import SolrError
 
 class QueueToSolrTest(unittest.TestCase):
     def setUp(self):
         self.solr_connection = mock.Mock()
         self.queue = Queue()
-        self.queue.put({"foo": "bar"})
+        self.queue.put((None, [{"foo": "bar"}]))
         self.queue.put(None)
 
     def test_normal_send(self):
@@ -24,9 +44,142 @@ class QueueToSolrTest(unittest.TestCase):
         queue_to_solr(self.queue, 2, self.solr_connection)
         self.solr_connection.add.assert_called_once_with([{"foo": "bar"}])
 
+    def test_chunk_split_into_batches(self):
+        queue = Queue()
+        queue.put((None, [{"id": i} for i in range(5)]))
+        queue.put(None)
+        queue_to_solr(queue, 2, self.solr_connection)
+        expected = [mock.call([{"id": 0}, {"id": 1}]),
+                    mock.call([{"id": 2}, {"id": 3}]),
+                    mock.call([{"id": 4}])]
+        calls = self.solr_connection.add.call_args_list
+        self.assertEqual(calls, expected)
+
+    def test_batches_capped_by_size(self):
+        queue = Queue()
+        docs = [{"id": "1", "_store": "x" * 100},
+                {"id": "2", "_store": "x" * 10},
+                {"id": "3", "_store": "x" * 10},
+                {"id": "4", "_store": "x" * 10}]
+        queue.put((None, docs))
+        queue.put(None)
+        max_bytes = sum(sir.indexing._estimate_document_size(d)
+                        for d in docs[1:3])
+        queue_to_solr(queue, 10, self.solr_connection,
+                      max_batch_bytes=max_bytes)
+        expected = [mock.call(docs[:1]),
+                    mock.call(docs[1:3]),
+                    mock.call(docs[3:])]
+        calls = self.solr_connection.add.call_args_list
+        self.assertEqual(calls, expected)
+
+    def test_sent_documents_acked(self):
+        queue = Queue()
+        queue.put(((1, 3), [{"id": 1}, {"id": 2}]))
+        queue.put(((3, 5), [{"id": 3}]))
+        queue.put(None)
+        ack_queue = Queue()
+        queue_to_solr(queue, 2, self.solr_connection, ack_queue)
+        self.assertEqual(ack_queue.get(timeout=1), Counter({(1, 3): 2}))
+        self.assertEqual(ack_queue.get(timeout=1), Counter({(3, 5): 1}))
+
+    def test_failed_documents_not_acked(self):
+        self.solr_connection.add.side_effect = SolrError("Test Error")
+        ack_queue = Queue()
+        queue_to_solr(self.queue, 1, self.solr_connection, ack_queue)
+        self.assertTrue(ack_queue.empty())
+
+
+class SolrSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.solr_connection = mock.Mock()
+
+    def test_concurrent_sends(self):
+        # The mock's call list isn't safe to update from several threads
+        sent = []
+        sent_lock = threading.Lock()
+
+        def add(data, **kwargs):
+            with sent_lock:
+                sent.extend(doc["id"] for doc in data)
+
+        self.solr_connection.add.side_effect = add
+        ack_queue = ThreadQueue()
+        sender = sir.indexing._SolrSender(self.solr_connection, 3, ack_queue)
+        for i in range(10):
+            sender.send([{"id": i}], [i])
+        # Waits until all threads are done sending
+        sender.close()
+        self.assertEqual(sorted(sent), range(10))
+        acked = Counter()
+        while not ack_queue.empty():
+            acked.update(ack_queue.get_nowait())
+        self.assertEqual(acked, Counter(range(10)))
+
+    def test_error_raised_on_close(self):
+        self.solr_connection.add.side_effect = ValueError("Test Error")
+        sender = sir.indexing._SolrSender(self.solr_connection, 2)
+        sender.send([{"id": 1}], [None])
+        self.assertRaises(ValueError, sender.close)
+
+
+class DocumentBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.budget = sir.indexing._DocumentBudget(5)
+
+    def tearDown(self):
+        sir.indexing.PROCESS_FLAG.value = True
+
+    def test_blocks_until_released(self):
+        self.budget.acquire(4)
+        timer = threading.Timer(0.2, self.budget.release, (4,))
+        timer.start()
+        self.budget.acquire(2)
+        timer.join()
+        self.assertEqual(self.budget.documents.value, 2)
+        self.assertEqual(self.budget.peak.value, 4)
+        self.assertGreater(self.budget.blocked_seconds.value, 0)
+
+    def test_metrics(self):
+        def value(metric):
+            return sir.metrics.REGISTRY.values[metric._index("artist")]
+
+        peak = value(sir.metrics.QUEUE_PEAK_DEPTH)
+        blocked = value(sir.metrics.BUDGET_BLOCKED_SECONDS)
+        budget = sir.indexing._DocumentBudget(5, "artist")
+        budget.acquire(3)
+        budget.release(2)
+        budget.acquire(3)
+        timer = threading.Timer(0.2, budget.release, (4,))
+        timer.start()
+        budget.acquire(2)
+        timer.join()
+        self.assertEqual(value(sir.metrics.QUEUE_PEAK_DEPTH) - peak, 4)
+        self.assertGreater(value(sir.metrics.BUDGET_BLOCKED_SECONDS),
+                           blocked)
+
+    def test_large_chunk_admitted_when_empty(self):
+        self.budget.acquire(8)
+        self.assertEqual(self.budget.documents.value, 8)
+
+    def test_exit_while_blocked(self):
+        self.budget.acquire(5)
+        sir.indexing.PROCESS_FLAG.value = False
+        self.assertRaises(SIR_EXIT, self.budget.acquire, 1)
+
+    def test_released_after_send(self):
+        queue = Queue()
+        sir.indexing._BudgetedQueue(queue, self.budget).put(
+            (None, [{"id": 1}, {"id": 2}]))
+        queue.put(None)
+        queue_to_solr(queue, 1, mock.Mock(), budget=self.budget)
+        self.assertEqual(self.budget.documents.value, 0)
+
 
 class SendDataToSolrTest(unittest.TestCase):
     def setUp(self):
+        # Other tests leave FAILED set
+        FAILED.value = False
         self.solr_connection = mock.MagicMock()
         self.solr_connection.add = mock.MagicMock()
 
@@ -42,6 +195,195 @@ class SendDataToSolrTest(unittest.TestCase):
         send_data_to_solr(self.solr_connection, [{"foo": "bar"}])
         self.assertTrue(FAILED.value)
 
+    def test_commit_within(self):
+        solr_connection = pysolr.Solr("http://localhost/solr/artist")
+        with mock.patch.object(solr_connection, "_update") as update:
+            self.assertEqual(send_data_to_solr(solr_connection,
+                                               [{"foo": "bar"}], 500),
+                             set())
+        message = update.call_args[0][0]
+        self.assertTrue(message.startswith('<add commitWithin="500">'))
+
+
+class CommitPolicyTest(unittest.TestCase):
+    def setUp(self):
+        config = mock.patch("sir.indexing.config.CFG")
+        self.cfg = config.start()
+        self.addCleanup(config.stop)
+        self.options = {}
+
+        def get(section, option):
+            try:
+                return self.options[option]
+            except KeyError:
+                raise NoOptionError(option, section)
+        self.cfg.get.side_effect = get
+        self.cfg.getint.side_effect = lambda s, o: int(get(s, o))
+
+    def test_default(self):
+        self.assertEqual(sir.indexing._commit_policy(False), ("hard", None))
+
+    def test_separate_live_policy(self):
+        self.options = {"live_commit": "within", "reindex_commit": "soft",
+                        "commit_within": "2000"}
+        self.assertEqual(sir.indexing._commit_policy(True), ("within", 2000))
+        self.assertEqual(sir.indexing._commit_policy(False), ("soft", None))
+
+    def test_unknown_policy(self):
+        self.options = {"reindex_commit": "sometimes"}
+        self.assertRaises(ValueError, sir.indexing._commit_policy, False)
+
+
+class EntityImportCommitTest(unittest.TestCase):
+    def make_import(self, policy):
+        entity_import = sir.indexing._EntityImport("artist", iter([]), 1,
+                                                   commit_policy=policy)
+        entity_import.solr_connection = mock.Mock()
+        return entity_import
+
+    def test_soft_commit(self):
+        entity_import = self.make_import("soft")
+        entity_import.commit()
+        entity_import.solr_connection.commit.assert_called_once_with(
+            softCommit=True)
+
+    def test_no_commit(self):
+        for policy in ("none", "within"):
+            entity_import = self.make_import(policy)
+            entity_import.commit()
+            self.assertFalse(entity_import.solr_connection.commit.called)
+
+    def test_sink_totals_logged_without_commit(self):
+        entity_import = self.make_import("none")
+        entity_import.solr_connection = NullSink("artist")
+        entity_import.solr_processes = [mock.Mock(exitcode=0, **{
+            "is_alive.return_value": False})]
+        entity_import.exhausted = True
+        with mock.patch.object(NullSink, "log_totals") as log_totals:
+            entity_import.finish_if_done(None, False)
+        log_totals.assert_called_once_with()
+        self.assertTrue(entity_import.done)
+
+BAD_REQUEST = "Solr responded with an error (HTTP 400): Bad document"
+
+
+class SendBisectingTest(unittest.TestCase):
+    def setUp(self):
+        FAILED.value = False
+        self.solr_connection = mock.Mock()
+        self.solr_connection.url = "http://localhost/solr/artist"
+        self.sent = []
+
+        def add(docs):
+            if any(doc["id"] == 3 for doc in docs):
+                raise SolrError(BAD_REQUEST)
+            self.sent.extend(docs)
+        self.solr_connection.add.side_effect = add
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.dead_letters = sir.indexing._DeadLetterFile(
+            os.path.join(self.tempdir, "dead_letters.jsonl"))
+
+    def test_bad_document_isolated(self):
+        data = [{"id": i} for i in range(6)]
+        rejected = send_data_to_solr(self.solr_connection, data,
+                                     dead_letters=self.dead_letters)
+        self.assertEqual(rejected, set([3]))
+        self.assertEqual(sorted(doc["id"] for doc in self.sent),
+                         [0, 1, 2, 4, 5])
+        self.assertFalse(FAILED.value)
+        with open(self.dead_letters.path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]["document"], {"id": 3})
+        self.assertEqual(lines[0]["core"], self.solr_connection.url)
+        self.assertEqual(lines[0]["error"], BAD_REQUEST)
+
+    @mock.patch("sir.indexing.get_sentry")
+    def test_transport_error_not_bisected(self, get_sentry):
+        error = SolrError("Failed to connect to server at 'localhost'")
+        self.solr_connection.add.side_effect = error
+        data = [{"id": i} for i in range(6)]
+        rejected = send_data_to_solr(self.solr_connection, data,
+                                     dead_letters=self.dead_letters)
+        self.assertEqual(rejected, set(range(6)))
+        self.assertEqual(self.solr_connection.add.call_count, 1)
+        self.assertEqual(get_sentry.return_value.captureException.call_count,
+                         1)
+        self.assertTrue(FAILED.value)
+        self.assertFalse(os.path.exists(self.dead_letters.path))
+
+    @mock.patch("sir.indexing.get_sentry")
+    def test_server_error_while_bisecting(self, get_sentry):
+        self.solr_connection.add.side_effect = [
+            SolrError(BAD_REQUEST), None,
+            SolrError("Solr responded with an error (HTTP 503): Down")]
+        data = [{"id": i} for i in range(6)]
+        rejected = send_data_to_solr(self.solr_connection, data,
+                                     dead_letters=self.dead_letters)
+        self.assertEqual(rejected, set([3, 4, 5]))
+        self.assertTrue(FAILED.value)
+        self.assertFalse(os.path.exists(self.dead_letters.path))
+
+    def test_bad_request_bisected_without_retries(self):
+        data = [{"id": i} for i in range(6)]
+        rejected = send_data_to_solr(self.solr_connection, data, retries=2)
+        self.assertEqual(rejected, set([3]))
+        calls = self.solr_connection.add.call_args_list
+        self.assertEqual(calls.count(mock.call(data)), 1)
+        self.assertEqual(calls.count(mock.call([{"id": 3}])), 1)
+
+    def test_retried_before_failing(self):
+        self.solr_connection.add.side_effect = [SolrError("Unavailable"),
+                                                None]
+        data = [{"id": 1}, {"id": 2}]
+        rejected = send_data_to_solr(self.solr_connection, data, retries=1)
+        self.assertEqual(rejected, set())
+        self.assertEqual(self.solr_connection.add.call_args_list,
+                         [mock.call(data), mock.call(data)])
+
+    def test_retries_overwrite(self):
+        self.solr_connection.add.side_effect = [SolrError("Unavailable"),
+                                                None]
+        data = [{"id": 1}]
+        send_data_to_solr(self.solr_connection, data, retries=1,
+                          overwrite=False)
+        self.assertEqual(self.solr_connection.add.call_args_list,
+                         [mock.call(data, overwrite=False), mock.call(data)])
+
+    def test_rejected_documents_not_acked(self):
+        queue = Queue()
+        queue.put(((1, 4), [{"id": 1}, {"id": 2}, {"id": 3}]))
+        queue.put(None)
+        ack_queue = Queue()
+        queue_to_solr(queue, 3, self.solr_connection, ack_queue)
+        self.assertEqual(ack_queue.get(timeout=1), Counter({(1, 4): 2}))
+
+
+class ChangedIdQueriesTest(unittest.TestCase):
+    def queries(self, entity_names, follow_paths=True):
+        since = datetime(2020, 1, 1)
+        return [(core_name, str(query)) for core_name, query in
+                sir.indexing._changed_id_queries(entity_names, since,
+                                                 follow_paths)]
+
+    def test_own_rows(self):
+        queries = self.queries(["artist"], follow_paths=False)
+        self.assertEqual(len(queries), 1)
+        core_name, query = queries[0]
+        self.assertEqual(core_name, "artist")
+        self.assertIn("WHERE musicbrainz.artist.last_updated >=", query)
+
+    def test_related_rows(self):
+        queries = self.queries(["artist"])
+        self.assertTrue(all(core_name == "artist" for core_name, _ in queries))
+        self.assertTrue(any("WHERE musicbrainz.area.last_updated >=" in query
+                            for _, query in queries))
+
+    def test_tables_without_last_updated_skipped(self):
+        self.assertEqual(self.queries(["tag"]), [])
+
+
 class LiveIndexFailTest(unittest.TestCase):
     def setUp(self):
         self.imp = sir.indexing._multiprocessed_import = mock.MagicMock()
@@ -55,3 +397,363 @@ class LiveIndexFailTest(unittest.TestCase):
         with self.assertRaises(Exception):
             sir.indexing.live_index(mock.MagicMock())
         self.assertTrue(FAILED.value)
+
+
+@mock.patch("sir.indexing._ImportWorkers")
+class LiveImportWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(sir.indexing._discard_live_workers)
+
+    def test_reused(self, import_workers):
+        worker_function = mock.Mock()
+        queues, workers = sir.indexing._live_import_workers(2, 0,
+                                                            worker_function)
+        self.assertEqual(sorted(queues), sorted(sir.indexing.SCHEMA))
+        self.assertEqual(sir.indexing._live_import_workers(2, 0,
+                                                           worker_function),
+                         (queues, workers))
+        import_workers.assert_called_once_with(2, mock.ANY)
+
+    def test_discarded(self, import_workers):
+        _, workers = sir.indexing._live_import_workers(2, 0, mock.Mock())
+        sir.indexing._discard_live_workers(close=True)
+        workers.close.assert_called_once_with()
+        sir.indexing._live_import_workers(2, 0, mock.Mock())
+        self.assertEqual(import_workers.call_count, 2)
+
+
+class NextEntityImportTest(unittest.TestCase):
+    def setUp(self):
+        self.cheap = sir.indexing._EntityImport("cheap", iter([]), 1)
+        self.expensive = sir.indexing._EntityImport("expensive", iter([]), 3)
+
+    def test_shares_proportional_to_cost(self):
+        imports = [self.cheap, self.expensive]
+        picked = []
+        for _ in range(8):
+            entity_import = sir.indexing._next_entity_import(imports)
+            entity_import.dispatched()
+            picked.append(entity_import.name)
+        self.assertEqual(picked.count("expensive"), 6)
+        self.assertEqual(picked.count("cheap"), 2)
+
+    def test_skips_finished_entities(self):
+        self.expensive.exhausted = True
+        self.assertIs(sir.indexing._next_entity_import([self.cheap,
+                                                        self.expensive]),
+                      self.cheap)
+        self.cheap.failed = True
+        self.assertIsNone(sir.indexing._next_entity_import([self.cheap,
+                                                            self.expensive]))
+
+    def test_max_active(self):
+        other = sir.indexing._EntityImport("other", iter([]), 1)
+        imports = [self.cheap, self.expensive, other]
+        self.cheap.solr_processes = self.expensive.solr_processes = [None]
+        self.cheap.pass_value = self.expensive.pass_value = 1
+        self.assertIs(sir.indexing._next_entity_import(imports, 3), other)
+        self.assertIs(sir.indexing._next_entity_import(imports, 2),
+                      self.cheap)
+        # Other entities may only start once an active one is done
+        self.cheap.exhausted = self.expensive.exhausted = True
+        self.assertIsNone(sir.indexing._next_entity_import(imports, 2))
+        self.cheap.done = True
+        self.assertIs(sir.indexing._next_entity_import(imports, 2), other)
+
+
+class ExpectedDocumentCountTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.addCleanup(self.session.close)
+        self.session.add_all([models.B(id=i) for i in range(1, 11)])
+        self.session.commit()
+        # Like the annotation entity, which only imports the latest
+        # annotations
+        entity = SearchEntity(models.B, [SearchField("id", "id")], 1.0,
+                              extraquery=lambda query:
+                              query.filter(models.B.id % 2 == 0))
+        patcher = mock.patch.dict(sir.indexing.SCHEMA, {"b": entity})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.journal = CheckpointJournal(os.path.join(tempdir, "journal"))
+
+    def count(self, importlimit=0):
+        return sir.indexing._expected_document_count(self.session, "b",
+                                                     self.journal,
+                                                     importlimit)
+
+    def test_extraquery(self):
+        self.assertEqual(self.count(), 5)
+
+    def test_importlimit(self):
+        self.journal.record("b", (1, 4))
+        self.journal.record("b", (4, 7))
+        self.journal.record("b", (7, 7))
+        self.assertEqual(self.count(importlimit=8), 3)
+
+    def test_importlimit_not_reached(self):
+        self.journal.record("b", (1, 6))
+        self.journal.record("b", (6, None))
+        self.assertEqual(self.count(importlimit=100), 5)
+
+
+class IterBoundsBatchesTest(unittest.TestCase):
+    def test_completed_batches_skipped(self):
+        journal = mock.Mock()
+        journal.is_completed.side_effect = lambda e, bounds: bounds == (1, 5)
+        batches = list(sir.indexing._iter_bounds_batches("artist",
+                                                         [(1, 5), (5, None)],
+                                                         journal))
+        self.assertEqual(batches, [("artist", (5, None))])
+
+
+class IterRowsStreamedTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        self.session.add_all([models.B(id=i) for i in range(1, 8)])
+        self.session.commit()
+        self.session.expunge_all()
+        self.entity = mock.Mock()
+        self.entity.model = models.B
+        self.entity.query = Query(models.B)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_all_rows_returned(self):
+        rows = sir.indexing._iter_rows_streamed(self.entity,
+                                                models.B.id > 2,
+                                                self.session, 2)
+        self.assertEqual([row.id for row in rows], [3, 4, 5, 6, 7])
+
+    def test_finished_chunks_expunged(self):
+        rows = sir.indexing._iter_rows_streamed(self.entity,
+                                                models.B.id > 0,
+                                                self.session, 3)
+        for _ in range(4):
+            next(rows)
+        self.assertEqual(sorted(obj.id for obj in self.session), [4, 5, 6])
+
+
+class QueryDatabaseExtractionTest(unittest.TestCase):
+    def setUp(self):
+        self.entity = mock.Mock()
+        self.entity.core_extractor.iter_rows.return_value = [
+            mock.Mock(id=1, values=[{1}])]
+        self.entity.field_values_to_dict.return_value = {"id": 1}
+        (self.entity.query.filter.return_value.with_session.return_value.
+         all.return_value) = []
+        patchers = [mock.patch.dict(sir.indexing.SCHEMA,
+                                    {"test": self.entity}),
+                    mock.patch("sir.util.db_session_ctx"),
+                    mock.patch("sir.util.db_session")]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        config = mock.patch("sir.config.CFG")
+        self.config = config.start()
+        self.addCleanup(config.stop)
+        self.config.getint.side_effect = NoOptionError("", "")
+        self.config.get.return_value = "core"
+        self.config.getboolean.return_value = False
+
+    def query(self):
+        queue = mock.Mock()
+        count = sir.indexing._query_database("test", models.B.id > 0, queue)
+        return count, queue
+
+    def test_core(self):
+        count, queue = self.query()
+        self.assertEqual(count, 1)
+        queue.put.assert_called_once_with((None, [{"id": 1}]))
+        self.entity.field_values_to_dict.assert_called_once_with([{1}])
+
+    def test_json(self):
+        self.config.get.return_value = "json"
+        self.entity.json_extractor.iter_rows.return_value = [
+            mock.Mock(id=1, values=[{1}])]
+        count, queue = self.query()
+        self.assertEqual(count, 1)
+        queue.put.assert_called_once_with((None, [{"id": 1}]))
+        self.assertFalse(self.entity.core_extractor.iter_rows.called)
+
+    def test_orm_with_wscompat(self):
+        self.config.getboolean.return_value = True
+        self.assertEqual(self.query()[0], 0)
+        self.assertFalse(self.entity.core_extractor.iter_rows.called)
+
+    def test_unknown_engine(self):
+        self.config.get.return_value = "magic"
+        self.assertRaises(ValueError, self.query)
+
+
+class ImportWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.task_queue = SimpleQueue()
+        self.reader, self.writer = Pipe(duplex=False)
+        wrapper = mock.patch("sir.indexing._index_entity_process_wrapper")
+        self.wrapper = wrapper.start()
+        self.addCleanup(wrapper.stop)
+
+    def run_worker(self, tasks, **kwargs):
+        for task in tasks:
+            self.task_queue.put(task)
+        self.task_queue.put(None)
+        sir.indexing._import_worker(self.task_queue, self.writer, Lock(), {},
+                                    **kwargs)
+        messages = []
+        while self.reader.poll():
+            messages.append(self.reader.recv()[1:])
+        return messages
+
+    def test_results_reported(self):
+        self.wrapper.side_effect = [((1, 5), 4), ValueError("Test Error")]
+        messages = self.run_worker([(0, ("artist", (1, 5))),
+                                    (1, ("artist", (5, None)))])
+        self.assertEqual(messages, [(0, None, None),
+                                    (0, True, (((1, 5), 4), mock.ANY,
+                                               mock.ANY)),
+                                    (1, None, None),
+                                    (1, False, "ValueError('Test Error',)")])
+
+    @unittest.skipUnless(sir.indexing._reset_peak_rss(),
+                         "The peak RSS can't be reset")
+    def test_peak_memory_reported(self):
+        def import_batch(*args):
+            # Freed again before the batch is done
+            data = "x" * 64 * 1024 * 1024
+            del data
+            return (1, 5), 4
+
+        self.wrapper.side_effect = import_batch
+        messages = self.run_worker([(0, ("artist", (1, 5)))])
+        memory = messages[1][2][2]
+        # The RSS is back where it was, so its growth would be about 0
+        self.assertGreater(memory, 32 * 1024 * 1024)
+
+    def test_recycled_after_max_rows(self):
+        self.wrapper.return_value = 3
+        messages = self.run_worker([(0, ("artist", [1, 2, 3])),
+                                    (1, ("artist", [4, 5, 6])),
+                                    (2, ("artist", [7]))],
+                                   live=True, max_rows=5)
+        self.assertEqual([m[0] for m in messages if m[1]], [0, 1])
+
+
+@mock.patch("sir.indexing.ShadowCore")
+@mock.patch("sir.indexing.CoreAdmin", mock.Mock())
+@mock.patch("sir.indexing._expected_document_count", mock.Mock())
+@mock.patch("sir.indexing.util.db_session_ctx", mock.MagicMock())
+@mock.patch("sir.indexing.util.db_session", mock.Mock())
+@mock.patch("sir.indexing._multiprocessed_import")
+class ReindexIntoShadowCoresTest(unittest.TestCase):
+    def setUp(self):
+        config_patcher = mock.patch("sir.config.CFG")
+        self.addCleanup(config_patcher.stop)
+        cfg = config_patcher.start()
+
+        def get(section, option):
+            if option == "uri":
+                return "http://localhost/solr"
+            raise NoOptionError(option, section)
+
+        # Only the uri is set, everything else uses the defaults
+        cfg.get.side_effect = get
+        cfg.getint.side_effect = cfg.getfloat.side_effect = get
+        cfg.getboolean.side_effect = get
+        FAILED.value = False
+
+    def reindex(self, resume=False):
+        sir.indexing._reindex_into_shadow_cores(["artist"], None, resume)
+
+    def test_not_overwritten(self, multiprocessed_import, shadow_core):
+        self.reindex()
+        self.assertFalse(multiprocessed_import.call_args[1]["overwrite"])
+
+    def test_overwritten_on_resume(self, multiprocessed_import, shadow_core):
+        self.reindex(resume=True)
+        self.assertTrue(multiprocessed_import.call_args[1]["overwrite"])
+
+    def test_swapped(self, multiprocessed_import, shadow_core):
+        multiprocessed_import.return_value = set()
+        self.reindex()
+        self.assertTrue(shadow_core.return_value.finish.called)
+
+    def test_failed_entity_not_swapped(self, multiprocessed_import,
+                                       shadow_core):
+        multiprocessed_import.return_value = set(["artist"])
+        self.reindex()
+        self.assertFalse(shadow_core.return_value.finish.called)
+
+
+@mock.patch("sir.indexing.metrics.start_exporters", mock.Mock())
+@mock.patch("sir.indexing.sink_connection_function", mock.Mock())
+@mock.patch("sir.indexing.util.check_solr_cores_version", mock.Mock())
+@mock.patch("sir.indexing._multiprocessed_import")
+@mock.patch("sir.indexing.CheckpointJournal")
+class ReindexTest(unittest.TestCase):
+    def setUp(self):
+        self.options = {"checkpoint_file": "reindex.checkpoints"}
+        config_patcher = mock.patch("sir.config.CFG")
+        self.addCleanup(config_patcher.stop)
+        cfg = config_patcher.start()
+
+        def get(section, option):
+            try:
+                return self.options[option]
+            except KeyError:
+                raise NoOptionError(option, section)
+        cfg.get.side_effect = get
+        cfg.getboolean.return_value = True
+
+    def reindex(self, **kwargs):
+        args = {"entity_type": ["artist"], "resume": False}
+        args.update(kwargs)
+        sir.indexing.reindex(args)
+
+    def test_solr_journal_cleared(self, journal_class, multiprocessed_import):
+        self.reindex()
+        journal = journal_class.return_value
+        journal.clear.assert_called_once_with(["artist"])
+        multiprocessed_import.assert_called_once_with(["artist"],
+                                                      journal=journal,
+                                                      connect=mock.ANY)
+
+    def test_solr_journal_resumed(self, journal_class, multiprocessed_import):
+        self.reindex(resume=True)
+        self.assertFalse(journal_class.return_value.clear.called)
+
+    def test_no_journal_for_other_sinks(self, journal_class,
+                                        multiprocessed_import):
+        for sink in ("null", "jsonl"):
+            self.reindex(sink=sink)
+            self.reindex(sink=sink, resume=True)
+        self.assertFalse(journal_class.called)
+        for call in multiprocessed_import.call_args_list:
+            self.assertIsNone(call[1]["journal"])
+
+    def test_shadow_needs_solr_sink(self, journal_class,
+                                    multiprocessed_import):
+        self.reindex(sink="null", shadow=True)
+        self.assertFalse(journal_class.called)
+        self.assertFalse(multiprocessed_import.called)
+
+    @mock.patch("sir.indexing.logger")
+    def test_wscompat_disables_extraction(self, logger, journal_class,
+                                          multiprocessed_import):
+        self.reindex()
+        self.assertFalse(logger.warning.called)
+        self.options["extraction"] = "core"
+        self.reindex()
+        logger.warning.assert_called_once_with(mock.ANY, "core")
+
+
+def load_tests(loader, tests, ignore):
+    tests.addTests(doctest.DocTestSuite(sir.indexing))
+    return tests
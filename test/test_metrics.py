@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from sir.metrics import Registry, start_http_server, write_stats_file
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry(["artist", "work"])
+        self.counter = self.registry.counter("rows_total", "Rows")
+        self.histogram = self.registry.histogram("seconds", "Seconds",
+                                                 (1, 10))
+        self.registry.allocate()
+
+    def test_counter(self):
+        self.counter.inc("artist", 3)
+        self.counter.inc("artist")
+        output = self.registry.render()
+        self.assertIn('rows_total{entity="artist"} 4\n', output)
+        self.assertIn('rows_total{entity="work"} 0\n', output)
+        self.assertIn("# TYPE rows_total counter\n", output)
+
+    def test_unknown_entity_ignored(self):
+        self.counter.inc("unknown")
+        self.histogram.observe(None, 1)
+        self.assertNotIn("unknown", self.registry.render())
+
+    def test_histogram(self):
+        self.histogram.observe("work", 0.5)
+        self.histogram.observe("work", 5)
+        self.histogram.observe("work", 20)
+        output = self.registry.render()
+        self.assertIn('seconds_bucket{entity="work",le="1"} 1\n', output)
+        self.assertIn('seconds_bucket{entity="work",le="10"} 2\n', output)
+        self.assertIn('seconds_bucket{entity="work",le="+Inf"} 3\n', output)
+        self.assertIn('seconds_sum{entity="work"} 25.5\n', output)
+        self.assertIn('seconds_count{entity="work"} 3\n', output)
+        self.assertIn('seconds_count{entity="artist"} 0\n', output)
+
+
+class ExporterTest(unittest.TestCase):
+    def test_http_server(self):
+        server = start_http_server(0, "127.0.0.1")
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        response = urllib2.urlopen("http://127.0.0.1:%i/metrics" %
+                                   server.server_port)
+        self.assertIn("# TYPE sir_db_rows_total counter", response.read())
+
+    def test_stats_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "metrics.prom")
+        write_stats_file(path)
+        with open(path) as f:
+            self.assertIn("sir_solr_batch_seconds_count", f.read())
+        self.assertEqual(os.listdir(directory), ["metrics.prom"])
@@ -0,0 +1,71 @@
+import mock
+import multiprocessing
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from sir import profiling
+
+
+def work(value):
+    return value * 2
+
+
+def nested(value):
+    return profiled_work(value)
+
+
+profiled_work = profiling.profiled(work)
+profiled_nested = profiling.profiled(nested)
+
+
+class ProfilingTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        patcher = mock.patch.multiple(profiling, _DIRECTORY=None, _EVERY=1,
+                                      _PROFILER=None, _PROFILER_PID=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def calls(self, function):
+        stats = pstats.Stats(os.path.join(self.tempdir, "merged.prof"))
+        return sum(call_count for (_, _, name), (call_count, _, _, _, _)
+                   in stats.stats.items() if name == function)
+
+    def test_disabled(self):
+        self.assertEqual(profiled_work(2), 4)
+        self.assertIsNone(profiling.report(self.tempdir))
+
+    def test_every_nth_call(self):
+        profiling.enable(self.tempdir, every=2)
+        for i in range(4):
+            self.assertEqual(profiled_work(i), i * 2)
+        profiling.report(self.tempdir)
+        self.assertEqual(self.calls("work"), 2)
+
+    def test_nested_calls(self):
+        profiling.enable(self.tempdir)
+        profiled_nested(1)
+        profiling.report(self.tempdir)
+        self.assertEqual(self.calls("nested"), 1)
+        self.assertEqual(self.calls("work"), 1)
+
+    def test_processes_merged(self):
+        profiling.enable(self.tempdir)
+        profiled_work(1)
+        process = multiprocessing.Process(target=profiled_work, args=(2,))
+        process.start()
+        process.join()
+        report = profiling.report(self.tempdir)
+        self.assertEqual(self.calls("work"), 2)
+        with open(report) as f:
+            self.assertIn("cumulative", f.read())
+
+    def test_old_stats_removed(self):
+        profiling.enable(self.tempdir)
+        profiled_work(1)
+        profiling.enable(self.tempdir)
+        self.assertIsNone(profiling.report(self.tempdir))
@@ -0,0 +1,77 @@
+import mock
+import unittest
+
+from mbdata.models import Annotation
+from sir.schema import queryext
+from sqlalchemy import Column, MetaData, Table
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.query import Query
+
+
+class FilterValidAnnotationsTest(unittest.TestCase):
+    def statement(self):
+        return str(queryext.filter_valid_annotations(Query(Annotation.id)).
+                   statement)
+
+    def test_subquery(self):
+        statement = self.statement()
+        self.assertEqual(statement.count("max("), len(queryext.models))
+        self.assertNotIn("sir_valid_annotation", statement)
+
+    @mock.patch("sir.schema.queryext._valid_annotation_table",
+                Table("sir_valid_annotation_test", MetaData(), Column("id")))
+    def test_table(self):
+        statement = self.statement()
+        self.assertNotIn("max(", statement)
+        self.assertIn("FROM sir_valid_annotation_test", statement)
+
+    @mock.patch("sir.schema.queryext._valid_annotation_table", None)
+    def test_create_table(self):
+        engine = mock.MagicMock()
+        engine.dialect = postgresql.dialect()
+        queryext.create_valid_annotation_table(engine)
+        connection = engine.begin.return_value.__enter__.return_value
+        statements = [call[0][0] for call in
+                      connection.execute.call_args_list]
+        statements = [statement if isinstance(statement, basestring)
+                      else str(statement.compile(dialect=engine.dialect))
+                      for statement in statements]
+        name = queryext._valid_annotation_table.name
+        self.assertTrue(name.startswith("sir_valid_annotation_"))
+        self.assertTrue(statements[0].strip().startswith(
+            "CREATE UNLOGGED TABLE %s" % name))
+        self.assertTrue(statements[1].startswith(
+            "INSERT INTO %s (id) SELECT" % name))
+        self.assertEqual(statements[2], "ANALYZE %s" % name)
+
+    @mock.patch("sir.schema.queryext._valid_annotation_table", None)
+    def test_unique_names(self):
+        names = set()
+        for _ in range(2):
+            queryext.create_valid_annotation_table(mock.MagicMock())
+            names.add(queryext._valid_annotation_table.name)
+        self.assertEqual(len(names), 2)
+
+    @mock.patch("sir.schema.queryext._valid_annotation_table", None)
+    def test_create_table_fails(self):
+        engine = mock.MagicMock()
+        engine.begin.side_effect = OperationalError("CREATE", {}, None)
+        queryext.create_valid_annotation_table(engine)
+        self.assertIsNone(queryext._valid_annotation_table)
+        self.assertEqual(self.statement().count("max("), len(queryext.models))
+
+    def test_drop_table(self):
+        table = Table("sir_valid_annotation_test", MetaData())
+        engine = mock.Mock()
+        with mock.patch("sir.schema.queryext._valid_annotation_table", table):
+            queryext.drop_valid_annotation_table(engine)
+            self.assertIsNone(queryext._valid_annotation_table)
+        engine.execute.assert_called_once_with(
+            "DROP TABLE IF EXISTS sir_valid_annotation_test")
+
+    @mock.patch("sir.schema.queryext._valid_annotation_table", None)
+    def test_drop_without_table(self):
+        engine = mock.Mock()
+        queryext.drop_valid_annotation_table(engine)
+        self.assertFalse(engine.execute.called)
@@ -4,8 +4,10 @@ import unittest
 
 from test import helpers, models
 from collections import defaultdict
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.properties import RelationshipProperty
-from sir.querying import iterate_path_values
+from sir.querying import compile_paths, iterate_path_values, iter_bounds
 from sir.schema.searchentities import defer_everything_but, merge_paths
 from sir.schema import generate_update_map, SCHEMA
 from sir.trigger_generation.paths import second_last_model_in_path
@@ -91,6 +93,44 @@ class IteratePathValuesTest(unittest.TestCase):
         self.assertEqual(res, [models.C.__tablename__])
 
 
+class CompilePathsTest(unittest.TestCase):
+    def setUp(self):
+        self.c = models.C(id=1, bar=3)
+        self.c.bs.append(models.B(id=1, c=self.c))
+        self.c.bs.append(models.B(id=2))
+
+    def extract(self, model, *field_paths):
+        return compile_paths(model, field_paths)(self.c if model is models.C
+                                                 else self.c.bs[0])
+
+    def test_one_to_many(self):
+        self.assertEqual(self.extract(models.C, ["bs.id"]), [{1, 2}])
+
+    def test_attribute_without_relationship(self):
+        self.assertEqual(self.extract(models.C, ["id"]), [{1}])
+
+    def test_many_to_one(self):
+        self.assertEqual(self.extract(models.B, ["c.id"]), [{1}])
+
+    def test_many_to_one_missing(self):
+        extract = compile_paths(models.B, [["c.id"]])
+        self.assertEqual(extract(self.c.bs[1]), [set()])
+
+    def test_shared_prefixes(self):
+        res = self.extract(models.C, ["bs.id", "id"], ["bs.c.bar"], ["bs.c"],
+                           ["bar"])
+        self.assertEqual(res, [{1, 2}, {3}, {self.c}, {3}])
+
+    def test_non_sqlalchemy_paths(self):
+        res = self.extract(models.C, ["__tablename__"])
+        self.assertEqual(res, [{models.C.__tablename__}])
+
+    def test_lists_and_none(self):
+        c = mock.Mock(spec=models.C, bar=[1, 2], id=None)
+        extract = compile_paths(models.C, [["bar", "id"]])
+        self.assertEqual(extract(c), [{1, 2}])
+
+
 class MergePathsTest(unittest.TestCase):
     def test_dotless_path(self):
         paths = [["id"], ["name"]]
@@ -110,6 +150,53 @@ class MergePathsTest(unittest.TestCase):
         self.assertEqual(dict(merge_paths(paths)), expected)
 
 
+class IterBoundsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine("sqlite:///:memory:")
+        models.Base.metadata.create_all(engine)
+        cls.session = sessionmaker(bind=engine)()
+        # Leave some gaps in the ids
+        cls.session.add_all([models.B(id=i) for i in range(1, 30, 2)])
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+
+    def bounds(self, batch_size, importlimit=0):
+        return list(iter_bounds(self.session, models.B.id, batch_size,
+                                importlimit))
+
+    def test_is_lazy(self):
+        bounds = iter_bounds(self.session, models.B.id, 4, 0)
+        self.assertEqual(next(bounds), (1, 9))
+
+    def test_bounds(self):
+        self.assertEqual(self.bounds(4),
+                         [(1, 9), (9, 17), (17, 25), (25, None)])
+
+    def test_variable_batch_size(self):
+        sizes = iter([2, 4, 100])
+        self.assertEqual(self.bounds(lambda: next(sizes)),
+                         [(1, 5), (5, 13), (13, None)])
+
+    def test_batch_size_one(self):
+        self.assertEqual(len(self.bounds(1)), 15)
+
+    def test_importlimit(self):
+        self.assertEqual(self.bounds(4, 9),
+                         [(1, 9), (9, 17), (17, 17)])
+
+    def test_importlimit_larger_than_table(self):
+        self.assertEqual(self.bounds(4, 100),
+                         [(1, 9), (9, 17), (17, 25), (25, 25)])
+
+    def test_empty_table(self):
+        self.assertEqual(list(iter_bounds(self.session, models.C.id, 4, 0)),
+                         [])
+
+
 class DBTest(unittest.TestCase):
     def test_non_composite_fk(self):
         paths, _, models, _ = generate_update_map()
@@ -102,3 +102,27 @@ class SearchEntityTest(unittest.TestCase):
         # Retrieve them and make sure we only get 20
         query = searchentity_b.query.with_session(session)
         self.assertEqual(len(query.all()), self.FILTER_MAX)
+
+    @mock.patch("sir.config.CFG")
+    def test_load_aggregates(self, mock):
+        mock.getboolean.return_value = False
+        searchentity_c = E(models.C, [F("b_count", "b_count")], 1.0)
+
+        session = self.session
+        session.add_all([models.C(id=1, bs=[models.B(id=1), models.B(id=2)]),
+                         models.C(id=2),
+                         models.C(id=10, bs=[models.B(id=3)])])
+        session.commit()
+        expected = dict(session.query(models.C.id, models.C.b_count))
+        self.assertEqual(expected, {1: 2, 2: 0, 10: 1})
+        session.expunge_all()
+
+        # Sparse ids are selected with IN, dense ones by their range
+        for ids in ([1, 2, 10], [1, 2]):
+            objs = (searchentity_c.query.filter(models.C.id.in_(ids)).
+                    with_session(session).all())
+            searchentity_c.load_aggregates(session, objs)
+            self.assertTrue(all("b_count" in obj.__dict__ for obj in objs))
+            self.assertEqual(dict((obj.id, obj.b_count) for obj in objs),
+                             dict((id_, expected[id_]) for id_ in ids))
+            session.expunge_all()
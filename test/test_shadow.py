@@ -0,0 +1,152 @@
+import json
+import mock
+import threading
+import unittest
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from sir.shadow import (CoreAdmin, ShadowCore, ShadowCoreMismatchException,
+                        _BULK_PROPERTIES)
+
+
+class FakeSolr(object):
+    """
+    The state of a Solr server that implements just enough of the CoreAdmin,
+    Config, update and select APIs for :mod:`sir.shadow`.
+    """
+
+    def __init__(self):
+        # Maps core names to their state
+        self.cores = {}
+        self.requests = []
+
+    def add_core(self, name, documents=0, config_set=None, instance_dir=None):
+        self.cores[name] = {"documents": documents, "properties": {},
+                            "config_set": config_set,
+                            "instance_dir": instance_dir or name}
+
+
+class FakeSolrHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def respond(self, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body))
+
+    def do_GET(self, data=None):
+        solr = self.server.solr
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/")
+        solr.requests.append((parts, params, data))
+        if parts[1:] == ["admin", "cores"]:
+            action = params["action"]
+            if action == "STATUS":
+                core = params["core"]
+                status = {core: {"name": core}} if core in solr.cores else {}
+                return self.respond({"status": status})
+            if action == "CREATE":
+                solr.add_core(params["name"], config_set=params["configSet"],
+                              instance_dir=params["instanceDir"])
+            elif action == "SWAP":
+                core, other = params["core"], params["other"]
+                solr.cores[core], solr.cores[other] = (solr.cores[other],
+                                                       solr.cores[core])
+            elif action == "UNLOAD":
+                del solr.cores[params["core"]]
+            return self.respond({})
+        core = solr.cores.get(parts[1])
+        if core is None:
+            return self.respond({}, 404)
+        if parts[2] == "config":
+            core["properties"].update(data.get("set-property", {}))
+            for name in data.get("unset-property", []):
+                del core["properties"][name]
+        elif parts[2] == "select":
+            return self.respond({"response": {"numFound": core["documents"]}})
+        self.respond({})
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.do_GET(json.loads(self.rfile.read(length)))
+
+
+class ShadowCoreTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), FakeSolrHandler)
+        self.server.solr = self.solr = FakeSolr()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.solr.add_core("artist", documents=10, config_set="artist")
+        admin = CoreAdmin("http://127.0.0.1:%i/solr/" %
+                          self.server.server_port)
+        self.shadow = ShadowCore(admin, "artist", "artist")
+
+    def test_prepare_creates_tuned_core(self):
+        self.shadow.prepare()
+        shadow = self.solr.cores["artist_shadow"]
+        self.assertEqual(shadow["config_set"], "artist")
+        self.assertEqual(shadow["properties"], _BULK_PROPERTIES)
+
+    @mock.patch("sir.shadow.time.strftime")
+    def test_instance_dir_per_build(self, strftime):
+        strftime.return_value = "20260101000000"
+        self.shadow.prepare()
+        self.shadow.finish(0, tolerance=1)
+        strftime.return_value = "20260201000000"
+        self.shadow.prepare()
+        self.assertEqual(self.solr.cores["artist"]["instance_dir"],
+                         "artist_shadow_20260101000000")
+        self.assertEqual(self.solr.cores["artist_shadow"]["instance_dir"],
+                         "artist_shadow_20260201000000")
+
+    def test_prepare_recreates_existing_core(self):
+        self.solr.add_core("artist_shadow", documents=5)
+        self.shadow.prepare()
+        self.assertEqual(self.solr.cores["artist_shadow"]["documents"], 0)
+
+    def test_prepare_resumes_existing_core(self):
+        self.solr.add_core("artist_shadow", documents=5)
+        self.shadow.prepare(resume=True)
+        self.assertEqual(self.solr.cores["artist_shadow"]["documents"], 5)
+
+    def test_finish_swaps_cores(self):
+        self.shadow.prepare()
+        self.solr.cores["artist_shadow"]["documents"] = 12
+        self.shadow.finish(12)
+        self.assertEqual(self.solr.cores["artist"]["documents"], 12)
+        self.assertEqual(self.solr.cores["artist"]["properties"], {})
+        self.assertNotIn("artist_shadow", self.solr.cores)
+
+    def test_finish_keeps_old_core(self):
+        self.shadow.prepare()
+        self.solr.cores["artist_shadow"]["documents"] = 12
+        self.shadow.finish(12, keep_old=True)
+        self.assertEqual(self.solr.cores["artist_shadow"]["documents"], 10)
+
+    def test_finish_commits_before_counting(self):
+        self.shadow.prepare()
+        self.shadow.finish(0, tolerance=1)
+        paths = [parts[1:] for parts, _, _ in self.solr.requests]
+        self.assertLess(paths.index(["artist_shadow", "update"]),
+                        paths.index(["artist_shadow", "select"]))
+
+    def test_mismatch_not_swapped(self):
+        self.shadow.prepare()
+        self.solr.cores["artist_shadow"]["documents"] = 8
+        self.assertRaises(ShadowCoreMismatchException, self.shadow.finish,
+                          12, 0.1)
+        self.assertEqual(self.solr.cores["artist"]["documents"], 10)
+        self.assertEqual(self.solr.cores["artist_shadow"]["documents"], 8)
+
+    def test_mismatch_within_tolerance(self):
+        self.shadow.prepare()
+        self.solr.cores["artist_shadow"]["documents"] = 99
+        self.shadow.finish(100, tolerance=0.01)
+        self.assertEqual(self.solr.cores["artist"]["documents"], 99)
@@ -0,0 +1,65 @@
+import gzip
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from sir.sinks import JSONLinesSink, NullSink, sink_connection_function
+
+
+class JSONLinesSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def read(self, path, opener=open):
+        with opener(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_documents_appended(self):
+        sink = JSONLinesSink(self.tempdir, "artist")
+        sink.add([{"id": "1"}, {"id": "2"}])
+        sink.add([{"id": "3"}], commitWithin=1000)
+        self.assertEqual(os.path.basename(sink.path),
+                         "artist.%i.jsonl" % os.getpid())
+        self.assertEqual(self.read(sink.path),
+                         [{"id": "1"}, {"id": "2"}, {"id": "3"}])
+
+    def test_compressed(self):
+        sink = JSONLinesSink(self.tempdir, "artist", compress=True)
+        sink.add([{"id": "1"}])
+        sink.add([{"id": "2"}])
+        self.assertTrue(sink.path.endswith(".jsonl.gz"))
+        self.assertEqual(self.read(sink.path, gzip.open),
+                         [{"id": "1"}, {"id": "2"}])
+
+    def test_directory_created(self):
+        directory = os.path.join(self.tempdir, "spool")
+        sink = sink_connection_function("jsonl", directory)("artist", 2)
+        sink.add([{"id": "1"}])
+        self.assertTrue(os.path.exists(sink.path))
+
+
+class NullSinkTest(unittest.TestCase):
+    def test_counts(self):
+        sink = NullSink("artist")
+        sink.add([{"id": "1"}, {"id": "22"}])
+        self.assertEqual(sink.documents.value, 2)
+        self.assertEqual(sink.bytes.value, len('{"id": "1"}{"id": "22"}'))
+
+    @mock.patch("sir.sinks.logger")
+    def test_totals_not_logged_on_commit(self, logger):
+        sink = NullSink("artist")
+        sink.add([{"id": "1"}])
+        sink.commit(softCommit=True)
+        self.assertFalse(logger.info.called)
+        sink.log_totals()
+        logger.info.assert_called_once_with(
+            "Discarded %i documents with %i bytes of %s", 1, 11, "artist")
+
+
+class SinkConnectionFunctionTest(unittest.TestCase):
+    def test_unknown_sink(self):
+        self.assertRaises(ValueError, sink_connection_function, "kafka")
@@ -2,6 +2,7 @@ import mock
 import unittest
 
 from test.models import B
+from ConfigParser import NoOptionError
 from json import dumps
 from sir import util
 from sir.schema import searchentities
@@ -52,3 +53,34 @@ class VersionCheckerTest(unittest.TestCase):
                                 "^testcore: Expected 1.1, got 1.0",
                                 util.solr_version_check,
                                 "testcore")
+
+
+class EngineTest(unittest.TestCase):
+    def setUp(self):
+        create_engine = mock.patch("sir.util.create_engine")
+        self.create_engine = create_engine.start()
+        self.addCleanup(create_engine.stop)
+        self.create_engine.side_effect = lambda *args, **kwargs: mock.Mock()
+
+        config = mock.patch("sir.util.config.CFG")
+        cfg = config.start()
+        self.addCleanup(config.stop)
+        cfg.get.return_value = "5432"
+        cfg.getint.side_effect = NoOptionError("pool_size", "database")
+        cfg.getboolean.return_value = False
+
+        engines = mock.patch.dict("sir.util._ENGINES", clear=True)
+        engines.start()
+        self.addCleanup(engines.stop)
+
+    def test_engine_reused(self):
+        self.assertIs(util.engine(), util.engine())
+        self.assertEqual(self.create_engine.call_count, 1)
+        self.assertEqual(self.create_engine.call_args[1]["pool_size"], 5)
+
+    def test_new_engine_after_fork(self):
+        parent_engine = util.engine()
+        with mock.patch("sir.util.os.getpid", return_value=-1):
+            child_engine = util.engine()
+        self.assertIsNot(parent_engine, child_engine)
+        self.assertFalse(parent_engine.dispose.called)